@@ -10,7 +10,8 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name = 'django-vsphere',
     version = '0.7',
-    packages = ['vsphere'],
+    packages = ['vsphere', 'vsphere.management',
+                'vsphere.management.commands'],
     include_package_data = True,
     description = 'Django app for vSphere Dashboard.',
     long_description = README,
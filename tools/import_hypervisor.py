@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from pysphere import VIServer, MORTypes, VIProperty
 from optparse import OptionParser
 from vsphere.models import VirtualNic
 from vsphere.models import Hypervisor
@@ -9,24 +8,163 @@ from vsphere.models import Vswitch
 from vsphere.models import Network
 from vsphere.models import Guest
 from vsphere.models import Disk
+from vsphere.models import ResourcePool
+from vsphere.models import update_resource_pools
+from vsphere.models import Datacenter
+from vsphere.models import update_datacenters
+from vsphere.models import update_datacenter_links
+from vsphere.models import record_samples
+from vsphere.models import update_capacity
 from os.path import expanduser
+from django.db import transaction, connection, reset_queries
+from django.core.exceptions import ValidationError
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
 from sys import exit
 import ConfigParser
+import json
+import gzip
+import time
+import os
 import re
 
+try:
+    from pysphere import VIServer, MORTypes, VIProperty
+except ImportError:
+    # pysphere is not needed to load a snapshot with -l
+    VIServer = MORTypes = VIProperty = None
+
+
+class SoapCounter(object):
+    """Proxy of a VIServer SOAP binding which counts the calls made through
+    it"""
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._proxy, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+if VIServer is not None:
+    class CountingVIServer(VIServer):
+        """VIServer whose SOAP binding is wrapped in a SoapCounter as soon
+        as connect creates it, so the calls of the login are counted"""
+
+        def __setattr__(self, name, value):
+            if name == '_proxy' and not isinstance(value, SoapCounter):
+                value = SoapCounter(value)
+            self.__dict__[name] = value
+
+
+class ImportMetrics(object):
+    """Wall time, SOAP calls, SQL queries and rows written of each import
+    phase of one host"""
+
+    def __init__(self, host):
+        self.host = host
+        self.server = None
+        self.phases = []
+        self.success = True
+        self.error = ''
+
+    def soap_calls(self):
+        return getattr(getattr(self.server, '_proxy', None), 'calls', 0)
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the enclosed block as the phase name, the block may set
+        the number of rows it wrote in the yielded dict. The queries are
+        counted in the query log, emptied before and after the phase so it
+        does not grow during the import"""
+        phase = {'phase': name, 'rows': 0}
+        soap_calls = self.soap_calls()
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        reset_queries()
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            phase['seconds'] = round(time.time() - start, 3)
+            phase['soap_calls'] = self.soap_calls() - soap_calls
+            phase['queries'] = len(connection.queries)
+            reset_queries()
+            connection.use_debug_cursor = debug_cursor
+            self.phases.append(phase)
+
+    def summary(self):
+        """Return a dict with the phases and their totals"""
+        ret_val = {'host': self.host,
+                   'success': self.success,
+                   'error': self.error,
+                   'phases': self.phases}
+        for key in ['seconds', 'soap_calls', 'queries', 'rows']:
+            ret_val[key] = sum([p[key] for p in self.phases])
+        ret_val['seconds'] = round(ret_val['seconds'], 3)
+        return ret_val
+
 
-def vmware_connect(host, user, password):
-    """Return a VIServer conneciont"""
-    s = VIServer()
-    s.connect(host, user, password)
+def prometheus_label(value):
+    """Escape a Prometheus label value as the text format requires"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def write_prometheus(filename, metrics_list):
+    """Write the phases of a list of ImportMetrics to a Prometheus textfile,
+    the file is replaced at once for the node exporter"""
+    lines = []
+    for key, text in [('seconds', 'Wall time'),
+                      ('soap_calls', 'SOAP calls'),
+                      ('queries', 'SQL queries'),
+                      ('rows', 'Rows written')]:
+        name = 'vsphere_import_phase_%s' % key
+        lines.append('# HELP %s %s of an import phase' % (name, text))
+        lines.append('# TYPE %s gauge' % name)
+        for metrics in metrics_list:
+            for phase in metrics.phases:
+                lines.append('%s{host="%s",phase="%s"} %s'
+                             % (name, prometheus_label(metrics.host),
+                                prometheus_label(phase['phase']),
+                                phase[key]))
+    lines.append('# HELP vsphere_import_success 1 if the host was imported')
+    lines.append('# TYPE vsphere_import_success gauge')
+    for metrics in metrics_list:
+        lines.append('vsphere_import_success{host="%s"} %d'
+                     % (prometheus_label(metrics.host), metrics.success))
+
+    f = open(filename + '.tmp', 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def vmware_connect(host, user, password, timeout=None, metrics=None):
+    """Return a VIServer conneciont, timeout is the socket timeout in
+    seconds. The SOAP calls of the connection are counted by SoapCounter,
+    from the login on when the server is given to metrics"""
+    s = CountingVIServer()
+    if metrics is not None:
+        metrics.server = s
+    s.connect(host, user, password, sock_timeout=timeout)
     return s
 
 
-def get_disks(vm):
-    """Return a list of disk dict with keys name, size, thin, raw, filename"""
+def get_disks(devices):
+    """Return a list of disk dict with keys name, size, thin, raw, filename
+    from a list of VirtualDevice properties"""
     ret_val = []
 
-    disks = [d for d in vm.properties.config.hardware.device
+    disks = [d for d in devices
              if d._type == 'VirtualDisk' and d.backing._type in
              ['VirtualDiskFlatVer1BackingInfo',
               'VirtualDiskFlatVer2BackingInfo',
@@ -49,25 +187,90 @@ def get_disks(vm):
     return ret_val
 
 
-def get_datastores(server):
-    """Return a list of datastore dict with keys name, capacity, freeSpace"""
+def get_host_snapshots(server):
+    """Return a list of host snapshot dict, one per HostSystem, with keys
+    mor, name, summary (HostListSummary), network (HostNetworkInfo) and
+    datastores (list of DatastoreSummary). All the hosts and all the
+    datastores are fetched with one property traversal each"""
+    results = server._retrieve_properties_traversal(
+        property_names=['summary'],
+        obj_type=MORTypes.Datastore
+    )
+    datastores = {}
+    for item in results or []:
+        for p in item.PropSet:
+            if p.Name == 'summary':
+                datastores[str(item.Obj)] = VIProperty(server, p.Val)
+
+    results = server._retrieve_properties_traversal(
+        property_names=['name', 'summary', 'config.network', 'datastore'],
+        obj_type=MORTypes.HostSystem
+    )
     ret_val = []
-    for ds_mor, name in server.get_datastores().items():
-        props = VIProperty(server, ds_mor)
-        capacity = props.summary.capacity / 1024 / 1024
-        freeSpace = props.summary.freeSpace / 1024 / 1024
+    for item in results or []:
+        snapshot = {'mor': item.Obj, 'datastores': []}
+        for p in item.PropSet:
+            if p.Name == 'name':
+                snapshot['name'] = p.Val
+            if p.Name == 'summary':
+                snapshot['summary'] = VIProperty(server, p.Val)
+            if p.Name == 'config.network':
+                snapshot['network'] = VIProperty(server, p.Val)
+            if p.Name == 'datastore':
+                snapshot['datastores'] = [
+                    datastores[str(mor)]
+                    for mor in p.Val.get_element_ManagedObjectReference()
+                    if str(mor) in datastores]
+        ret_val.append(snapshot)
+
+    return ret_val
+
+
+def get_host_datacenters(server):
+    """Return a dict of datacenter name indexed by HostSystem MOR, with one
+    property traversal per datacenter"""
+    ret_val = {}
+    for dc_mor, dc_name in server.get_datacenters().items():
+        results = server._retrieve_properties_traversal(
+            property_names=['name'],
+            from_node=dc_mor,
+            obj_type=MORTypes.HostSystem
+        )
+        for item in results or []:
+            ret_val[str(item.Obj)] = dc_name
+
+    return ret_val
+
+
+def get_host_snapshot(server):
+    """Return the snapshot of the first host from get_host_snapshots"""
+    return get_host_snapshots(server)[0]
+
+
+def get_datastores(server, snapshot=None):
+    """Return a list of datastore dict with keys name, url, capacity,
+    freeSpace. The url is the same on every host mounting the datastore"""
+    if snapshot is None:
+        snapshot = get_host_snapshot(server)
+    ret_val = []
+    for summary in snapshot.get('datastores'):
+        name = summary.name
+        url = summary.url
+        capacity = summary.capacity / 1024 / 1024
+        freeSpace = summary.freeSpace / 1024 / 1024
         ret_val.append({'name': name,
+                        'url': url,
                         'capacity': capacity,
                         'freeSpace': freeSpace})
     return ret_val
 
 
-def get_networks(server):
+def get_networks(server, snapshot=None):
     """Return a list a network dict with keys name, vlanId, vswitchName"""
-    mor, name = server.get_hosts().items()[0]
-    prop = VIProperty(server, mor)
+    if snapshot is None:
+        snapshot = get_host_snapshot(server)
     ret_val = []
-    for network in prop.configManager.networkSystem.networkInfo.portgroup:
+    for network in snapshot.get('network').portgroup:
         name = network.spec.name
         vlanId = network.spec.vlanId
         vswitchName = network.spec.vswitchName
@@ -78,11 +281,11 @@ def get_networks(server):
     return ret_val
 
 
-def get_interfaces(prop):
+def get_interfaces(network):
     """Return a list of interface dict with keys driver, linkSpeed, mac,
-    name"""
+    name from a HostNetworkInfo"""
     ret_val = []
-    for interface in prop.configManager.networkSystem.networkInfo.pnic:
+    for interface in network.pnic:
         name = interface.device
         mac = interface.mac
         driver = interface.driver
@@ -101,15 +304,16 @@ def get_interfaces(prop):
     return ret_val
 
 
-def get_vnics(vm):
-    """Return a list of vnic dict with keys name, mac, type, network"""
+def get_vnics(devices):
+    """Return a list of vnic dict with keys name, mac, type, network
+    from a list of VirtualDevice properties"""
     ret_val = []
-    for v in vm.get_property("devices").values():
-        if v.get('macAddress'):
-            name = v.get('label')
-            mac = v.get('macAddress')
-            driver = v.get('type')
-            network = v.get('summary')
+    for v in devices:
+        if hasattr(v, 'macAddress'):
+            name = v.deviceInfo.label
+            mac = v.macAddress
+            driver = v._type
+            network = v.deviceInfo.summary
             ret_val.append({'name': name,
                             'mac': mac,
                             'type': driver,
@@ -118,12 +322,12 @@ def get_vnics(vm):
     return ret_val
 
 
-def get_vswitch(server):
+def get_vswitch(server, snapshot=None):
     """Return a list of vswitch dict with keys name, nicDevice"""
-    mor, name = server.get_hosts().items()[0]
-    prop = VIProperty(server, mor)
+    if snapshot is None:
+        snapshot = get_host_snapshot(server)
     ret_val = []
-    for v in prop.configManager.networkSystem.networkConfig.vswitch:
+    for v in snapshot.get('network').vswitch:
         name = v.name
         nicDevice = v.spec.bridge.nicDevice  # this is a list
         ret_val.append({'name': name, 'nicDevice': nicDevice})
@@ -131,83 +335,115 @@ def get_vswitch(server):
     return ret_val
 
 
+def get_resource_pools(server):
+    """Return a dict of resource pool name indexed by resource pool MOR"""
+    results = server._retrieve_properties_traversal(
+        property_names=['name'],
+        obj_type=MORTypes.ResourcePool
+    )
+
+    ret_val = {}
+    if not results:
+        return ret_val
+
+    for item in results:
+        for p in item.PropSet:
+            if p.Name == 'name':
+                ret_val[str(item.Obj)] = p.Val
+
+    return ret_val
+
+
 def get_guests(server):
     """Return a list of dict guest"""
+    ret_val = []
+    for guests in get_guests_by_host(server).values():
+        ret_val.extend(guests)
+    return ret_val
+
 
-    properties = [
-        'name',
-        'storage.perDatastoreUsage',
-        'config.hardware.memoryMB',
-        'config.hardware.numCPU'
-    ]
+GUEST_PROPERTIES = [
+    'name',
+    'config.hardware.memoryMB',
+    'config.hardware.numCPU',
+    'config.hardware.device',
+    'config.annotation',
+    'config.guestFullName',
+    'runtime.powerState',
+    'runtime.host',
+    'resourcePool',
+]
+
+
+def get_guest(server, props, resource_pools):
+    """Return a guest dict from a dict of GUEST_PROPERTIES values and a dict
+    of resource pool name indexed by MOR"""
+    devices = []
+    if props.get('config.hardware.device') is not None:
+        devices = VIProperty(server,
+                             props.get('config.hardware.device')).VirtualDevice
+    resourcePool = resource_pools.get(str(props.get('resourcePool')),
+                                      'Default')
+
+    return {'name': props.get('name', ''),
+            'vcpu': int(props.get('config.hardware.numCPU', 0)),
+            'memory': int(props.get('config.hardware.memoryMB', 0)),
+            'disks': get_disks(devices),
+            'vnics': get_vnics(devices),
+            'poweredOn': props.get('runtime.powerState') == 'poweredOn',
+            'resourcePool': resourcePool,
+            'annotation': props.get('config.annotation', ''),
+            'osVersion': props.get('config.guestFullName', '')}
+
+
+def get_guests_by_host(server):
+    """Return a dict of list of dict guest indexed by HostSystem MOR
+
+    All the guest properties are fetched with a single PropertyCollector
+    traversal instead of one VIVirtualMachine per guest."""
     results = server._retrieve_properties_traversal(
-        property_names=properties,
+        property_names=GUEST_PROPERTIES,
         obj_type=MORTypes.VirtualMachine
     )
 
-    ret_val = []
+    ret_val = {}
     if not results:
         return ret_val
 
-    for item in results:
-        for p in item.PropSet:
-            if p.Name == 'config.hardware.memoryMB':
-                memory = int(p.Val)
-            if p.Name == 'config.hardware.numCPU':
-                vcpu = int(p.Val)
-            if p.Name == 'name':
-                name = p.Val
-        try:
-            vm = server.get_vm_by_name(name)
-        except:
-            poweredOn = False
-            disks = {}
-            osVersion = ''
-            annotation = ''
-            vnics = []
-            resourcePool = 'Default'
-        else:
-            annotation = vm.properties.config.annotation
-            osVersion = vm.get_property('guest_full_name')
-            poweredOn = vm.is_powered_on()
-            disks = get_disks(vm)
-            vnics = get_vnics(vm)
-            resourcePool = vm.get_resource_pool_name()
+    resource_pools = get_resource_pools(server)
 
-        ret_val.append({'name': name,
-                        'vcpu': vcpu,
-                        'memory': memory,
-                        'disks': disks,
-                        'vnics': vnics,
-                        'poweredOn': poweredOn,
-                        'resourcePool': resourcePool,
-                        'annotation': annotation,
-                        'osVersion': osVersion})
+    for item in results:
+        props = dict((p.Name, p.Val) for p in item.PropSet)
+        host = str(props.get('runtime.host'))
+        guest = get_guest(server, props, resource_pools)
+        ret_val.setdefault(host, []).append(guest)
 
     return ret_val
 
 
-def get_hardware(server):
+def get_hardware(server, snapshot=None):
     """Return a hardware dict"""
-
-    mor, name = server.get_hosts().items()[0]
-    prop = VIProperty(server, mor)
-    overallMemoryUsage = prop.summary.quickStats.overallMemoryUsage
-    overallCpuUsage = prop.summary.quickStats.overallCpuUsage
-    numCpuThreads = prop.summary.hardware.numCpuThreads
-    productName = prop.summary.config.product.name
-    productVersion = prop.summary.config.product.version
-    numCpuCores = prop.summary.hardware.numCpuCores
-    numCpuPkgs = prop.summary.hardware.numCpuPkgs
-    cpuModel = prop.summary.hardware.cpuModel
-    numHBAs = prop.summary.hardware.numHBAs
-    numNics = prop.summary.hardware.numNics
-    cpuMhz = prop.summary.hardware.cpuMhz
-    memorySize = prop.hardware.memorySize
-    vendor = prop.summary.hardware.vendor
-    model = prop.summary.hardware.model
-    interfaces = get_interfaces(prop)
-    datastores = get_datastores(server)
+    if snapshot is None:
+        snapshot = get_host_snapshot(server)
+
+    name = snapshot.get('name')
+    summary = snapshot.get('summary')
+    overallMemoryUsage = summary.quickStats.overallMemoryUsage
+    overallCpuUsage = summary.quickStats.overallCpuUsage
+    numCpuThreads = summary.hardware.numCpuThreads
+    productName = summary.config.product.name
+    productVersion = summary.config.product.version
+    numCpuCores = summary.hardware.numCpuCores
+    numCpuPkgs = summary.hardware.numCpuPkgs
+    cpuModel = summary.hardware.cpuModel
+    numHBAs = summary.hardware.numHBAs
+    numNics = summary.hardware.numNics
+    cpuMhz = summary.hardware.cpuMhz
+    memorySize = summary.hardware.memorySize
+    vendor = summary.hardware.vendor
+    model = summary.hardware.model
+    interfaces = get_interfaces(snapshot.get('network'))
+    datastores = get_datastores(server, snapshot)
 
     return {
         'name': name,
@@ -230,7 +466,7 @@ def get_hardware(server):
     }
 
 
-def create_hypervisor(hypervisor, datacenter, note=''):
+def create_hypervisor(hypervisor, datacenter, note='', save=True):
     """Create an Hypervisor object from get_hardware and a datacenter"""
     h = Hypervisor()
     h.name = hypervisor.get('name')
@@ -248,24 +484,35 @@ def create_hypervisor(hypervisor, datacenter, note=''):
     h.annotation = note
     h.datacenter = datacenter
 
-    h.clean()
-    h.save()
+    if save:
+        set_datacenter(h)
+        h.clean()
+        h.save()
     return h
 
 
-def create_datastore(datastore, hypervisor):
-    """ Create a Datastore object from get_datastores and Hypervisor object"""
+def create_datastore(datastore, hypervisor, save=True):
+    """ Create a Datastore object from get_datastores and Hypervisor object,
+    when saved the Datastore of the same url is updated if it exists and
+    mounted on the hypervisor"""
     d = Datastore()
     d.name = datastore.get('name')
+    d.url = get_datastore_url(datastore, hypervisor)
     d.capacity = datastore.get('capacity')
-    d.hypervisor_id = hypervisor.id
 
-    d.clean()
-    d.save()
+    if save:
+        existing = Datastore.objects.filter(url=d.url)
+        if existing:
+            update_object(existing[0], d)
+            d = existing[0]
+        else:
+            d.clean()
+            d.save()
+        d.hypervisors.add(hypervisor)
     return d
 
 
-def create_guest(guest, hypervisor):
+def create_guest(guest, hypervisor, save=True):
     """Create Guest object from get_guests and Hypervisor object"""
     g = Guest()
     g.name = guest.get('name')
@@ -277,12 +524,14 @@ def create_guest(guest, hypervisor):
     g.osVersion = guest.get('osVersion')
     g.hypervisor = hypervisor
 
-    g.clean()
-    g.save()
+    if save:
+        set_resource_pools([g], hypervisor.datacenter)
+        g.clean()
+        g.save()
     return g
 
 
-def create_disk(disk, datastore, guest):
+def create_disk(disk, datastore, guest, save=True):
     """Create a Disk object from get_disks, Datastore and Guest objects"""
     d = Disk()
     d.name = disk.get('name')
@@ -292,35 +541,38 @@ def create_disk(disk, datastore, guest):
     if not d.raw:
         d.datastore = datastore
 
-    d.clean()
-    d.save()
+    if save:
+        d.clean()
+        d.save()
     return d
 
 
-def create_vswitch(vswitch, hypervisor):
+def create_vswitch(vswitch, hypervisor, save=True):
     """Create a Vswitch object from get_vswitch"""
     v = Vswitch()
     v.name = vswitch.get('name')
     v.hypervisor = hypervisor
 
-    v.clean()
-    v.save()
+    if save:
+        v.clean()
+        v.save()
     return v
 
 
-def create_network(network, vswitch):
+def create_network(network, vswitch, save=True):
     """Create a Network object from get_networks and a vswitch object"""
     n = Network()
     n.name = network.get('name')
     n.vlanId = network.get('vlanId')
     n.vswitch = vswitch
 
-    n.clean()
-    n.save()
+    if save:
+        n.clean()
+        n.save()
     return n
 
 
-def create_interface(interface, hypervisor, vswitch=None):
+def create_interface(interface, hypervisor, vswitch=None, save=True):
     """Create an Interface object from get_interfaces,
     an Hypervisor and Vswitch objects"""
     i = Interface()
@@ -332,12 +584,13 @@ def create_interface(interface, hypervisor, vswitch=None):
         i.vswitch = vswitch
     i.hypervisor = hypervisor
 
-    i.clean()
-    i.save()
+    if save:
+        i.clean()
+        i.save()
     return i
 
 
-def create_vnic(vnic, guest, network):
+def create_vnic(vnic, guest, network, save=True):
     """Create a VirtualNic object from get_vnics, an Guest
     and a Network object"""
     v = VirtualNic()
@@ -347,71 +600,627 @@ def create_vnic(vnic, guest, network):
     v.guest = guest
     v.network = network
 
-    v.clean()
-    v.save()
+    if save:
+        v.clean()
+        v.save()
     return v
 
 
 def create_full_hypervisor(server, datacenter, note):
     """Create a full hypervisor with Hardware, interface, network,
     guetst, ..."""
-    HARDWARE = get_hardware(server)
+    snapshot = get_host_snapshot(server)
+    HARDWARE = get_hardware(server, snapshot)
     hypervisor = create_hypervisor(HARDWARE, datacenter, note)
 
-    DATASTORES = HARDWARE.get('datastores')
-    for ds in DATASTORES:
-        create_datastore(ds, hypervisor)
+    rows, datastores = sync_datastores(hypervisor, HARDWARE.get('datastores'))
 
-    NETWORKS = get_networks(server)
-    VSWITCHS = get_vswitch(server)
+    NETWORKS = get_networks(server, snapshot)
+    VSWITCHS = get_vswitch(server, snapshot)
+    vswitchs = {}
     for vswitch in VSWITCHS:
-        create_vswitch(vswitch, hypervisor)
+        vswitchs[vswitch.get('name')] = create_vswitch(vswitch, hypervisor)
+    networks = {}
     for network in NETWORKS:
-        n_vswitchName = network.get('vswitchName')
-        n_vswitch = Vswitch.objects.get(name=n_vswitchName,
-                                        hypervisor=hypervisor)
-        create_network(network, n_vswitch)
-
-    INTERFACES = HARDWARE.get('interfaces')
-    for interface in INTERFACES:
-        i_vs_name = ''
-        i_name = interface.get('name')
-        for x in VSWITCHS:
-            if i_name in x.get('nicDevice'):
-                i_vs_name = x.get('name')
-        try:
-            n_vswitch = Vswitch.objects.get(name=i_vs_name,
-                                            hypervisor=hypervisor)
-        except:
-            create_interface(interface, hypervisor)
-        else:
-            create_interface(interface, hypervisor, n_vswitch)
+        n_vswitch = vswitchs[network.get('vswitchName')]
+        networks[network.get('name')] = create_network(network, n_vswitch)
+
+    nic_vswitch = get_nic_vswitch(VSWITCHS, vswitchs)
+    for interface in HARDWARE.get('interfaces'):
+        create_interface(interface, hypervisor,
+                         nic_vswitch.get(interface.get('name')))
 
     GUESTS = get_guests(server)
     for guest in GUESTS:
         g = create_guest(guest, hypervisor)
 
-        DISKS = guest.get('disks')
-        for disk in DISKS:
-            disk_name = disk.get('filename')
-            m = re.search(r"\[([A-Za-z0-9_]+)\]", disk_name)
-            try:
-                disk_ds_name = m.group(1)
-                disk_ds = Datastore.objects.get(name=disk_ds_name,
-                                                hypervisor=hypervisor)
+        for disk in guest.get('disks'):
+            disk_ds_name = get_datastore_name(disk.get('filename'))
+            disk_ds = datastores.get(disk_ds_name)
+            if disk_ds:
                 create_disk(disk, disk_ds, g)
-            except:
-                pass
 
-        VNICS = guest.get('vnics')
-        for vnic in VNICS:
-            vnic_net_name = vnic.get('network')
-            try:
-                vnic_net = Network.objects.get(name=vnic_net_name,
-                                               vswitch__hypervisor=hypervisor)
+        for vnic in guest.get('vnics'):
+            vnic_net = networks.get(vnic.get('network'))
+            if vnic_net:
                 create_vnic(vnic, g, vnic_net)
-            except:
-                pass
+
+    touched = set([hypervisor.id])
+    if rows[1]:
+        touched.update(get_sharing_hypervisors(datastores.values()))
+    update_capacity(list(touched))
+    update_datacenters()
+    record_samples(list(touched))
+
+
+def get_datastore_url(datastore, hypervisor):
+    """Return the url of a datastore dict from get_datastores. Inventories
+    recorded without url get one made of the hypervisor and datastore names,
+    so their datastores are not shared"""
+    return datastore.get('url') or '%s:%s' % (hypervisor.name,
+                                              datastore.get('name'))
+
+
+def sync_datastores(hypervisor, datastores):
+    """Insert or update the shared Datastore rows of a list of datastore
+    dict from get_datastores, then mount exactly these datastores on the
+    hypervisor. The datastores left without any hypervisor are deleted.
+    Return a (created, updated, deleted) tuple and a dict of the Datastore
+    objects of the hypervisor indexed by name"""
+    wanted = dict((get_datastore_url(ds, hypervisor),
+                   create_datastore(ds, hypervisor, save=False))
+                  for ds in datastores)
+    existing = dict((ds.url, ds) for ds in
+                    Datastore.objects.filter(url__in=wanted.keys()))
+    created, updated, deleted = sync_objects(Datastore, existing, wanted)
+    mounted = dict((ds.id, ds) for ds in
+                   Datastore.objects.filter(url__in=wanted.keys()))
+
+    Mount = Datastore.hypervisors.through
+    current = set(Mount.objects.filter(hypervisor=hypervisor).values_list(
+        'datastore', flat=True))
+    unmounted = list(current - set(mounted))
+    if unmounted:
+        Mount.objects.filter(hypervisor=hypervisor,
+                             datastore__in=unmounted).delete()
+        orphans = Datastore.objects.filter(id__in=unmounted,
+                                           hypervisors=None)
+        deleted = orphans.count()
+        orphans.delete()
+    Mount.objects.bulk_create([Mount(hypervisor=hypervisor, datastore_id=i)
+                               for i in set(mounted) - current])
+
+    return ((created, updated, deleted),
+            dict((ds.name, ds) for ds in mounted.values()))
+
+
+def get_sharing_hypervisors(datastores):
+    """Return the set of id of the hypervisors mounting one of a list of
+    Datastore objects"""
+    Mount = Datastore.hypervisors.through
+    return set(Mount.objects.filter(datastore__in=datastores).values_list(
+        'hypervisor', flat=True))
+
+
+def get_datastore_name(filename):
+    """Return the datastore name of a disk filename "[datastore] vm/vm.vmdk"
+    or None, the name may contain spaces, dots or any character but ]"""
+    m = re.match(r"\s*\[([^\]]+)\]", filename or '')
+    if m:
+        return m.group(1)
+    return None
+
+
+def get_nic_vswitch(vswitch_list, vswitchs):
+    """Return a dict of Vswitch object indexed by physical nic name, from
+    get_vswitch and a dict of Vswitch object indexed by name"""
+    ret_val = {}
+    for x in vswitch_list:
+        for nic in x.get('nicDevice'):
+            ret_val[nic] = vswitchs.get(x.get('name'))
+    return ret_val
+
+
+def chunks(l, size=500):
+    """Yield successive slices of a list, to keep IN clauses small"""
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+
+def bulk_save(model, objects):
+    """Clean a list of unsaved objects, then insert them with bulk_create,
+    return the number of rows"""
+    for o in objects:
+        o.clean()
+    model.objects.bulk_create(objects)
+    return len(objects)
+
+
+def set_datacenter(hypervisor):
+    """Link an Hypervisor object to the Datacenter of its datacenter name,
+    return True if the Datacenter row was created"""
+    hypervisor.dc, created = Datacenter.objects.get_or_create(
+        name=hypervisor.datacenter)
+    return created
+
+
+def set_resource_pools(guests, datacenter):
+    """Link a list of Guest objects to the ResourcePool of their resourcePool
+    name in datacenter, the missing ResourcePool rows are created. Return
+    the number of rows created"""
+    names = set(g.resourcePool for g in guests)
+    pools = dict((p.name, p) for p in ResourcePool.objects.filter(
+        datacenter=datacenter, name__in=names))
+    created = bulk_save(ResourcePool, [
+        ResourcePool(name=name, datacenter=datacenter)
+        for name in names if name not in pools])
+    if created:
+        pools = dict((p.name, p) for p in ResourcePool.objects.filter(
+            datacenter=datacenter, name__in=names))
+    for g in guests:
+        g.pool = pools[g.resourcePool]
+    return created
+
+
+def delete_empty_resource_pools():
+    """Delete the ResourcePool rows without guest, return their number"""
+    empty = ResourcePool.objects.filter(guest=None)
+    deleted = empty.count()
+    if deleted:
+        empty.delete()
+    return deleted
+
+
+def check_unique_names(hypervisor, guests):
+    """Raise a ValidationError if the hypervisor or one of the guests
+    already exists"""
+    if Hypervisor.objects.filter(name=hypervisor.name).exists():
+        raise ValidationError('Hypervisor %s already exists' % hypervisor.name)
+
+    names = [g.name for g in guests]
+    if len(set(names)) != len(names):
+        raise ValidationError('Duplicate guest names on %s' % hypervisor.name)
+    for chunk in chunks(names):
+        existing = Guest.objects.filter(name__in=chunk)
+        existing = existing.values_list('name', flat=True)
+        if existing:
+            raise ValidationError('Guests already exist: %s'
+                                  % ', '.join(existing))
+
+
+def get_inventory(server, metrics=None):
+    """Return a dict with keys hardware, networks, vswitchs, guests"""
+    if metrics is None:
+        metrics = ImportMetrics(None)
+    metrics.server = server
+
+    with metrics.phase('hardware'):
+        snapshot = get_host_snapshot(server)
+        hardware = get_hardware(server, snapshot)
+    with metrics.phase('networks'):
+        networks = get_networks(server, snapshot)
+        vswitchs = get_vswitch(server, snapshot)
+    with metrics.phase('guests'):
+        guests = get_guests(server)
+
+    return {'hardware': hardware,
+            'networks': networks,
+            'vswitchs': vswitchs,
+            'guests': guests}
+
+
+def get_vcenter_inventories(server, metrics=None):
+    """Return a list of (datacenter, inventory) tuple, one per HostSystem of
+    a vCenter, the hosts, datastores and guests of every host are fetched
+    at once over the same session"""
+    if metrics is None:
+        metrics = ImportMetrics(None)
+    metrics.server = server
+
+    with metrics.phase('hardware'):
+        snapshots = get_host_snapshots(server)
+        datacenters = get_host_datacenters(server)
+    with metrics.phase('guests'):
+        guests = get_guests_by_host(server)
+
+    ret_val = []
+    for snapshot in snapshots:
+        mor = str(snapshot.get('mor'))
+        inventory = {'hardware': get_hardware(server, snapshot),
+                     'networks': get_networks(server, snapshot),
+                     'vswitchs': get_vswitch(server, snapshot),
+                     'guests': guests.get(mor, [])}
+        ret_val.append((datacenters.get(mor, ''), inventory))
+
+    return ret_val
+
+
+def bulk_create_full_hypervisor(server, datacenter, note):
+    """Create a full hypervisor with bulk_create_hypervisor"""
+    return bulk_create_hypervisor(get_inventory(server), datacenter, note)
+
+
+def bulk_create_hypervisor(inventory, datacenter, note, metrics=None):
+    """Create a full hypervisor from get_inventory like
+    create_full_hypervisor, but build the rows in memory and write them with
+    bulk_create, one batch per model, in a single transaction"""
+    HARDWARE = inventory.get('hardware')
+    NETWORKS = inventory.get('networks')
+    VSWITCHS = inventory.get('vswitchs')
+    GUESTS = inventory.get('guests')
+    if metrics is None:
+        metrics = ImportMetrics(HARDWARE.get('name'))
+
+    with metrics.phase('validate'):
+        hypervisor = create_hypervisor(HARDWARE, datacenter, note, save=False)
+        guests = [create_guest(guest, hypervisor, save=False)
+                  for guest in GUESTS]
+        hypervisor.clean()
+        check_unique_names(hypervisor, guests)
+
+    with transaction.atomic():
+        with metrics.phase('write Hypervisor') as phase:
+            phase['rows'] = int(set_datacenter(hypervisor))
+            hypervisor.save()
+            phase['rows'] += 1
+
+        with metrics.phase('write Datastore') as phase:
+            # shared datastores may already exist with another hypervisor
+            rows, datastores = sync_datastores(hypervisor,
+                                               HARDWARE.get('datastores'))
+            phase['rows'] = sum(rows)
+            touched = set([hypervisor.id])
+            if rows[1]:
+                # the capacity shows on every hypervisor sharing them
+                touched.update(get_sharing_hypervisors(datastores.values()))
+
+        with metrics.phase('write Vswitch') as phase:
+            phase['rows'] = bulk_save(Vswitch, [
+                create_vswitch(vswitch, hypervisor, save=False)
+                for vswitch in VSWITCHS])
+            vswitchs = dict((v.name, v) for v in
+                            Vswitch.objects.filter(hypervisor=hypervisor))
+
+        with metrics.phase('write Network') as phase:
+            networks = []
+            for network in NETWORKS:
+                n_vswitch = vswitchs[network.get('vswitchName')]
+                networks.append(create_network(network, n_vswitch,
+                                               save=False))
+            phase['rows'] = bulk_save(Network, networks)
+            networks = dict((n.name, n) for n in Network.objects.filter(
+                vswitch__hypervisor=hypervisor))
+
+        with metrics.phase('write Interface') as phase:
+            nic_vswitch = get_nic_vswitch(VSWITCHS, vswitchs)
+            interfaces = []
+            for interface in HARDWARE.get('interfaces'):
+                i_vswitch = nic_vswitch.get(interface.get('name'))
+                interfaces.append(create_interface(interface, hypervisor,
+                                                   i_vswitch, save=False))
+            phase['rows'] = bulk_save(Interface, interfaces)
+
+        with metrics.phase('write Guest') as phase:
+            # guests were built before the hypervisor had an id
+            for g in guests:
+                g.hypervisor = hypervisor
+            phase['rows'] = set_resource_pools(guests,
+                                               hypervisor.datacenter)
+            phase['rows'] += bulk_save(Guest, guests)
+            guests = dict((g.name, g) for g in
+                          Guest.objects.filter(hypervisor=hypervisor))
+
+        disks = []
+        vnics = []
+        for guest in GUESTS:
+            g = guests[guest.get('name')]
+            for disk in guest.get('disks'):
+                disk_ds_name = get_datastore_name(disk.get('filename'))
+                disk_ds = datastores.get(disk_ds_name)
+                if disk_ds:
+                    disks.append(create_disk(disk, disk_ds, g, save=False))
+            for vnic in guest.get('vnics'):
+                vnic_net = networks.get(vnic.get('network'))
+                if vnic_net:
+                    vnics.append(create_vnic(vnic, g, vnic_net, save=False))
+        with metrics.phase('write Disk') as phase:
+            phase['rows'] = bulk_save(Disk, disks)
+        with metrics.phase('write VirtualNic') as phase:
+            phase['rows'] = bulk_save(VirtualNic, vnics)
+        with metrics.phase('write capacity') as phase:
+            phase['rows'] = update_capacity(list(touched))
+            phase['rows'] += update_datacenters()
+        with metrics.phase('write samples') as phase:
+            phase['rows'] = record_samples(list(touched))
+
+    return hypervisor
+
+
+def update_object(obj, new):
+    """Copy the fields of new which differ into obj and save only these
+    fields, return True if obj changed. Fields which are not editable, like
+    the capacity rollups, are left alone"""
+    changed = [f.attname for f in obj._meta.fields
+               if not f.primary_key and f.editable and
+               getattr(obj, f.attname) != getattr(new, f.attname)]
+    if not changed:
+        return False
+    for attname in changed:
+        setattr(obj, attname, getattr(new, attname))
+    obj.clean()
+    obj.save(update_fields=changed)
+    return True
+
+
+def sync_objects(model, existing, wanted):
+    """Diff wanted unsaved objects against existing saved objects, both dict
+    indexed by the same key, then insert, update or delete only the rows
+    which changed. Return a (created, updated, deleted) tuple"""
+    created = [o for k, o in wanted.items() if k not in existing]
+    updated = len([k for k, o in wanted.items()
+                   if k in existing and update_object(existing[k], o)])
+    deleted = [o.id for k, o in existing.items() if k not in wanted]
+    for chunk in chunks(deleted):
+        model.objects.filter(id__in=chunk).delete()
+    bulk_save(model, created)
+    return (len(created), updated, len(deleted))
+
+
+def sync_full_hypervisor(server, datacenter, note):
+    """Synchronize a full hypervisor with sync_hypervisor"""
+    return sync_hypervisor(get_inventory(server), datacenter, note)
+
+
+def sync_hypervisor(inventory, datacenter, note, metrics=None):
+    """Synchronize an existing hypervisor with its inventory from
+    get_inventory, only the rows which differ from the database are
+    inserted, updated or deleted. Guests found on another hypervisor are
+    moved to this one, and the capacity rollups of both hypervisors are
+    recomputed. Return a dict of (created, updated, deleted) tuple indexed
+    by model name"""
+    HARDWARE = inventory.get('hardware')
+    NETWORKS = inventory.get('networks')
+    VSWITCHS = inventory.get('vswitchs')
+    GUESTS = inventory.get('guests')
+    if metrics is None:
+        metrics = ImportMetrics(HARDWARE.get('name'))
+    stats = {}
+
+    with transaction.atomic():
+        with metrics.phase('write Hypervisor') as phase:
+            new = create_hypervisor(HARDWARE, datacenter, note, save=False)
+            set_datacenter(new)
+            try:
+                hypervisor = Hypervisor.objects.get(name=new.name)
+            except Hypervisor.DoesNotExist:
+                hypervisor = new
+                hypervisor.clean()
+                hypervisor.save()
+                stats['Hypervisor'] = (1, 0, 0)
+            else:
+                if not note:
+                    new.annotation = hypervisor.annotation
+                new.id = hypervisor.id
+                stats['Hypervisor'] = (0, int(update_object(hypervisor, new)),
+                                       0)
+            phase['rows'] = sum(stats['Hypervisor'])
+
+        with metrics.phase('write Datastore') as phase:
+            # the datastores unmounted still need their rollups recomputed
+            unmounted = set(Datastore.objects.filter(
+                hypervisors=hypervisor).values_list('id', flat=True))
+            stats['Datastore'], datastores = sync_datastores(
+                hypervisor, HARDWARE.get('datastores'))
+            unmounted -= set(ds.id for ds in datastores.values())
+            phase['rows'] = sum(stats['Datastore'])
+            touched = set([hypervisor.id])
+            if stats['Datastore'][1]:
+                # the capacity shows on every hypervisor sharing them
+                touched.update(get_sharing_hypervisors(datastores.values()))
+
+        with metrics.phase('write Vswitch') as phase:
+            existing = dict((v.name, v) for v in
+                            Vswitch.objects.filter(hypervisor=hypervisor))
+            wanted = dict((v.get('name'),
+                           create_vswitch(v, hypervisor, save=False))
+                          for v in VSWITCHS)
+            stats['Vswitch'] = sync_objects(Vswitch, existing, wanted)
+            vswitchs = dict((v.name, v) for v in
+                            Vswitch.objects.filter(hypervisor=hypervisor))
+            phase['rows'] = sum(stats['Vswitch'])
+
+        with metrics.phase('write Network') as phase:
+            existing = dict((n.name, n) for n in Network.objects.filter(
+                vswitch__hypervisor=hypervisor))
+            wanted = {}
+            for network in NETWORKS:
+                n_vswitch = vswitchs[network.get('vswitchName')]
+                wanted[network.get('name')] = create_network(
+                    network, n_vswitch, save=False)
+            stats['Network'] = sync_objects(Network, existing, wanted)
+            networks = dict((n.name, n) for n in Network.objects.filter(
+                vswitch__hypervisor=hypervisor))
+            phase['rows'] = sum(stats['Network'])
+
+        with metrics.phase('write Interface') as phase:
+            nic_vswitch = get_nic_vswitch(VSWITCHS, vswitchs)
+            existing = dict((i.name, i) for i in
+                            Interface.objects.filter(hypervisor=hypervisor))
+            wanted = {}
+            for interface in HARDWARE.get('interfaces'):
+                i_vswitch = nic_vswitch.get(interface.get('name'))
+                wanted[interface.get('name')] = create_interface(
+                    interface, hypervisor, i_vswitch, save=False)
+            stats['Interface'] = sync_objects(Interface, existing, wanted)
+            phase['rows'] = sum(stats['Interface'])
+
+        with metrics.phase('write Guest') as phase:
+            # guests may have been moved from another hypervisor
+            existing = dict((g.name, g) for g in
+                            Guest.objects.filter(hypervisor=hypervisor))
+            names = [guest.get('name') for guest in GUESTS]
+            for chunk in chunks(names):
+                existing.update((g.name, g) for g in
+                                Guest.objects.filter(name__in=chunk))
+            wanted = dict((guest.get('name'),
+                           create_guest(guest, hypervisor, save=False))
+                          for guest in GUESTS)
+            touched.update(g.hypervisor_id for g in existing.values())
+            created = set_resource_pools(wanted.values(),
+                                         hypervisor.datacenter)
+            stats['Guest'] = sync_objects(Guest, existing, wanted)
+            stats['ResourcePool'] = (created, 0,
+                                     delete_empty_resource_pools())
+            guests = dict((g.name, g) for g in
+                          Guest.objects.filter(hypervisor=hypervisor))
+            phase['rows'] = sum(stats['Guest']) + sum(stats['ResourcePool'])
+
+        disks = {}
+        vnics = {}
+        for guest in GUESTS:
+            g = guests[guest.get('name')]
+            for disk in guest.get('disks'):
+                disk_ds_name = get_datastore_name(disk.get('filename'))
+                disk_ds = datastores.get(disk_ds_name)
+                if disk_ds:
+                    disks[(g.name, disk.get('name'))] = create_disk(
+                        disk, disk_ds, g, save=False)
+            for vnic in guest.get('vnics'):
+                vnic_net = networks.get(vnic.get('network'))
+                if vnic_net:
+                    vnics[(g.name, vnic.get('name'))] = create_vnic(
+                        vnic, g, vnic_net, save=False)
+
+        with metrics.phase('write Disk') as phase:
+            existing = dict(((d.guest.name, d.name), d) for d in
+                            Disk.objects.filter(guest__hypervisor=hypervisor)
+                            .select_related('guest'))
+            stats['Disk'] = sync_objects(Disk, existing, disks)
+            phase['rows'] = sum(stats['Disk'])
+
+        with metrics.phase('write VirtualNic') as phase:
+            existing = dict(((v.guest.name, v.name), v) for v in
+                            VirtualNic.objects.filter(
+                                guest__hypervisor=hypervisor)
+                            .select_related('guest'))
+            stats['VirtualNic'] = sync_objects(VirtualNic, existing, vnics)
+            phase['rows'] = sum(stats['VirtualNic'])
+
+        with metrics.phase('write capacity') as phase:
+            phase['rows'] = update_capacity(list(touched), list(unmounted))
+            phase['rows'] += update_datacenters()
+
+        with metrics.phase('write samples') as phase:
+            phase['rows'] = record_samples(list(touched))
+
+    return stats
+
+
+def collect_inventory(host, user, password, timeout=None, metrics=None):
+    """Connect to a host and return its inventory from get_inventory"""
+    if metrics is None:
+        metrics = ImportMetrics(host)
+    with metrics.phase('connect'):
+        server = vmware_connect(host, user, password, timeout, metrics)
+    try:
+        return get_inventory(server, metrics)
+    finally:
+        server.disconnect()
+
+
+def dump_inventory(f, inventory, datacenter):
+    """Write an inventory from get_inventory to an open file as JSON lines,
+    one hypervisor record followed by one record per guest"""
+    record = {'type': 'hypervisor',
+              'datacenter': datacenter,
+              'hardware': inventory.get('hardware'),
+              'networks': inventory.get('networks'),
+              'vswitchs': inventory.get('vswitchs')}
+    f.write(json.dumps(record) + '\n')
+    for guest in inventory.get('guests'):
+        f.write(json.dumps({'type': 'guest', 'guest': guest}) + '\n')
+
+
+def load_inventories(filename):
+    """Yield a (datacenter, inventory) tuple per hypervisor from a gzip file
+    written by dump_inventory, only one hypervisor is held in memory"""
+    datacenter = inventory = None
+    for line in gzip.open(filename, 'rb'):
+        record = json.loads(line)
+        if record.get('type') == 'hypervisor':
+            if inventory:
+                yield datacenter, inventory
+            datacenter = record.get('datacenter')
+            inventory = {'hardware': record.get('hardware'),
+                         'networks': record.get('networks'),
+                         'vswitchs': record.get('vswitchs'),
+                         'guests': []}
+        elif record.get('type') == 'guest':
+            inventory['guests'].append(record.get('guest'))
+    if inventory:
+        yield datacenter, inventory
+
+
+def read_hosts_file(filename):
+    """Return a list of (hostname, datacenter, user) tuple from a file with
+    one "hostname datacenter [user]" line per host"""
+    ret_val = []
+    for line in open(filename):
+        line = line.split('#')[0].split()
+        if not line:
+            continue
+        if len(line) < 2:
+            raise ValueError('"%s" has no datacenter' % line[0])
+        user = line[2] if len(line) > 2 else None
+        ret_val.append((line[0], line[1], user))
+    return ret_val
+
+
+def import_hypervisors(hosts, write, workers=8, timeout=600):
+    """Collect the inventory of hosts, a list of (hostname, datacenter, user,
+    password) tuple, on a pool of workers threads and write each one with
+    write(inventory, datacenter, metrics) from the calling thread as they
+    come. A host which takes more than timeout seconds is given up.
+    Return the list of ImportMetrics of the hosts. Each worker measures
+    its phases in its own ImportMetrics, merged once the inventory is
+    back, so a worker given up cannot add to the report"""
+    started = {}
+    metrics = dict((host[0], ImportMetrics(host[0])) for host in hosts)
+    worker_metrics = dict((host[0], ImportMetrics(host[0]))
+                          for host in hosts)
+
+    def collect(host, user, password):
+        started[host] = time.time()
+        return collect_inventory(host, user, password, timeout,
+                                 worker_metrics[host])
+
+    pool = ThreadPool(workers)
+    results = [(host, datacenter,
+                pool.apply_async(collect, (host, user, password)))
+               for host, datacenter, user, password in hosts]
+    pool.close()
+
+    ret_val = []
+    for host, datacenter, result in results:
+        while not result.ready():
+            result.wait(1)
+            if host in started and time.time() - started[host] > timeout:
+                break
+        try:
+            if not result.ready():
+                raise RuntimeError('timeout after %s seconds' % timeout)
+            try:
+                inventory = result.get()
+            finally:
+                metrics[host].phases.extend(worker_metrics[host].phases)
+            write(inventory, datacenter, metrics[host])
+        except Exception, e:
+            metrics[host].success = False
+            metrics[host].error = str(e) or e.__class__.__name__
+        ret_val.append(metrics[host])
+
+    pool.terminate()
+    return ret_val
 
 
 if __name__ == '__main__':
@@ -421,6 +1230,19 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-H', '--hostname',
                       help='Host name, IP Address - mandatory')
+    parser.add_option('-f', '--hosts-file', dest='hosts_file',
+                      help='File of "hostname datacenter [user]" lines, the '
+                           'hosts are imported in parallel with -b or -s')
+    parser.add_option('-w', '--workers', type='int', default=8,
+                      help='Hosts collected in parallel with -f '
+                           '[default: %default]')
+    parser.add_option('-t', '--timeout', type='int', default=600,
+                      help='Seconds before giving up a host with -f '
+                           '[default: %default]')
+    parser.add_option('-V', '--vcenter', action='store_true', default=False,
+                      help='The host is a vCenter, import all its hosts '
+                           'with their datacenter over one session, with -b '
+                           'or -s [default: %default]')
     parser.add_option('-u', '--user', default='root',
                       help='User name [default: %default]')
     parser.add_option('-d', '--datacenter', default='',
@@ -429,10 +1251,33 @@ if __name__ == '__main__':
                       help='Password to connect [default: %default]')
     parser.add_option('-a', '--anotation', type='string', default='',
                       help='Hypervisor Note [default: %default]')
+    parser.add_option('-b', '--bulk', action='store_true', default=False,
+                      help='Write the hypervisor with bulk inserts in a '
+                           'single transaction [default: %default]')
+    parser.add_option('-s', '--sync', action='store_true', default=False,
+                      help='Update an existing hypervisor, only the rows '
+                           'which changed are written [default: %default]')
+    parser.add_option('-o', '--dump',
+                      help='Write the inventory to a gzip JSON lines file '
+                           'instead of the database')
+    parser.add_option('-l', '--load',
+                      help='Import the hypervisors of a file written with -o, '
+                           'without connecting to any host')
+    parser.add_option('-m', '--metrics',
+                      help='Write the timings and counters of each import '
+                           'phase to a Prometheus textfile')
+    parser.add_option('-r', '--rebuild', action='store_true', default=False,
+                      help='Only rebuild the datacenters, resource pools '
+                           'and capacity rollups of the hypervisors already '
+                           'imported [default: %default]')
 
     (options, args) = parser.parse_args()
 
     mandatories = ['hostname', 'datacenter']
+    if options.vcenter:
+        mandatories = ['hostname']
+    if options.hosts_file or options.load or options.rebuild:
+        mandatories = []
 
     for m in mandatories:
         if getattr(options, m) is None:
@@ -440,6 +1285,16 @@ if __name__ == '__main__':
             parser.print_help()
             exit(-1)
 
+    if options.rebuild:
+        with transaction.atomic():
+            print '%d hypervisors linked to their datacenter' % (
+                update_datacenter_links())
+            print '%d guests linked to their resource pool' % (
+                update_resource_pools())
+            print '%d rows updated' % (update_capacity() +
+                                       update_datacenters())
+        exit(0)
+
     try:
         password = Config.get(options.user, 'password')
     except:
@@ -447,7 +1302,7 @@ if __name__ == '__main__':
 
     if getattr(options, 'password'):
         password = options.password
-    if not password:
+    if not password and not (options.hosts_file or options.load):
         print '"password" option is missing'
         exit(-1)
 
@@ -456,11 +1311,97 @@ if __name__ == '__main__':
     datacenter = options.datacenter
     note = options.anotation
 
-    try:
-        server = vmware_connect(hostname, user, password)
-    except:
-        exit(1)
-
-    create_full_hypervisor(server, datacenter, note)
+    if options.sync:
+        write = lambda inventory, dc, metrics: sync_hypervisor(
+            inventory, dc, note, metrics)
+    else:
+        write = lambda inventory, dc, metrics: bulk_create_hypervisor(
+            inventory, dc, note, metrics)
+    if options.dump:
+        dump_file = gzip.open(options.dump, 'wb')
+
+        def write(inventory, dc, metrics):
+            with metrics.phase('dump'):
+                dump_inventory(dump_file, inventory, dc)
+
+    if options.load:
+        summary = []
+        for dc, inventory in load_inventories(options.load):
+            metrics = ImportMetrics(inventory.get('hardware').get('name'))
+            try:
+                write(inventory, datacenter or dc, metrics)
+            except Exception, e:
+                metrics.success = False
+                metrics.error = str(e) or e.__class__.__name__
+            summary.append(metrics)
+            print json.dumps(metrics.summary())
+
+    elif options.vcenter:
+        metrics = ImportMetrics(hostname)
+        try:
+            with metrics.phase('connect'):
+                server = vmware_connect(hostname, user, password,
+                                        metrics=metrics)
+        except:
+            exit(1)
+        inventories = get_vcenter_inventories(server, metrics)
+        server.disconnect()
+        print json.dumps(metrics.summary())
+
+        summary = []
+        for dc, inventory in inventories:
+            host_metrics = ImportMetrics(inventory.get('hardware').get('name'))
+            try:
+                write(inventory, dc, host_metrics)
+            except Exception, e:
+                host_metrics.success = False
+                host_metrics.error = str(e) or e.__class__.__name__
+            summary.append(host_metrics)
+            print json.dumps(host_metrics.summary())
+
+    elif options.hosts_file:
+        hosts = []
+        for host, dc, host_user in read_hosts_file(options.hosts_file):
+            try:
+                host_password = Config.get(host_user, 'password')
+            except:
+                host_user, host_password = user, password
+            hosts.append((host, dc, host_user, host_password))
+
+        summary = import_hypervisors(hosts, write, options.workers,
+                                     options.timeout)
+        for metrics in summary:
+            print json.dumps(metrics.summary())
+        for metrics in summary:
+            print '%-6s %-40s %7.1fs %s' % (
+                metrics.success and 'OK' or 'FAILED', metrics.host,
+                metrics.summary().get('seconds'), metrics.error)
+
+    else:
+        metrics = ImportMetrics(hostname)
+        try:
+            with metrics.phase('connect'):
+                server = vmware_connect(hostname, user, password,
+                                        metrics=metrics)
+        except:
+            exit(1)
 
-    server.disconnect()
+        if options.dump or options.sync or options.bulk:
+            write(get_inventory(server, metrics), datacenter, metrics)
+        else:
+            with metrics.phase('create_full_hypervisor'):
+                create_full_hypervisor(server, datacenter, note)
+
+        server.disconnect()
+        summary = [metrics]
+        print json.dumps(metrics.summary())
+
+    if options.dump:
+        dump_file.close()
+    if options.metrics:
+        write_prometheus(options.metrics, summary)
+
+    failed = len([m for m in summary if not m.success])
+    if options.hosts_file or options.vcenter or options.load:
+        print '%d hosts, %d failed' % (len(summary), failed)
+    exit(failed and 1 or 0)
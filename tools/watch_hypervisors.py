@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+from django.db import transaction
+from vsphere.models import VirtualNic
+from vsphere.models import Hypervisor
+from vsphere.models import Datastore
+from vsphere.models import Network
+from vsphere.models import Guest
+from vsphere.models import Disk
+from vsphere.models import update_capacity
+from vsphere.models import update_datacenters
+from vsphere.models import record_samples
+from import_hypervisor import GUEST_PROPERTIES
+from import_hypervisor import get_datastore_name
+from import_hypervisor import vmware_connect
+from import_hypervisor import update_object
+from import_hypervisor import sync_objects
+from import_hypervisor import create_guest
+from import_hypervisor import create_disk
+from import_hypervisor import create_vnic
+from import_hypervisor import VIProperty
+from import_hypervisor import get_guest
+from import_hypervisor import set_resource_pools
+from import_hypervisor import delete_empty_resource_pools
+from import_hypervisor import chunks
+from os.path import expanduser
+from sys import exit
+import ConfigParser
+import json
+import time
+
+try:
+    from pysphere import MORTypes
+    from pysphere.resources import VimService_services as VI
+except ImportError:
+    MORTypes = VI = None
+
+
+HOST_PROPERTIES = [
+    'name',
+    'summary.hardware',
+    'summary.config.product',
+]
+
+WATCHED_PROPERTIES = {
+    'VirtualMachine': GUEST_PROPERTIES,
+    'HostSystem': HOST_PROPERTIES,
+    'ResourcePool': ['name'],
+}
+
+# seconds between two capacity samples of the hypervisors changed by the
+# watcher, the raw tier would otherwise get a sample for every batch
+SAMPLE_INTERVAL = 300
+
+
+class VIPropertyCollector(object):
+    """Incremental PropertyCollector of a pysphere VIServer session, over a
+    ContainerView of the whole inventory.
+
+    wait_for_updates returns a (version, truncated, updates) tuple where
+    updates is a list of (kind, type, mor, changes) tuple and changes a list
+    of (op, name, val) tuple, which is all the watcher needs, so a stub with
+    the same two methods can stand for a vCenter."""
+
+    def __init__(self, server):
+        self._server = server
+        self._content = server._do_service_content
+        self._filter = None
+
+    def _this(self, request, mor, mor_type):
+        _this = request.new__this(mor)
+        _this.set_attribute_type(mor_type)
+        request.set_element__this(_this)
+
+    def create_filter(self, properties):
+        """Register a filter on properties, a dict of list of property path
+        indexed by managed object type"""
+        view_manager = self._content.ViewManager
+        request = VI.CreateContainerViewRequestMsg()
+        self._this(request, view_manager, view_manager.get_attribute_type())
+        container = request.new_container(self._content.RootFolder)
+        container.set_attribute_type(
+            self._content.RootFolder.get_attribute_type())
+        request.set_element_container(container)
+        request.set_element_type(properties.keys())
+        request.set_element_recursive(True)
+        view = self._server._proxy.CreateContainerView(request)._returnval
+
+        request = VI.CreateFilterRequestMsg()
+        self._this(request, self._content.PropertyCollector,
+                   MORTypes.PropertyCollector)
+        spec = request.new_spec()
+        prop_set = []
+        for obj_type, paths in properties.items():
+            p = spec.new_propSet()
+            p.set_element_type(obj_type)
+            p.set_element_pathSet(paths)
+            prop_set.append(p)
+        spec.set_element_propSet(prop_set)
+
+        obj_set = spec.new_objectSet()
+        obj = obj_set.new_obj(view)
+        obj.set_attribute_type(view.get_attribute_type())
+        obj_set.set_element_obj(obj)
+        obj_set.set_element_skip(True)
+        traversal = VI.ns0.TraversalSpec_Def('traverseView').pyclass()
+        traversal.set_element_name('traverseView')
+        traversal.set_element_type(view.get_attribute_type())
+        traversal.set_element_path('view')
+        traversal.set_element_skip(False)
+        obj_set.set_element_selectSet([traversal])
+        spec.set_element_objectSet([obj_set])
+
+        request.set_element_spec(spec)
+        request.set_element_partialUpdates(False)
+        self._filter = self._server._proxy.CreateFilter(request)._returnval
+
+    def wait_for_updates(self, version, max_wait):
+        """Return the changes since version with WaitForUpdatesEx, waiting
+        at most max_wait seconds"""
+        request = VI.WaitForUpdatesExRequestMsg()
+        self._this(request, self._content.PropertyCollector,
+                   MORTypes.PropertyCollector)
+        request.set_element_version(version)
+        options = request.new_options()
+        options.set_element_maxWaitSeconds(max_wait)
+        request.set_element_options(options)
+        update_set = self._server._proxy.WaitForUpdatesEx(request)._returnval
+        if update_set is None:
+            return version, False, []
+
+        updates = []
+        for filter_update in update_set.FilterSet or []:
+            for object_update in filter_update.ObjectSet or []:
+                changes = [(c.Op, c.Name, c.Val)
+                           for c in object_update.ChangeSet or []]
+                updates.append((object_update.Kind,
+                                object_update.Obj.get_attribute_type(),
+                                str(object_update.Obj), changes))
+        return update_set.Version, bool(update_set.Truncated), updates
+
+    def destroy(self):
+        """Destroy the filter registered by create_filter"""
+        if self._filter is None:
+            return
+        request = VI.DestroyPropertyFilterRequestMsg()
+        self._this(request, self._filter, self._filter.get_attribute_type())
+        self._server._proxy.DestroyPropertyFilter(request)
+        self._filter = None
+
+
+class InventoryWatcher(object):
+    """Keep the Hypervisor, Guest, Disk and VirtualNic rows up to date from
+    the updates of a property collector, only the objects named in an update
+    are written. A guest whose host or resource pool is not known yet is
+    kept pending until one enters. The capacity samples of the changed
+    hypervisors are recorded at most every sample_interval seconds"""
+
+    def __init__(self, collector, server=None,
+                 sample_interval=SAMPLE_INTERVAL):
+        self.collector = collector
+        self.server = server
+        self.sample_interval = sample_interval
+        self.version = ''
+        self.objects = {}
+        self.guest_names = {}
+        self.pending = set()
+        self.touched = set()
+        self.unsampled = set()
+        self.last_sample = None
+
+    def props(self, mor):
+        return self.objects.get(mor, {}).get('props', {})
+
+    def resource_pools(self):
+        return dict((mor, o['props'].get('name'))
+                    for mor, o in self.objects.items()
+                    if o['type'] == 'ResourcePool')
+
+    def update(self, updates):
+        """Merge updates in the known objects, return the sets of changed
+        guest and host MOR and the names of the guests which left. The
+        pending guests are changed again when a host or a pool enters"""
+        guests = set()
+        hosts = set()
+        left = []
+        for kind, obj_type, mor, changes in updates:
+            if kind == 'leave':
+                if obj_type == 'VirtualMachine':
+                    guests.discard(mor)
+                    self.pending.discard(mor)
+                    if mor in self.guest_names:
+                        left.append(self.guest_names.pop(mor))
+                self.objects.pop(mor, None)
+                continue
+
+            obj = self.objects.setdefault(mor, {'type': obj_type,
+                                                'props': {}})
+            for op, name, val in changes:
+                if op in ('remove', 'indirectRemove'):
+                    obj['props'].pop(name, None)
+                else:
+                    obj['props'][name] = val
+
+            if obj_type == 'VirtualMachine':
+                guests.add(mor)
+            elif obj_type == 'HostSystem':
+                hosts.add(mor)
+            if obj_type in ('HostSystem', 'ResourcePool') and \
+                    kind == 'enter':
+                # retry the guests which came before their host or pool
+                guests.update(self.pending)
+            elif obj_type == 'ResourcePool' and kind == 'modify':
+                guests.update(m for m, o in self.objects.items()
+                              if o['type'] == 'VirtualMachine' and
+                              str(o['props'].get('resourcePool')) == mor)
+        return guests, hosts, left
+
+    def apply_host(self, mor):
+        """Update the Hypervisor row of a HostSystem, return the number of
+        rows written"""
+        props = self.props(mor)
+        try:
+            hypervisor = Hypervisor.objects.get(name=props.get('name'))
+        except Hypervisor.DoesNotExist:
+            return 0
+        new = Hypervisor.objects.get(id=hypervisor.id)
+        if props.get('summary.hardware') is not None:
+            hardware = VIProperty(self.server, props.get('summary.hardware'))
+            new.cpuModel = ' '.join(hardware.cpuModel.split())
+            new.numCpuPkgs = hardware.numCpuPkgs
+            new.vendor = hardware.vendor
+            new.model = hardware.model
+            new.numCpuThreads = hardware.numCpuThreads
+            new.memorySize = hardware.memorySize / 1024 / 1024
+            new.numCpuCores = hardware.numCpuCores
+            new.cpuMhz = hardware.cpuMhz
+            new.numHBAs = hardware.numHBAs
+            new.numNics = hardware.numNics
+        if props.get('summary.config.product') is not None:
+            product = VIProperty(self.server,
+                                 props.get('summary.config.product'))
+            new.productName = product.name
+            new.productVersion = product.version
+        return int(update_object(hypervisor, new))
+
+    def host(self, mor):
+        """Return the name of the HostSystem of a VirtualMachine"""
+        return self.props(str(self.props(mor).get('runtime.host'))).get(
+            'name')
+
+    def prefetch(self, mors):
+        """Return the rows the guests of mors need, fetched once for the
+        batch: the Hypervisor and Guest by name, the Datastore and Network
+        by (hypervisor id, name), the Disk and VirtualNic by (guest name,
+        name)"""
+        hypervisors = dict((h.name, h) for h in Hypervisor.objects.all())
+        batch = {'hypervisors': hypervisors,
+                 'resource_pools': self.resource_pools(),
+                 'guests': {}, 'disks': {}, 'vnics': {},
+                 'datastores': {}, 'networks': {}, 'wanted': {}}
+
+        names = set(self.props(mor).get('name', '') for mor in mors)
+        names.update(self.guest_names[mor] for mor in mors
+                     if mor in self.guest_names)
+        for chunk in chunks(list(names)):
+            batch['guests'].update((g.name, g) for g in
+                                   Guest.objects.filter(name__in=chunk))
+            batch['disks'].update(
+                ((d.guest.name, d.name), d) for d in Disk.objects.filter(
+                    guest__name__in=chunk).select_related('guest'))
+            batch['vnics'].update(
+                ((v.guest.name, v.name), v) for v in
+                VirtualNic.objects.filter(
+                    guest__name__in=chunk).select_related('guest'))
+
+        ids = set(hypervisors[self.host(mor)].id for mor in mors
+                  if self.host(mor) in hypervisors)
+        for chunk in chunks(list(ids)):
+            batch['datastores'].update(
+                ((link.hypervisor_id, link.datastore.name), link.datastore)
+                for link in Datastore.hypervisors.through.objects.filter(
+                    hypervisor__in=chunk).select_related('datastore'))
+            batch['networks'].update(
+                ((n.vswitch.hypervisor_id, n.name), n) for n in
+                Network.objects.filter(
+                    vswitch__hypervisor__in=chunk).select_related('vswitch'))
+        return batch
+
+    def apply_guest(self, mor, batch):
+        """Add a VirtualMachine to the wanted guests of a batch from
+        prefetch, return False if its host or its resource pool is not
+        known yet"""
+        props = self.props(mor)
+        hypervisor = batch['hypervisors'].get(self.host(mor))
+        pool = props.get('resourcePool')
+        if hypervisor is None or pool is not None and \
+                str(pool) not in batch['resource_pools']:
+            return False
+        guest = get_guest(self.server, props, batch['resource_pools'])
+        name = guest.get('name')
+
+        old_name = self.guest_names.get(mor)
+        if old_name and old_name != name and \
+                old_name in batch['guests'] and name not in batch['guests']:
+            # the renamed guest keeps its rows
+            batch['guests'][name] = batch['guests'].pop(old_name)
+            for rows in (batch['disks'], batch['vnics']):
+                for key in [k for k in rows if k[0] == old_name]:
+                    rows[(name, key[1])] = rows.pop(key)
+        self.guest_names[mor] = name
+        batch['wanted'][name] = (guest, hypervisor)
+        return True
+
+    def write_guests(self, batch):
+        """Insert or update the wanted guests of a batch with their Disk and
+        VirtualNic rows, return the number of rows written"""
+        wanted = dict((name, create_guest(guest, hypervisor, save=False))
+                      for name, (guest, hypervisor)
+                      in batch['wanted'].items())
+        existing = dict((name, g) for name, g in batch['guests'].items()
+                        if name in wanted)
+        self.touched.update(g.hypervisor_id for g in existing.values())
+        self.touched.update(g.hypervisor_id for g in wanted.values())
+
+        rows = 0
+        datacenters = {}
+        for g in wanted.values():
+            datacenters.setdefault(g.hypervisor.datacenter, []).append(g)
+        for datacenter, guests in datacenters.items():
+            rows += set_resource_pools(guests, datacenter)
+        rows += sum(sync_objects(Guest, existing, wanted))
+        guests = dict(existing)
+        for chunk in chunks([n for n in wanted if n not in existing]):
+            guests.update((g.name, g) for g in
+                          Guest.objects.filter(name__in=chunk))
+
+        disks = {}
+        vnics = {}
+        for name, (guest, hypervisor) in batch['wanted'].items():
+            g = guests[name]
+            for disk in guest.get('disks'):
+                disk_ds = batch['datastores'].get(
+                    (hypervisor.id, get_datastore_name(disk.get('filename'))))
+                if disk_ds:
+                    disks[(name, disk.get('name'))] = create_disk(
+                        disk, disk_ds, g, save=False)
+            for vnic in guest.get('vnics'):
+                vnic_net = batch['networks'].get(
+                    (hypervisor.id, vnic.get('network')))
+                if vnic_net:
+                    vnics[(name, vnic.get('name'))] = create_vnic(
+                        vnic, g, vnic_net, save=False)
+        existing = dict((k, d) for k, d in batch['disks'].items()
+                        if k[0] in wanted)
+        rows += sum(sync_objects(Disk, existing, disks))
+        existing = dict((k, v) for k, v in batch['vnics'].items()
+                        if k[0] in wanted)
+        rows += sum(sync_objects(VirtualNic, existing, vnics))
+        return rows
+
+    def sample(self, now=None):
+        """Record the capacity samples of the hypervisors changed since the
+        last samples if sample_interval seconds went by, return the number
+        of rows inserted"""
+        if now is None:
+            now = int(time.time())
+        if not self.unsampled or self.last_sample is not None and \
+                now - self.last_sample < self.sample_interval:
+            return 0
+        rows = record_samples(list(self.unsampled), now)
+        self.unsampled = set()
+        self.last_sample = now
+        return rows
+
+    def process(self, updates, now=None):
+        """Apply a list of updates to the database in one transaction,
+        then recompute the capacity rollups of the hypervisors whose guests
+        changed and the datacenter totals and sample them, now being the
+        epoch seconds of the batch. Return a dict of counters"""
+        guests, hosts, left = self.update(updates)
+        stats = {'updates': len(updates), 'hosts': len(hosts),
+                 'guests': len(guests), 'left': len(left), 'rows': 0}
+        self.touched = set()
+
+        with transaction.atomic():
+            for mor in hosts:
+                stats['rows'] += self.apply_host(mor)
+
+            if left:
+                stats['rows'] += len(left)
+                self.touched.update(Guest.objects.filter(
+                    name__in=left).values_list('hypervisor', flat=True))
+                Guest.objects.filter(name__in=left).delete()
+
+            if guests:
+                batch = self.prefetch(guests)
+                for mor in guests:
+                    if self.apply_guest(mor, batch):
+                        self.pending.discard(mor)
+                    else:
+                        self.pending.add(mor)
+                stats['rows'] += self.write_guests(batch)
+            stats['pending'] = len(self.pending)
+
+            if self.touched:
+                stats['rows'] += delete_empty_resource_pools()
+                stats['rows'] += update_capacity(list(self.touched))
+            if self.touched or hosts:
+                stats['rows'] += update_datacenters()
+            self.unsampled.update(self.touched)
+            stats['samples'] = self.sample(now)
+        return stats
+
+    def run(self, max_wait=60, iterations=None):
+        """Register the filter then apply the updates as they come, forever
+        or for iterations calls to WaitForUpdatesEx. The first call returns
+        the whole inventory"""
+        self.collector.create_filter(WATCHED_PROPERTIES)
+        while iterations is None or iterations > 0:
+            self.version, truncated, updates = \
+                self.collector.wait_for_updates(self.version, max_wait)
+            if updates:
+                stats = self.process(updates)
+                stats['version'] = self.version
+                print json.dumps(stats)
+            else:
+                self.sample()
+            if iterations is not None and not truncated:
+                iterations -= 1
+
+
+if __name__ == '__main__':
+    Config = ConfigParser.ConfigParser()
+    Config.read(expanduser('~/.hypervisor.ini'))
+
+    parser = OptionParser()
+    parser.add_option('-H', '--hostname',
+                      help='vCenter or ESXi host name - mandatory')
+    parser.add_option('-u', '--user', default='root',
+                      help='User name [default: %default]')
+    parser.add_option('-p', '--password', type='string', default='',
+                      help='Password to connect [default: %default]')
+    parser.add_option('-w', '--max-wait', dest='max_wait', type='int',
+                      default=60,
+                      help='Seconds to wait for changes in each '
+                           'WaitForUpdatesEx call [default: %default]')
+    parser.add_option('-i', '--sample-interval', dest='sample_interval',
+                      type='int', default=SAMPLE_INTERVAL,
+                      help='Seconds between two capacity samples of the '
+                           'changed hypervisors [default: %default]')
+
+    (options, args) = parser.parse_args()
+
+    if options.hostname is None:
+        print '"hostname" option is missing'
+        parser.print_help()
+        exit(-1)
+
+    try:
+        password = Config.get(options.user, 'password')
+    except:
+        password = ''
+
+    if getattr(options, 'password'):
+        password = options.password
+    if not password:
+        print '"password" option is missing'
+        exit(-1)
+
+    try:
+        server = vmware_connect(options.hostname, options.user, password)
+    except:
+        exit(1)
+
+    collector = VIPropertyCollector(server)
+    try:
+        InventoryWatcher(collector, server,
+                         options.sample_interval).run(options.max_wait)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.destroy()
+        server.disconnect()
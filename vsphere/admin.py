@@ -1,22 +1,42 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
+from vsphere.models import Datacenter
 from vsphere.models import Datastore
 from vsphere.models import Hypervisor
 from vsphere.models import Disk
 from vsphere.models import Guest
+from vsphere.models import ResourcePool
 from vsphere.models import Network
 from vsphere.models import Interface
 from vsphere.models import VirtualNic
 from vsphere.models import Vswitch
+from vsphere.models import CapacitySample
+
+
+class DatacenterAdmin(admin.ModelAdmin):
+    """
+    DatacenterAdmin Class with display and search settings, read only as
+    the rows are derived from the hypervisors
+    """
+    list_display = ['name', 'numHypervisors', 'numGuests', 'memorySize',
+                    'datastoresSize']
+    search_fields = ['name']
+    readonly_fields = ['name', 'numHypervisors', 'numCpuThreads',
+                       'memorySize', 'datastoresSize', 'numGuests',
+                       'memoryReserved', 'vcpuReserved', 'diskReserved',
+                       'rawDiskReserved']
+
+    def has_add_permission(self, request):
+        return False
 
 
 class DatastoreAdmin(admin.ModelAdmin):
     """
     DatastoreAdmin Class with display, filter and search settings
     """
-    list_display = ['hypervisor', 'name', 'capacity']
-    list_filter = ['hypervisor']
-    search_fields = ['hypervisor']
+    list_display = ['name', 'url', 'capacity']
+    list_filter = ['hypervisors']
+    search_fields = ['name', 'url']
     save_as = True
 
 
@@ -40,6 +60,16 @@ class GuestAdmin(admin.ModelAdmin):
     save_as = True
 
 
+class ResourcePoolAdmin(admin.ModelAdmin):
+    """
+    ResourcePoolAdmin Class with display, filter and search settings
+    """
+    list_display = ['name', 'datacenter']
+    list_filter = ['datacenter']
+    search_fields = ['name']
+    save_as = True
+
+
 class HypervisorAdmin(admin.ModelAdmin):
     """
     HypervisorAdmin Class with display, filter and search settings
@@ -86,11 +116,29 @@ class NetworkAdmin(admin.ModelAdmin):
     save_as = True
 
 
+class CapacitySampleAdmin(admin.ModelAdmin):
+    """
+    CapacitySampleAdmin Class with display and filter settings, read only
+    as the rows are recorded by record_samples
+    """
+    list_display = ['kind', 'entity', 'tier', 'timestamp', 'memory', 'vcpu',
+                    'disk', 'guests']
+    list_filter = ['kind', 'tier']
+    readonly_fields = ['kind', 'entity', 'tier', 'timestamp', 'memory',
+                       'vcpu', 'disk', 'rawDisk', 'guests', 'poweredOn']
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(Datacenter, DatacenterAdmin)
 admin.site.register(Datastore, DatastoreAdmin)
 admin.site.register(Hypervisor, HypervisorAdmin)
 admin.site.register(Disk, DiskAdmin)
 admin.site.register(Guest, GuestAdmin)
+admin.site.register(ResourcePool, ResourcePoolAdmin)
 admin.site.register(Interface, InterfaceAdmin)
 admin.site.register(VirtualNic, VirtualNicAdmin)
 admin.site.register(Vswitch, VswitchAdmin)
 admin.site.register(Network, NetworkAdmin)
+admin.site.register(CapacitySample, CapacitySampleAdmin)
@@ -1,8 +1,46 @@
 from tastypie.resources import ModelResource
+from tastypie.paginator import Paginator
+from tastypie.exceptions import BadRequest
 from vsphere.models import Guest, Hypervisor
+from vsphere.pagination import CursorPage, PAGE_SIZE
 from tastypie import fields
 
 
+class CursorPaginator(Paginator):
+    """
+    Keyset pagination on (name, id) when the request has a cursor, empty
+    for the first page, with the estimated total_count if it has total.
+    Offset pagination otherwise
+    """
+
+    def page(self):
+        if 'cursor' not in self.request_data:
+            return super(CursorPaginator, self).page()
+        limit = self.get_limit() or PAGE_SIZE
+        try:
+            page = CursorPage(self.objects, self.request_data['cursor'],
+                              limit, total='total' in self.request_data)
+        except ValueError:
+            raise BadRequest("Invalid cursor '%s' provided."
+                             % self.request_data['cursor'])
+        return {
+            self.collection_name: page.object_list,
+            'meta': {
+                'limit': limit,
+                'total_count': page.total,
+                'previous': self.cursor_uri(page.previous_cursor()),
+                'next': self.cursor_uri(page.next_cursor()),
+            },
+        }
+
+    def cursor_uri(self, cursor):
+        if cursor is None or self.resource_uri is None:
+            return None
+        request_params = self.request_data.copy()
+        request_params['cursor'] = cursor
+        return '%s?%s' % (self.resource_uri, request_params.urlencode())
+
+
 class GuestResource(ModelResource):
     hypervisor = fields.CharField(attribute="hypervisor")
 
@@ -12,6 +50,7 @@ class GuestResource(ModelResource):
         resource_name = 'guest'
         ordering = ['name']
         limit = 0
+        paginator_class = CursorPaginator
         filtering = {
             'name': ('exact', 'startswith', 'icontains'),
         }
@@ -28,6 +67,7 @@ class HypervisorResource(ModelResource):
         resource_name = 'hypervisor'
         ordering = ['name']
         limit = 0
+        paginator_class = CursorPaginator
         filtering = {
             'name': ('exact', 'startswith', 'icontains'),
         }
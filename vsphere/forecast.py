@@ -0,0 +1,142 @@
+from vsphere.models import CapacitySample
+import time
+
+try:
+    import numpy
+except ImportError:
+    # without numpy there is no forecast, the pages show none
+    numpy = None
+
+# vCPU per physical thread at which a hypervisor is considered full
+MAX_CONSOLIDATION = 4.0
+# days of daily samples fitted
+WINDOW = 30
+
+
+def fit_trends(groups, x, y, count, robust=True, iterations=10):
+    """Fit y = intercept + slope * x by least squares for count groups at
+    once, groups being the group index of each point. The robust fit
+    reweights the points by their residual (Huber) against the median
+    absolute residual of their group, so that a one-off jump does not
+    drive the trend. Return the intercept and slope arrays, nan for the
+    groups with less than two distinct x"""
+    intercept, slope = weighted_fit(groups, x, y, count, numpy.ones(len(x)))
+    for i in range(robust and iterations or 0):
+        residual = numpy.abs(y - intercept[groups] - slope[groups] * x)
+        limit = 1.5 * 1.4826 * group_medians(groups, residual, count)[groups]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            w = numpy.where(residual > limit, limit / residual, 1.0)
+        intercept, slope = weighted_fit(groups, x, y, count, w)
+    return intercept, slope
+
+
+def weighted_fit(groups, x, y, count, w):
+    n = numpy.bincount(groups, w, count)
+    sx = numpy.bincount(groups, w * x, count)
+    sy = numpy.bincount(groups, w * y, count)
+    sxx = numpy.bincount(groups, w * x * x, count)
+    sxy = numpy.bincount(groups, w * x * y, count)
+    det = n * sxx - sx * sx
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = numpy.where(det > 0, (n * sxy - sx * sy) / det, numpy.nan)
+        intercept = (sy - slope * sx) / n
+    return intercept, slope
+
+
+def group_medians(groups, values, count):
+    """Return the median of the values of each of count groups, nan for
+    the empty groups"""
+    if not len(values):
+        return numpy.full(count, numpy.nan)
+    order = numpy.lexsort((values, groups))
+    values = values[order]
+    points = numpy.bincount(groups, minlength=count)
+    start = numpy.concatenate(([0], numpy.cumsum(points)[:-1]))
+    last = len(values) - 1
+    low = numpy.minimum(start + (points - 1) // 2, last)
+    high = numpy.minimum(start + points // 2, last)
+    return numpy.where(points > 0, (values[low] + values[high]) / 2.0,
+                       numpy.nan)
+
+
+def load_samples(kind, fields, entities=None, days=WINDOW, now=None):
+    """Return the entity and x arrays of the daily samples and a dict of the
+    y array of each of fields, x being in days relative to now. The
+    entities are filtered by chunks of 500 ids to keep the IN clauses
+    small"""
+    if now is None:
+        now = int(time.time())
+    samples = CapacitySample.objects.filter(
+        kind=kind, tier=CapacitySample.DAILY,
+        timestamp__gte=now - days * 86400)
+    if entities is None:
+        querysets = [samples]
+    else:
+        entities = list(entities)
+        querysets = [samples.filter(entity__in=entities[i:i + 500])
+                     for i in range(0, len(entities), 500)]
+    rows = []
+    for queryset in querysets:
+        rows.extend(queryset.values_list('entity', 'timestamp', *fields))
+    rows = numpy.array(rows, dtype=float).reshape(-1, 2 + len(fields))
+    return (rows[:, 0].astype(int), (rows[:, 1] - now) / 86400.0,
+            dict((f, rows[:, 2 + i]) for i, f in enumerate(fields)))
+
+
+def days_until_full(kind, field, capacities, keys=None, days=WINDOW,
+                    now=None):
+    """Return a dict of the days until the field of the entities reaches
+    their capacity, from the trend of the last days of samples.
+    capacities is a dict of capacity indexed by entity id, or by key when
+    keys, a dict of key indexed by entity id, sums the samples of the
+    entities of a same key (the hypervisors of a datacenter). The days are
+    None when there is no trend or it does not grow"""
+    return days_until_full_by_field(kind, {field: capacities}, keys,
+                                    days=days, now=now).get(field, {})
+
+
+def days_until_full_by_field(kind, capacities, keys=None, all_entities=False,
+                             days=WINDOW, now=None):
+    """Return the days_until_full dict of each field of capacities, a dict
+    of capacities indexed by field, from a single load of the samples. When
+    keys holds every entity of kind, all_entities loads their samples
+    without filtering them by id"""
+    if numpy is None:
+        return {}
+    if keys is None:
+        keys = dict((e, e) for c in capacities.values() for e in c)
+    if not keys:
+        return dict((f, {}) for f in capacities)
+    entity, x, y = load_samples(kind, list(capacities),
+                                None if all_entities else keys.keys(),
+                                days, now)
+    return dict((f, fit_until_full(entity, x, y[f], c, keys))
+                for f, c in capacities.items())
+
+
+def fit_until_full(entity, x, y, capacities, keys):
+    """Return the days until full of the keys of capacities from the
+    samples of load_samples of their entities"""
+    if not capacities:
+        return {}
+    key_list = list(capacities)
+    key_index = dict((k, i) for i, k in enumerate(key_list))
+    group = numpy.array([key_index.get(keys.get(e), -1) for e in entity],
+                        dtype=int)
+    known = group >= 0
+    group, x, y = group[known], x[known], y[known]
+
+    # sum the entities of a key sampled in the same bucket
+    points, first, inverse = numpy.unique(
+        group * 1e6 + numpy.round(x, 4), return_index=True,
+        return_inverse=True)
+    y = numpy.bincount(inverse, y, len(points))
+    group, x = group[first], x[first]
+
+    intercept, slope = fit_trends(group, x, y, len(key_list))
+    capacity = numpy.array([capacities[k] for k in key_list], dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        left = numpy.maximum(capacity - intercept, 0) / slope
+        left = numpy.where(slope > 0, left, numpy.nan)
+    return dict((k, None if numpy.isnan(d) else float(d))
+                for k, d in zip(key_list, left))
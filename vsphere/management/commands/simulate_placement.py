@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from vsphere.placement import Simulation, new_guests
+from vsphere.forecast import MAX_CONSOLIDATION
+from optparse import make_option
+import json
+
+
+class Command(BaseCommand):
+    help = 'Simulate the placement of new guests or of the guests of lost ' \
+           'hypervisors and print the placement plan'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--datacenter', default='',
+                    help='Only use the hypervisors of this datacenter'),
+        make_option('-l', '--lose', action='append', default=[],
+                    help='Hypervisor name to evacuate, can be repeated'),
+        make_option('-n', '--new', action='append', default=[],
+                    help='New guests as count:memory:vcpu:disk, memory and '
+                         'disk in MB, can be repeated'),
+        make_option('-b', '--best-fit', action='store_true', dest='best_fit',
+                    default=False,
+                    help='Best fit instead of first fit decreasing'),
+        make_option('-c', '--consolidation', type='float',
+                    default=MAX_CONSOLIDATION,
+                    help='vCPU allowed per physical thread '
+                         '[default: %default]'),
+        make_option('-j', '--json', action='store_true', default=False,
+                    help='Print the plan as JSON'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            simulation = Simulation(options['datacenter'],
+                                    options['consolidation'])
+            guests = simulation.evacuate(options['lose'])
+            for spec in options['new']:
+                guests += new_guests(spec)
+        except (ImportError, ValueError) as e:
+            raise CommandError(e)
+        plan = simulation.place(guests, options['best_fit'])
+
+        if options['json']:
+            plan['hypervisors'] = simulation.free()
+            self.stdout.write(json.dumps(plan, indent=2))
+            return
+        for p in plan['placed']:
+            self.stdout.write('%s -> %s %s' % (p['guest'], p['hypervisor'],
+                                               p['datastore'] or ''))
+        for name in plan['unplaced']:
+            self.stdout.write('%s does not fit' % name)
+        self.stdout.write('%d placed, %d unplaced' % (len(plan['placed']),
+                                                      len(plan['unplaced'])))
@@ -1,11 +1,139 @@
 from django.core.validators import RegexValidator
-from django.db.models import Sum
-from django.db import models
+from django.db.models import Avg, Count, Sum, Q
+from django.db import models, connection
+import json
+import time
 import re
 
 name_regex = re.compile(r'^[a-zA-Z0-9\-\_\.]+$')
 
 
+# Correlated subqueries, one per annotation, so the sums over guests, disks
+# and datastores don't multiply each other like joins would
+HYPERVISOR_CAPACITY = {
+    'guests_count': 'SELECT COUNT(*) FROM vsphere_guest g '
+                    'WHERE g.hypervisor_id = vsphere_hypervisor.id',
+    'guests_memory': 'SELECT COALESCE(SUM(g.memory), 0) FROM vsphere_guest g '
+                     'WHERE g.hypervisor_id = vsphere_hypervisor.id',
+    'guests_vcpu': 'SELECT COALESCE(SUM(g.vcpu), 0) FROM vsphere_guest g '
+                   'WHERE g.hypervisor_id = vsphere_hypervisor.id',
+    'datastores_capacity': 'SELECT COALESCE(SUM(s.capacity), 0) '
+                           'FROM vsphere_datastore s '
+                           'JOIN vsphere_datastore_hypervisors m '
+                           'ON m.datastore_id = s.id '
+                           'WHERE m.hypervisor_id = vsphere_hypervisor.id',
+    'disks_size': 'SELECT COALESCE(SUM(d.size), 0) FROM vsphere_disk d '
+                  'JOIN vsphere_guest g ON d.guest_id = g.id '
+                  'WHERE g.hypervisor_id = vsphere_hypervisor.id '
+                  'AND d.datastore_id IS NOT NULL AND NOT d.raw',
+    'raw_disks_size': 'SELECT COALESCE(SUM(d.size), 0) FROM vsphere_disk d '
+                      'JOIN vsphere_guest g ON d.guest_id = g.id '
+                      'WHERE g.hypervisor_id = vsphere_hypervisor.id '
+                      'AND d.raw',
+}
+
+GUEST_DISK_TOTALS = {
+    'disks_size': 'SELECT COALESCE(SUM(d.size), 0) FROM vsphere_disk d '
+                  'WHERE d.guest_id = vsphere_guest.id',
+    'raw_disks_size': 'SELECT COALESCE(SUM(d.size), 0) FROM vsphere_disk d '
+                      'WHERE d.guest_id = vsphere_guest.id AND d.raw',
+}
+
+DATASTORE_USAGE = {
+    'disks_size': 'SELECT COALESCE(SUM(d.size), 0) FROM vsphere_disk d '
+                  'WHERE d.datastore_id = vsphere_datastore.id AND NOT d.raw',
+    'guests_count': 'SELECT COUNT(DISTINCT d.guest_id) FROM vsphere_disk d '
+                    'WHERE d.datastore_id = vsphere_datastore.id',
+}
+
+
+class HypervisorQuerySet(models.query.QuerySet):
+    def with_capacity(self):
+        return self.extra(select=HYPERVISOR_CAPACITY)
+
+    def by_free_capacity(self):
+        def column(name):
+            return 'vsphere_hypervisor.%s' % connection.ops.quote_name(name)
+        return self.extra(select={
+            'memory_free': '%s - %s' % (column('memorySize'),
+                                        column('memoryReserved')),
+            'storage_free': '%s - %s' % (column('datastoresSize'),
+                                         column('diskReserved')),
+        }).order_by('-memory_free', '-storage_free', 'id')
+
+
+class HypervisorManager(models.Manager):
+    def get_queryset(self):
+        return HypervisorQuerySet(self.model, using=self._db)
+
+    def with_capacity(self):
+        """Hypervisors annotated with guests_count, guests_memory,
+        guests_vcpu, datastores_capacity, disks_size and raw_disks_size"""
+        return self.get_queryset().with_capacity()
+
+    def by_free_capacity(self):
+        """Hypervisors annotated with memory_free and storage_free, ordered
+        by the most free memory then datastore space"""
+        return self.get_queryset().by_free_capacity()
+
+
+class GuestQuerySet(models.query.QuerySet):
+    def with_disk_totals(self):
+        return self.extra(select=GUEST_DISK_TOTALS)
+
+
+class GuestManager(models.Manager):
+    def get_queryset(self):
+        return GuestQuerySet(self.model, using=self._db)
+
+    def with_disk_totals(self):
+        """Guests annotated with disks_size and raw_disks_size"""
+        return self.get_queryset().with_disk_totals()
+
+
+class DatastoreQuerySet(models.query.QuerySet):
+    def with_usage(self):
+        return self.extra(select=DATASTORE_USAGE)
+
+
+class DatastoreManager(models.Manager):
+    def get_queryset(self):
+        return DatastoreQuerySet(self.model, using=self._db)
+
+    def with_usage(self):
+        """Datastores annotated with disks_size, without raw disks, and
+        guests_count"""
+        return self.get_queryset().with_usage()
+
+
+class Datacenter(models.Model):
+    name = models.CharField(max_length=100, unique=True,
+                            validators=[RegexValidator(regex=name_regex)])
+    # totals of the hypervisors, recomputed by update_datacenters
+    numHypervisors = models.IntegerField(default=0, editable=False)
+    numCpuThreads = models.IntegerField(default=0, editable=False)
+    memorySize = models.IntegerField(default=0, editable=False)
+    datastoresSize = models.IntegerField(default=0, editable=False)
+    numGuests = models.IntegerField(default=0, editable=False)
+    memoryReserved = models.IntegerField(default=0, editable=False)
+    vcpuReserved = models.IntegerField(default=0, editable=False)
+    diskReserved = models.IntegerField(default=0, editable=False)
+    rawDiskReserved = models.IntegerField(default=0, editable=False)
+    # JSON histograms
+    esxiVersions = models.TextField(default='{}', editable=False)
+    linkSpeeds = models.TextField(default='{}', editable=False)
+
+    def __unicode__(self):
+        return u'%s' % self.name
+
+    def get_esxi_versions(self):
+        return json.loads(self.esxiVersions)
+
+    def get_link_speeds(self):
+        return dict((int(k), v) for k, v in
+                    json.loads(self.linkSpeeds).items())
+
+
 class Hypervisor(models.Model):
     name = models.CharField(max_length=100, unique=True,
                             validators=[RegexValidator(regex=name_regex)])
@@ -24,46 +152,66 @@ class Hypervisor(models.Model):
     annotation = models.CharField(max_length=100, blank=True, null=True)
     datacenter = models.CharField(max_length=100, unique=False,
                                   validators=[RegexValidator(regex=name_regex)])
+    dc = models.ForeignKey(Datacenter, null=True, blank=True,
+                           on_delete=models.SET_NULL)
+    # capacity rollups, recomputed by update_capacity
+    numGuests = models.IntegerField(default=0, editable=False)
+    datastoresSize = models.IntegerField(default=0, editable=False)
+    memoryReserved = models.IntegerField(default=0, editable=False)
+    vcpuReserved = models.IntegerField(default=0, editable=False)
+    diskReserved = models.IntegerField(default=0, editable=False)
+    rawDiskReserved = models.IntegerField(default=0, editable=False)
+
+    objects = HypervisorManager()
 
     def __unicode__(self):
         return u'%s' % self.name
 
     def get_number_guest(self):
+        if hasattr(self, 'guests_count'):
+            return self.guests_count
         guest_list = Guest.objects.filter(hypervisor=self)
         return len(guest_list)
 
     def get_datastores_size(self):
-        ds_list = Datastore.objects.filter(hypervisor=self)
+        if hasattr(self, 'datastores_capacity'):
+            return self.datastores_capacity
+        ds_list = self.datastores.all()
         capacity = 0
         for ds in ds_list:
             capacity += int(ds.capacity)
         return capacity
 
     def get_mem_reserved(self):
+        if hasattr(self, 'guests_memory'):
+            return self.guests_memory
         guest_list = Guest.objects.filter(hypervisor=self)
         mem_reserved = 0
         for guest in guest_list:
             mem_reserved += int(guest.memory)
         return mem_reserved
-    memoryReserved = property(get_mem_reserved)
 
     def get_disk_reserved(self):
-        ds_list = Datastore.objects.filter(hypervisor=self)
+        if hasattr(self, 'disks_size'):
+            return self.disks_size
+        disk_list = Disk.objects.filter(guest__hypervisor=self, raw=False)
         disk_reserved = 0
-        for ds in ds_list:
-            disk_reserved += Datastore.get_reserved(ds)
+        for disk in disk_list.exclude(datastore=None):
+            disk_reserved += int(disk.size)
         return disk_reserved
-    diskReserved = property(get_disk_reserved)
 
     def get_vcpu_reserved(self):
+        if hasattr(self, 'guests_vcpu'):
+            return self.guests_vcpu
         guest_list = Guest.objects.filter(hypervisor=self)
         vcpu_reserved = 0
         for guest in guest_list:
             vcpu_reserved += int(guest.vcpu)
         return vcpu_reserved
-    vcpuReserved = property(get_vcpu_reserved)
 
     def get_raw_disk_reserved(self):
+        if hasattr(self, 'raw_disks_size'):
+            return self.raw_disks_size
         raw_disk_reserved = 0
         guest_list = Guest.objects.filter(hypervisor=self)
         for guest in guest_list:
@@ -75,16 +223,31 @@ class Hypervisor(models.Model):
         return raw_disk_reserved
 
 
+class ResourcePool(models.Model):
+    name = models.CharField(max_length=100, db_index=True)
+    datacenter = models.CharField(max_length=100)
+
+    class Meta:
+        unique_together = ('name', 'datacenter')
+
+    def __unicode__(self):
+        return u'%s.%s' % (self.datacenter, self.name)
+
+
 class Guest(models.Model):
     name = models.CharField(max_length=100, unique=True)
     poweredOn = models.BooleanField()
     vcpu = models.IntegerField()
     memory = models.IntegerField()
     resourcePool = models.CharField(max_length=100)
+    pool = models.ForeignKey(ResourcePool, null=True, blank=True,
+                             on_delete=models.SET_NULL)
     annotation = models.CharField(max_length=100, blank=True, null=True)
     osVersion = models.CharField(max_length=100, blank=True, null=True)
     hypervisor = models.ForeignKey(Hypervisor, unique=False, null=False)
 
+    objects = GuestManager()
+
     def __unicode__(self):
         return u'%s.%s' % (self.hypervisor.name, self.name)
 
@@ -92,6 +255,10 @@ class Guest(models.Model):
         return self.hypervisor.name
 
     def get_disk_reserved(self, raw=''):
+        if hasattr(self, 'disks_size'):
+            if raw is False:
+                return self.disks_size - self.raw_disks_size
+            return self.disks_size
         if raw is False:
             disk_list = Disk.objects.filter(guest=self, raw=False)
         else:
@@ -104,13 +271,22 @@ class Guest(models.Model):
 
 class Datastore(models.Model):
     name = models.CharField(max_length=100)
+    url = models.CharField(max_length=255, unique=True)
     capacity = models.IntegerField()
-    hypervisor = models.ForeignKey(Hypervisor, null=False)
+    hypervisors = models.ManyToManyField(Hypervisor,
+                                         related_name='datastores')
+    # capacity rollups, recomputed by update_capacity
+    reserved = models.IntegerField(default=0, editable=False)
+    numGuests = models.IntegerField(default=0, editable=False)
+
+    objects = DatastoreManager()
 
     def __unicode__(self):
-        return u'%s.%s' % (self.hypervisor.name, self.name)
+        return u'%s' % self.name
 
     def get_reserved(self):
+        if hasattr(self, 'disks_size'):
+            return self.disks_size
         vd_list = Disk.objects.filter(datastore=self)
         reserved = 0
         for vd in vd_list:
@@ -131,7 +307,8 @@ class Disk(models.Model):
     name = models.CharField(max_length=100)
     size = models.IntegerField()
     guest = models.ForeignKey(Guest, null=False)
-    datastore = models.ForeignKey(Datastore, null=True)
+    datastore = models.ForeignKey(Datastore, null=True,
+                                  on_delete=models.SET_NULL)
     raw = models.BooleanField(default=False)
     thin = models.BooleanField(default=False)
 
@@ -181,3 +358,275 @@ class VirtualNic(models.Model):
 
     def __unicode__(self):
         return u'%s.%s' % (self.guest.name, self.name)
+
+
+def save_changed(obj, values):
+    """Set the fields of a dict of values which differ on obj and save only
+    these fields, return 1 if obj changed, 0 otherwise"""
+    changed = [k for k, v in values.items() if getattr(obj, k) != v]
+    for k in changed:
+        setattr(obj, k, values[k])
+    if changed:
+        obj.save(update_fields=changed)
+    return int(bool(changed))
+
+
+def update_capacity(hypervisors=None, datastores=()):
+    """Recompute the capacity rollups of the hypervisors, a list of id, of
+    their datastores and of the datastores, a list of id, or of every
+    hypervisor and datastore if hypervisors is None, with the annotated
+    managers. Only the rows which changed are saved, return their number"""
+    hypervisor_list = Hypervisor.objects.with_capacity()
+    ds_list = Datastore.objects.with_usage()
+    if hypervisors is not None:
+        hypervisor_list = hypervisor_list.filter(id__in=hypervisors)
+        ds_list = ds_list.filter(Q(hypervisors__in=hypervisors) |
+                                 Q(id__in=datastores)).distinct()
+
+    rows = 0
+    for ds in ds_list:
+        rows += save_changed(ds, {
+            'reserved': ds.get_reserved(),
+            'numGuests': ds.guests_count,
+        })
+    for hv in hypervisor_list:
+        rows += save_changed(hv, {
+            'numGuests': hv.get_number_guest(),
+            'datastoresSize': hv.get_datastores_size(),
+            'memoryReserved': hv.get_mem_reserved(),
+            'vcpuReserved': hv.get_vcpu_reserved(),
+            'diskReserved': hv.get_disk_reserved(),
+            'rawDiskReserved': hv.get_raw_disk_reserved(),
+        })
+    return rows
+
+
+def update_resource_pools():
+    """Create the ResourcePool rows from the resourcePool names of the
+    guests without pool, imported before the ResourcePool model, and link
+    the guests to them. Return the number of guests linked"""
+    rows = 0
+    pairs = Guest.objects.filter(pool=None).values_list(
+        'resourcePool', 'hypervisor__datacenter').distinct()
+    for name, datacenter in pairs:
+        pool, created = ResourcePool.objects.get_or_create(
+            name=name, datacenter=datacenter)
+        rows += Guest.objects.filter(
+            pool=None, resourcePool=name,
+            hypervisor__datacenter=datacenter).update(pool=pool)
+    return rows
+
+
+def update_datacenters():
+    """Recompute the totals and histograms of every Datacenter from the
+    rollups of its hypervisors with grouped queries, and delete the
+    datacenters without hypervisor. A datastore shared by hypervisors of
+    a datacenter is counted once. Only the rows which changed are saved,
+    return their number"""
+    totals = dict((r['dc'], r) for r in Hypervisor.objects.values(
+        'dc').annotate(numHypervisors=Count('id'),
+                       numCpuThreads=Sum('numCpuThreads'),
+                       memorySize=Sum('memorySize'),
+                       numGuests=Sum('numGuests'),
+                       memoryReserved=Sum('memoryReserved'),
+                       vcpuReserved=Sum('vcpuReserved'),
+                       diskReserved=Sum('diskReserved'),
+                       rawDiskReserved=Sum('rawDiskReserved')))
+
+    versions = {}
+    for r in Hypervisor.objects.values('dc', 'productVersion').annotate(
+            count=Count('id')):
+        versions.setdefault(r['dc'], {})[str(r['productVersion'])] = \
+            r['count']
+    storage = {}
+    for dc, ds, capacity in Datastore.objects.values_list(
+            'hypervisors__dc', 'id', 'capacity').distinct():
+        storage[dc] = storage.get(dc, 0) + capacity
+    speeds = {}
+    for r in Interface.objects.exclude(vswitch=None).values(
+            'hypervisor__dc', 'linkSpeed').annotate(count=Count('id')):
+        speeds.setdefault(r['hypervisor__dc'], {})[r['linkSpeed']] = \
+            r['count']
+
+    rows = 0
+    for dc in Datacenter.objects.all():
+        if dc.id not in totals:
+            dc.delete()
+            rows += 1
+            continue
+        values = dict((k, v or 0) for k, v in totals[dc.id].items()
+                      if k != 'dc')
+        values['datastoresSize'] = storage.get(dc.id, 0)
+        values['esxiVersions'] = json.dumps(versions.get(dc.id, {}),
+                                            sort_keys=True)
+        values['linkSpeeds'] = json.dumps(speeds.get(dc.id, {}),
+                                          sort_keys=True)
+        rows += save_changed(dc, values)
+    return rows
+
+
+def update_datacenter_links():
+    """Create the Datacenter rows from the datacenter names of the
+    hypervisors without dc, imported before the Datacenter model, and link
+    the hypervisors to them. Return the number of hypervisors linked"""
+    rows = 0
+    names = Hypervisor.objects.filter(dc=None).values_list(
+        'datacenter', flat=True).distinct()
+    for name in names:
+        dc, created = Datacenter.objects.get_or_create(name=name)
+        rows += Hypervisor.objects.filter(dc=None, datacenter=name).update(
+            dc=dc)
+    return rows
+
+
+class CapacitySample(models.Model):
+    HYPERVISOR = 0
+    DATASTORE = 1
+    RESOURCEPOOL = 2
+    KINDS = {'hypervisor': HYPERVISOR, 'datastore': DATASTORE,
+             'resourcepool': RESOURCEPOOL}
+
+    RAW = 0
+    HOURLY = 1
+    DAILY = 2
+    # (bucket seconds, retention seconds) of each tier, hourly and daily
+    # buckets hold the mean of the raw samples recorded in them, the raw
+    # retention covers a whole daily bucket
+    TIERS = {RAW: (1, 2 * 86400),
+             HOURLY: (3600, 60 * 86400),
+             DAILY: (86400, 3 * 365 * 86400)}
+
+    kind = models.SmallIntegerField(
+        choices=sorted((v, k) for k, v in KINDS.items()))
+    entity = models.IntegerField()
+    tier = models.SmallIntegerField(
+        choices=[(RAW, 'raw'), (HOURLY, 'hourly'), (DAILY, 'daily')])
+    timestamp = models.IntegerField()
+    memory = models.IntegerField(default=0)
+    vcpu = models.IntegerField(default=0)
+    disk = models.IntegerField(default=0)
+    rawDisk = models.IntegerField(default=0)
+    guests = models.IntegerField(default=0)
+    poweredOn = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [('kind', 'entity', 'tier', 'timestamp'),
+                          ('tier', 'timestamp')]
+
+    def __unicode__(self):
+        return u'%s.%s.%s.%s' % (self.kind, self.entity, self.tier,
+                                 self.timestamp)
+
+
+SAMPLE_FIELDS = ['memory', 'vcpu', 'disk', 'rawDisk', 'guests', 'poweredOn']
+
+
+def get_capacity_samples(hypervisors=None):
+    """Return a list of (kind, entity, values) tuple, values being a dict
+    indexed by SAMPLE_FIELDS, for the hypervisors, a list of id, their
+    datastores and the resource pools of their guests, or for all of them
+    if None. Hypervisors and datastores are read from their rollups"""
+    hv_list = Hypervisor.objects.all()
+    ds_list = Datastore.objects.all()
+    guest_list = Guest.objects.all()
+    if hypervisors is not None:
+        hv_list = hv_list.filter(id__in=hypervisors)
+        ds_list = ds_list.filter(hypervisors__in=hypervisors).distinct()
+        pools = Guest.objects.filter(hypervisor__in=hypervisors).exclude(
+            pool=None).values_list('pool', flat=True).distinct()
+        guest_list = guest_list.filter(pool__in=list(pools))
+
+    powered = dict(Guest.objects.filter(
+        poweredOn=True, hypervisor__in=hv_list).values_list(
+        'hypervisor').annotate(Count('id')))
+    ret_val = []
+    for hv in hv_list:
+        ret_val.append((CapacitySample.HYPERVISOR, hv.id, {
+            'memory': hv.memoryReserved, 'vcpu': hv.vcpuReserved,
+            'disk': hv.diskReserved, 'rawDisk': hv.rawDiskReserved,
+            'guests': hv.numGuests, 'poweredOn': powered.get(hv.id, 0)}))
+    for ds in ds_list:
+        ret_val.append((CapacitySample.DATASTORE, ds.id, {
+            'disk': ds.reserved, 'guests': ds.numGuests}))
+
+    guest_list = guest_list.exclude(pool=None)
+    powered = dict(guest_list.filter(poweredOn=True).values_list(
+        'pool').annotate(Count('id')))
+    disks = {}
+    for pool, raw, size in Disk.objects.filter(
+            guest__in=guest_list).values_list('guest__pool', 'raw').annotate(
+            Sum('size')):
+        disks[(pool, raw)] = size
+    for r in guest_list.values('pool').annotate(
+            count=Count('id'), memory=Sum('memory'), vcpu=Sum('vcpu')):
+        pool = r['pool']
+        ret_val.append((CapacitySample.RESOURCEPOOL, pool, {
+            'memory': r['memory'], 'vcpu': r['vcpu'],
+            'disk': disks.get((pool, False), 0),
+            'rawDisk': disks.get((pool, True), 0),
+            'guests': r['count'], 'poweredOn': powered.get(pool, 0)}))
+    return ret_val
+
+
+def record_samples(hypervisors=None, timestamp=None):
+    """Record the samples of get_capacity_samples at timestamp, epoch
+    seconds, now if None: appended to the raw tier, then the bucket of
+    timestamp in the other tiers is replaced by the mean of the raw samples
+    it holds, then delete the samples past the retention of their tier.
+    Return the number of rows inserted"""
+    if timestamp is None:
+        timestamp = int(time.time())
+    samples = get_capacity_samples(hypervisors)
+    rows = [CapacitySample(kind=kind, entity=entity, tier=CapacitySample.RAW,
+                           timestamp=timestamp, **values)
+            for kind, entity, values in samples]
+    CapacitySample.objects.bulk_create(rows, batch_size=500)
+    inserted = len(rows)
+
+    means = dict(('mean_' + f, Avg(f)) for f in SAMPLE_FIELDS)
+    for tier, (step, retention) in CapacitySample.TIERS.items():
+        if tier != CapacitySample.RAW:
+            bucket = timestamp - timestamp % step
+            rows = []
+            for kind in CapacitySample.KINDS.values():
+                entities = [e for k, e, v in samples if k == kind]
+                for i in range(0, len(entities), 500):
+                    chunk = entities[i:i + 500]
+                    raw = CapacitySample.objects.filter(
+                        kind=kind, tier=CapacitySample.RAW,
+                        entity__in=chunk, timestamp__gte=bucket,
+                        timestamp__lt=bucket + step)
+                    for r in raw.values('entity').annotate(**means):
+                        values = dict((f, int(round(r['mean_' + f])))
+                                      for f in SAMPLE_FIELDS)
+                        rows.append(CapacitySample(
+                            kind=kind, entity=r['entity'], tier=tier,
+                            timestamp=bucket, **values))
+                    CapacitySample.objects.filter(
+                        kind=kind, tier=tier, timestamp=bucket,
+                        entity__in=chunk).delete()
+            CapacitySample.objects.bulk_create(rows, batch_size=500)
+            inserted += len(rows)
+        CapacitySample.objects.filter(
+            tier=tier, timestamp__lt=timestamp - retention).delete()
+    return inserted
+
+
+def get_samples(kind, entity, start, end=None, tier=None):
+    """Return the samples of an entity between start and end, epoch
+    seconds, as a dict of lists indexed by timestamp and SAMPLE_FIELDS.
+    Unless tier is given, the finest tier still holding start is used"""
+    if end is None:
+        end = int(time.time())
+    if tier is None:
+        age = int(time.time()) - start
+        for tier in (CapacitySample.RAW, CapacitySample.HOURLY,
+                     CapacitySample.DAILY):
+            if CapacitySample.TIERS[tier][1] >= age:
+                break
+    fields = ['timestamp'] + SAMPLE_FIELDS
+    rows = CapacitySample.objects.filter(
+        kind=kind, entity=entity, tier=tier, timestamp__gte=start,
+        timestamp__lte=end).order_by('timestamp').values_list(*fields)
+    columns = zip(*rows) or [()] * len(fields)
+    return dict((f, list(c)) for f, c in zip(fields, columns))
@@ -0,0 +1,110 @@
+from django.core.cache import cache
+from django.db.models import Model, Q
+import hashlib
+import base64
+import json
+
+PAGE_SIZE = 25
+# seconds an estimated total is kept
+COUNT_TIMEOUT = 300
+
+
+def encode_cursor(direction, key):
+    return base64.urlsafe_b64encode(json.dumps([direction] + list(key)))
+
+
+def decode_cursor(cursor, keys):
+    """Return the direction, 'next' or 'prev', and the key of a cursor
+    token, raise ValueError if it is not one. The key values are scalars,
+    a list or a dict would only fail once the query runs"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(data, list) or len(data) != len(keys) + 1 or \
+            data[0] not in ('next', 'prev'):
+        raise ValueError('invalid cursor')
+    for value in data[1:]:
+        if not isinstance(value, (basestring, int, long, float)):
+            raise ValueError('invalid cursor')
+    return data[0], data[1:]
+
+
+def estimated_count(queryset):
+    """Return the count of the queryset, cached COUNT_TIMEOUT seconds by
+    query, so it may be behind the table"""
+    key = 'vsphere-count-%s' % hashlib.md5(
+        unicode(queryset.query).encode('utf-8')).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_TIMEOUT)
+    return count
+
+
+class CursorPage(object):
+    """
+    A page of a queryset ordered on keys, (name, id) by default, starting
+    after (or ending before) the row of an opaque cursor token, fetched
+    with a WHERE on the keys instead of an OFFSET and without a COUNT. A
+    flat values_list is paged on its single key. Like a Django Page it is
+    a sequence of its rows
+    """
+
+    def __init__(self, queryset, cursor='', size=PAGE_SIZE,
+                 keys=('name', 'id'), total=False):
+        self.keys = keys
+        self.total = None
+        if total:
+            self.total = estimated_count(queryset)
+        direction, key = 'next', None
+        if cursor:
+            direction, key = decode_cursor(cursor, keys)
+            queryset = queryset.filter(self.beyond(direction, key))
+        if direction == 'next':
+            order = keys
+        else:
+            order = ['-%s' % k for k in keys]
+        rows = list(queryset.order_by(*order)[:size + 1])
+        more = len(rows) > size
+        self.object_list = rows[:size]
+        if direction == 'next':
+            self.has_previous = key is not None
+            self.has_next = more
+        else:
+            self.object_list.reverse()
+            self.has_previous = more
+            self.has_next = True
+
+    def beyond(self, direction, key):
+        """Return the Q of the rows after (next) or before (prev) key"""
+        op = direction == 'next' and 'gt' or 'lt'
+        q = None
+        for name, value in reversed(zip(self.keys, key)):
+            beyond = Q(**{'%s__%s' % (name, op): value})
+            if q is not None:
+                beyond |= Q(**{name: value}) & q
+            q = beyond
+        return q
+
+    def key(self, row):
+        if isinstance(row, Model):
+            return [getattr(row, k) for k in self.keys]
+        return [row]
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor('next', self.key(self.object_list[-1]))
+
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor('prev', self.key(self.object_list[0]))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
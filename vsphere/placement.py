@@ -0,0 +1,173 @@
+from vsphere.models import Hypervisor, Guest, Datastore, Disk
+from vsphere.forecast import MAX_CONSOLIDATION
+
+try:
+    import numpy
+except ImportError:
+    # the simulator needs numpy
+    numpy = None
+
+
+def new_guests(spec, prefix='new'):
+    """Return the guests described by a count:memory:vcpu:disk spec, memory
+    and disk in MB, as a list of dict for Simulation.place"""
+    count, memory, vcpu, disk = [int(x) for x in spec.split(':')]
+    return [{'name': '%s-%d' % (prefix, i + 1), 'memory': memory,
+             'vcpu': vcpu, 'disk': disk, 'datastores': ()}
+            for i in range(count)]
+
+
+class Simulation(object):
+    """
+    What-if placement of guests on the hypervisors of a datacenter, or all
+    of them, from their current free memory, vCPU (up to consolidation
+    vCPU per thread) and datastore space. The state is kept in arrays
+    indexed by hypervisor, the datastores mounted by each hypervisor being
+    stored as consecutive slices of the mount arrays
+    """
+
+    def __init__(self, datacenter=None, consolidation=MAX_CONSOLIDATION):
+        if numpy is None:
+            raise ImportError('the placement simulator requires numpy')
+        hv_list = Hypervisor.objects.order_by('name')
+        if datacenter:
+            hv_list = hv_list.filter(datacenter=datacenter)
+        rows = list(hv_list.values_list('id', 'name', 'memorySize',
+                                        'memoryReserved', 'numCpuThreads',
+                                        'vcpuReserved'))
+        self.hv_ids = [r[0] for r in rows]
+        self.hv_names = [r[1] for r in rows]
+        self.hv_index = dict((r[0], i) for i, r in enumerate(rows))
+        self.memory = numpy.array([r[2] - r[3] for r in rows], dtype=float)
+        self.vcpu = numpy.array([r[4] * consolidation - r[5] for r in rows],
+                                dtype=float)
+        self.alive = numpy.ones(len(rows), dtype=bool)
+
+        mounts = sorted(
+            (self.hv_index[h], d) for h, d in
+            Datastore.hypervisors.through.objects.filter(
+                hypervisor__in=self.hv_ids).values_list('hypervisor_id',
+                                                         'datastore_id'))
+        ds_rows = Datastore.objects.filter(
+            id__in=set(d for h, d in mounts)).values_list(
+            'id', 'name', 'capacity', 'reserved')
+        self.ds_ids = [r[0] for r in ds_rows]
+        self.ds_names = [r[1] for r in ds_rows]
+        self.ds_index = dict((r[0], i) for i, r in enumerate(ds_rows))
+        self.ds_free = numpy.array([r[2] - r[3] for r in ds_rows],
+                                   dtype=float)
+        self.mount_hv = numpy.array([h for h, d in mounts], dtype=int)
+        self.mount_ds = numpy.array([self.ds_index[d] for h, d in mounts],
+                                    dtype=int)
+        self.mount_start = numpy.searchsorted(self.mount_hv,
+                                              numpy.arange(len(rows) + 1))
+        order = numpy.argsort(self.mount_ds, kind='mergesort')
+        self.ds_hosts = numpy.split(self.mount_hv[order], numpy.searchsorted(
+            self.mount_ds[order], numpy.arange(1, len(self.ds_ids))))
+        self.update_datastores()
+
+    def update_datastores(self):
+        """Compute the largest free datastore space of every hypervisor"""
+        self.ds_best = numpy.full(len(self.hv_ids), -1.0)
+        mounted = self.mount_start[1:] > self.mount_start[:-1]
+        if mounted.any():
+            self.ds_best[mounted] = numpy.maximum.reduceat(
+                self.ds_free[self.mount_ds], self.mount_start[:-1][mounted])
+
+    def use_datastore(self, ds, size):
+        """Take size from the datastore index, recomputing the largest free
+        space of the hypervisors for which it was the largest"""
+        hosts = self.ds_hosts[ds]
+        stale = hosts[self.ds_best[hosts] == self.ds_free[ds]]
+        self.ds_free[ds] -= size
+        if len(stale):
+            mounts = numpy.zeros(len(self.hv_ids), dtype=bool)
+            mounts[stale] = True
+            mounts = mounts[self.mount_hv]
+            self.ds_best[stale] = -1.0
+            numpy.maximum.at(self.ds_best, self.mount_hv[mounts],
+                             self.ds_free[self.mount_ds[mounts]])
+
+    def mounting(self, datastores):
+        """Return the mask of the hypervisors mounting all the datastores"""
+        wanted = [self.ds_index.get(d, -1) for d in datastores]
+        if -1 in wanted:
+            return numpy.zeros(len(self.hv_ids), dtype=bool)
+        count = numpy.bincount(
+            self.mount_hv[numpy.in1d(self.mount_ds, wanted)],
+            minlength=len(self.hv_ids))
+        return count == len(wanted)
+
+    def evacuate(self, names):
+        """Remove the named hypervisors and return their guests, to place
+        again on the hypervisors mounting their datastores"""
+        lost = list(Hypervisor.objects.filter(
+            id__in=self.hv_ids, name__in=names).values_list('id', flat=True))
+        for h in lost:
+            self.alive[self.hv_index[h]] = False
+        datastores = {}
+        for g, d in Disk.objects.filter(
+                guest__hypervisor__in=lost).exclude(
+                datastore=None).values_list('guest', 'datastore').distinct():
+            datastores.setdefault(g, []).append(d)
+        return [{'name': name, 'memory': memory, 'vcpu': vcpu, 'disk': 0,
+                 'datastores': datastores.get(g, ())}
+                for g, name, memory, vcpu in Guest.objects.filter(
+                    hypervisor__in=lost).order_by('name').values_list(
+                    'id', 'name', 'memory', 'vcpu')]
+
+    def place(self, guests, best_fit=False):
+        """Place the guests, largest memory first, on the first hypervisor
+        they fit on or with best_fit on the one left with the least free
+        memory, their disk going on a datastore of this hypervisor the same
+        way. Return the placement plan as a dict with the placed guests
+        and the names of the guests which do not fit"""
+        placed, unplaced = [], []
+        # free resources only shrink, a demand which did not fit never will
+        failed = set()
+        for vm in sorted(guests, key=lambda g: (g['memory'], g['vcpu'],
+                                                g['disk']), reverse=True):
+            demand = (vm['memory'], vm['vcpu'], vm['disk'],
+                      tuple(vm['datastores']))
+            if demand in failed:
+                unplaced.append(vm['name'])
+                continue
+            fit = self.alive & (self.memory >= vm['memory']) & (
+                self.vcpu >= vm['vcpu'])
+            if vm['disk']:
+                fit &= self.ds_best >= vm['disk']
+            if vm['datastores']:
+                fit &= self.mounting(vm['datastores'])
+            candidates = numpy.flatnonzero(fit)
+            if not len(candidates):
+                failed.add(demand)
+                unplaced.append(vm['name'])
+                continue
+            if best_fit:
+                h = candidates[numpy.argmin(self.memory[candidates])]
+            else:
+                h = candidates[0]
+            self.memory[h] -= vm['memory']
+            self.vcpu[h] -= vm['vcpu']
+
+            datastore = None
+            if vm['disk']:
+                ds = self.mount_ds[self.mount_start[h]:self.mount_start[h + 1]]
+                ds = ds[self.ds_free[ds] >= vm['disk']]
+                if best_fit:
+                    ds = ds[numpy.argmin(self.ds_free[ds])]
+                else:
+                    ds = ds[0]
+                self.use_datastore(ds, vm['disk'])
+                datastore = self.ds_names[ds]
+            placed.append({'guest': vm['name'],
+                           'hypervisor': self.hv_names[h],
+                           'datastore': datastore})
+        return {'placed': placed, 'unplaced': unplaced}
+
+    def free(self):
+        """Return the free memory and vCPU left on the remaining
+        hypervisors as a list of dict"""
+        return [{'hypervisor': self.hv_names[i],
+                 'memory': int(self.memory[i]), 'vcpu': float(self.vcpu[i])}
+                for i in numpy.flatnonzero(self.alive)]
@@ -5,4 +5,6 @@ register = template.Library()
 
 @register.filter
 def percent(value, arg):
+    if not arg:
+        return 0
     return int(100 * value / arg)
\ No newline at end of file
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the import and watch scripts of tools/ are not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'tools'))
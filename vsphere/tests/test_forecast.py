@@ -0,0 +1,106 @@
+from django.test import TestCase
+from django.utils import unittest
+from vsphere.models import CapacitySample
+from vsphere import forecast
+
+numpy = forecast.numpy
+
+
+@unittest.skipIf(numpy is None, 'the forecast requires numpy')
+class FitTrendsTest(TestCase):
+
+    def test_line(self):
+        x = numpy.arange(-29, 1, dtype=float)
+        groups = numpy.zeros(len(x), dtype=int)
+        intercept, slope = forecast.fit_trends(groups, x, 1000 + 10 * x, 1)
+        self.assertAlmostEqual(intercept[0], 1000)
+        self.assertAlmostEqual(slope[0], 10)
+
+    def test_spike(self):
+        x = numpy.arange(-29, 1, dtype=float)
+        groups = numpy.zeros(len(x), dtype=int)
+        for spike in (15, -1):
+            y = 1000 + 10 * x
+            y[spike] += 100000
+            intercept, slope = forecast.fit_trends(groups, x, y, 1)
+            self.assertAlmostEqual(slope[0], 10, places=2)
+            plain = forecast.fit_trends(groups, x, y, 1, robust=False)[1]
+            self.assertTrue(plain[0] > 30)
+
+    def test_groups(self):
+        x = numpy.array([0, 1, 2, 0, 1, 2, 5], dtype=float)
+        y = numpy.array([1, 2, 3, 9, 7, 5, 4], dtype=float)
+        groups = numpy.array([0, 0, 0, 1, 1, 1, 2])
+        intercept, slope = forecast.fit_trends(groups, x, y, 4)
+        self.assertAlmostEqual(slope[0], 1)
+        self.assertAlmostEqual(slope[1], -2)
+        self.assertTrue(numpy.isnan(slope[2]))
+        self.assertTrue(numpy.isnan(slope[3]))
+
+    def test_group_medians(self):
+        groups = numpy.array([1, 0, 1, 0, 0, 1, 1])
+        values = numpy.array([4, 3, 1, 1, 2, 3, 2], dtype=float)
+        medians = forecast.group_medians(groups, values, 3)
+        self.assertEqual(list(medians[:2]), [2, 2.5])
+        self.assertTrue(numpy.isnan(medians[2]))
+
+
+@unittest.skipIf(numpy is None, 'the forecast requires numpy')
+class DaysUntilFullTest(TestCase):
+    now = 1000 * 86400
+
+    def sample(self, entity, day, memory, vcpu=0):
+        CapacitySample.objects.create(
+            kind=CapacitySample.HYPERVISOR, entity=entity,
+            tier=CapacitySample.DAILY, timestamp=self.now + day * 86400,
+            memory=memory, vcpu=vcpu)
+
+    def test_spike(self):
+        for day in range(-29, 1):
+            self.sample(1, day, 1000 + 10 * day + (day == 0 and 100000))
+        days = forecast.days_until_full(
+            CapacitySample.HYPERVISOR, 'memory', {1: 100000}, now=self.now)
+        self.assertAlmostEqual(days[1], 9900, delta=10)
+
+    def test_keys(self):
+        for day in range(-9, 1):
+            self.sample(1, day, 100 + 10 * day)
+            self.sample(2, day, 100 + 20 * day)
+            self.sample(3, day, 500)
+        days = forecast.days_until_full(
+            CapacitySample.HYPERVISOR, 'memory', {'dc': 800, 'flat': 1000},
+            keys={1: 'dc', 2: 'dc', 3: 'flat'}, now=self.now)
+        self.assertAlmostEqual(days['dc'], 20)
+        self.assertEqual(days['flat'], None)
+
+    def test_no_samples(self):
+        days = forecast.days_until_full(
+            CapacitySample.HYPERVISOR, 'memory', {1: 100}, now=self.now)
+        self.assertEqual(days, {1: None})
+
+    def test_by_field(self):
+        for day in range(-9, 1):
+            self.sample(1, day, 100 + 10 * day, 10 + day)
+            self.sample(2, day, 100 + 20 * day, 10)
+        with self.assertNumQueries(1):
+            days = forecast.days_until_full_by_field(
+                CapacitySample.HYPERVISOR,
+                {'memory': {'dc': 800}, 'vcpu': {'dc': 40}},
+                keys={1: 'dc', 2: 'dc'}, all_entities=True, now=self.now)
+        self.assertAlmostEqual(days['memory']['dc'], 20)
+        self.assertAlmostEqual(days['vcpu']['dc'], 20)
+
+    def test_many_entities(self):
+        # more ids than the SQLite variables of a query
+        CapacitySample.objects.bulk_create([CapacitySample(
+            kind=CapacitySample.HYPERVISOR, entity=entity,
+            tier=CapacitySample.DAILY, timestamp=self.now + day * 86400,
+            memory=100 + day) for entity in range(1, 1201)
+            for day in (-1, 0)])
+        capacities = dict((entity, 200) for entity in range(1, 1201))
+        with self.assertNumQueries(3):
+            days = forecast.days_until_full(
+                CapacitySample.HYPERVISOR, 'memory', capacities,
+                now=self.now)
+        self.assertEqual(len(days), 1200)
+        self.assertAlmostEqual(days[1200], 100)
@@ -0,0 +1,449 @@
+from django.test import TestCase
+from django.utils import unittest
+from vsphere.models import Hypervisor, Disk, VirtualNic, Interface
+from vsphere.tests.test_sync import inventory
+import import_hypervisor
+import gzip
+import os
+import tempfile
+import threading
+
+
+class Stub(object):
+    """Object with the attributes it is given, like a pysphere property"""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def managed_object(mor, **props):
+    """Return an item of a property traversal, the __ of the property names
+    standing for dots"""
+    return Stub(Obj=mor, PropSet=[Stub(Name=k.replace('__', '.'), Val=v)
+                                  for k, v in props.items()])
+
+
+def virtual_machine(mor, name, host, pool='resgroup-1', devices=True):
+    disk = Stub(_type='VirtualDisk',
+                deviceInfo=Stub(label='Hard disk 1', summary='10,485,760 KB'),
+                backing=Stub(_type='VirtualDiskFlatVer2BackingInfo',
+                             fileName='[ds1] %s/%s.vmdk' % (name, name),
+                             thinProvisioned=True))
+    nic = Stub(_type='VirtualVmxnet3', macAddress='00:50:56:00:00:01',
+               deviceInfo=Stub(label='Network adapter 1',
+                               summary='VM Network'))
+    return managed_object(
+        mor, name=name, config__hardware__memoryMB=2048,
+        config__hardware__numCPU=2,
+        config__hardware__device=devices and Stub(VirtualDevice=[disk, nic])
+        or None, config__annotation='', config__guestFullName='Linux',
+        runtime__powerState='poweredOn', runtime__host=host,
+        resourcePool=pool)
+
+
+def host_system(mor, name, datastores):
+    summary = Stub(
+        quickStats=Stub(overallMemoryUsage=1024, overallCpuUsage=2600),
+        hardware=Stub(numCpuThreads=32, numCpuCores=16, numCpuPkgs=2,
+                      cpuModel='Intel(R)  Xeon(R)   E5', numHBAs=2,
+                      numNics=2, cpuMhz=2600, memorySize=64 * 1024 ** 3,
+                      vendor='Dell', model='R720'),
+        config=Stub(product=Stub(name='VMware ESXi', version='5.5.0')))
+    network = Stub(
+        pnic=[Stub(device='vmnic0', mac='00:00:00:00:00:01', driver='ixgbe',
+                   linkSpeed=Stub(speedMb=10000)),
+              Stub(device='vmnic1', mac='00:00:00:00:00:02', driver='ixgbe',
+                   spec=Stub(linkSpeed=Stub(speedMb=1000)))],
+        portgroup=[Stub(spec=Stub(name='VM Network', vlanId=0,
+                                  vswitchName='vSwitch0'))],
+        vswitch=[Stub(name='vSwitch0',
+                      spec=Stub(bridge=Stub(nicDevice=['vmnic0',
+                                                       'vmnic1'])))])
+    return managed_object(
+        mor, name=name, summary=summary, config__network=network,
+        datastore=Stub(get_element_ManagedObjectReference=lambda:
+                       datastores))
+
+
+def datastore(mor, name):
+    return managed_object(mor, summary=Stub(
+        name=name, url='ds:///vmfs/volumes/%s/' % name,
+        capacity=1024 ** 4, freeSpace=1024 ** 3))
+
+
+class StubMORTypes(object):
+    Datastore = 'Datastore'
+    HostSystem = 'HostSystem'
+    ResourcePool = 'ResourcePool'
+    VirtualMachine = 'VirtualMachine'
+
+
+class StubVIServer(object):
+    """VIServer answering the property traversals from lists of
+    managed_object indexed by type, datacenters being lists of HostSystem
+    MOR indexed by datacenter name"""
+
+    def __init__(self, objects, datacenters=None):
+        self.objects = objects
+        self.datacenters = datacenters or {}
+        self.traversals = []
+
+    def _retrieve_properties_traversal(self, property_names=[],
+                                       from_node=None,
+                                       obj_type='ManagedEntity'):
+        self.traversals.append(obj_type)
+        results = self.objects.get(obj_type, [])
+        if from_node is not None:
+            results = [r for r in results
+                       if r.Obj in self.datacenters[from_node]]
+        return results
+
+    def get_datacenters(self):
+        return dict((name, name) for name in self.datacenters)
+
+
+class PysphereTestCase(TestCase):
+    """Put stubs in place of the pysphere names of import_hypervisor"""
+
+    def setUp(self):
+        self.pysphere = (import_hypervisor.MORTypes,
+                         import_hypervisor.VIProperty)
+        import_hypervisor.MORTypes = StubMORTypes
+        import_hypervisor.VIProperty = lambda server, value: value
+
+    def tearDown(self):
+        import_hypervisor.MORTypes, import_hypervisor.VIProperty = \
+            self.pysphere
+
+
+class GetGuestsTest(PysphereTestCase):
+
+    def setUp(self):
+        super(GetGuestsTest, self).setUp()
+        self.server = StubVIServer({
+            'VirtualMachine': [
+                virtual_machine('vm-1', 'web1', 'host-1'),
+                virtual_machine('vm-2', 'db1', 'host-2', 'resgroup-2'),
+                virtual_machine('vm-3', 'tpl1', 'host-1', 'resgroup-9',
+                                devices=False)],
+            'ResourcePool': [managed_object('resgroup-1', name='Prod'),
+                             managed_object('resgroup-2', name='Dev')]})
+
+    def test_by_host(self):
+        guests = import_hypervisor.get_guests_by_host(self.server)
+        # one traversal for the guests, one for the pools
+        self.assertEqual(self.server.traversals,
+                         ['VirtualMachine', 'ResourcePool'])
+        self.assertEqual(
+            dict((host, [(g['name'], g['resourcePool']) for g in guests])
+                 for host, guests in guests.items()),
+            {'host-1': [('web1', 'Prod'), ('tpl1', 'Default')],
+             'host-2': [('db1', 'Dev')]})
+        web1, tpl1 = guests['host-1']
+        self.assertEqual((web1['vcpu'], web1['memory'], web1['poweredOn']),
+                         (2, 2048, True))
+        self.assertEqual(web1['disks'], [
+            {'name': 'Hard disk 1', 'size': 10240, 'thin': True,
+             'raw': False, 'filename': '[ds1] web1/web1.vmdk'}])
+        self.assertEqual(web1['vnics'], [
+            {'name': 'Network adapter 1', 'mac': '00:50:56:00:00:01',
+             'type': 'VirtualVmxnet3', 'network': 'VM Network'}])
+        self.assertEqual((tpl1['disks'], tpl1['vnics']), ([], []))
+
+    def test_guests(self):
+        self.assertEqual(sorted(g['name'] for g in
+                                import_hypervisor.get_guests(self.server)),
+                         ['db1', 'tpl1', 'web1'])
+
+    def test_no_guests(self):
+        server = StubVIServer({})
+        self.assertEqual(import_hypervisor.get_guests(server), [])
+        self.assertEqual(server.traversals, ['VirtualMachine'])
+
+
+class HostSnapshotTest(PysphereTestCase):
+
+    def setUp(self):
+        super(HostSnapshotTest, self).setUp()
+        self.server = StubVIServer({
+            'Datastore': [datastore('datastore-1', 'ds1'),
+                          datastore('datastore-2', 'ds2')],
+            'HostSystem': [host_system('host-1', 'esx1', ['datastore-2'])]})
+
+    def test_snapshot(self):
+        snapshot = import_hypervisor.get_host_snapshot(self.server)
+        self.assertEqual(self.server.traversals, ['Datastore', 'HostSystem'])
+        self.assertEqual((snapshot['mor'], snapshot['name']),
+                         ('host-1', 'esx1'))
+        self.assertEqual([ds.name for ds in snapshot['datastores']],
+                         ['ds2'])
+
+    def test_host_dicts(self):
+        # the dicts are derived from the snapshot without more traversals
+        snapshot = import_hypervisor.get_host_snapshot(self.server)
+        hardware = import_hypervisor.get_hardware(self.server, snapshot)
+        networks = import_hypervisor.get_networks(self.server, snapshot)
+        vswitchs = import_hypervisor.get_vswitch(self.server, snapshot)
+        self.assertEqual(len(self.server.traversals), 2)
+        self.assertEqual((hardware['name'], hardware['memorySize'],
+                          hardware['cpuModel'], hardware['productVersion']),
+                         ('esx1', 65536, 'Intel(R) Xeon(R) E5', '5.5.0'))
+        self.assertEqual([(i['name'], i['linkSpeed'])
+                          for i in hardware['interfaces']],
+                         [('vmnic0', 10000), ('vmnic1', 1000)])
+        self.assertEqual(hardware['datastores'], [
+            {'name': 'ds2', 'url': 'ds:///vmfs/volumes/ds2/',
+             'capacity': 1024 ** 2, 'freeSpace': 1024}])
+        self.assertEqual(networks, [{'name': 'VM Network', 'vlanId': 0,
+                                     'vswitchName': 'vSwitch0'}])
+        self.assertEqual(vswitchs, [{'name': 'vSwitch0',
+                                     'nicDevice': ['vmnic0', 'vmnic1']}])
+
+
+class VcenterInventoriesTest(PysphereTestCase):
+
+    def test_inventories(self):
+        server = StubVIServer({
+            'Datastore': [datastore('datastore-1', 'ds1'),
+                          datastore('datastore-2', 'ds2')],
+            'HostSystem': [
+                host_system('host-1', 'esx1', ['datastore-1']),
+                host_system('host-2', 'esx2', ['datastore-1']),
+                host_system('host-3', 'esx3', ['datastore-2'])],
+            'VirtualMachine': [
+                virtual_machine('vm-1', 'web1', 'host-1'),
+                virtual_machine('vm-2', 'web2', 'host-1'),
+                virtual_machine('vm-3', 'db1', 'host-3')],
+            'ResourcePool': [managed_object('resgroup-1', name='Prod')]},
+            datacenters={'DC1': ['host-1', 'host-2'], 'DC2': ['host-3']})
+        metrics = import_hypervisor.ImportMetrics('vcenter')
+        inventories = import_hypervisor.get_vcenter_inventories(server,
+                                                                metrics)
+        self.assertEqual(
+            [(dc, host['hardware']['name'],
+              [ds['name'] for ds in host['hardware']['datastores']],
+              [g['name'] for g in host['guests']])
+             for dc, host in inventories],
+            [('DC1', 'esx1', ['ds1'], ['web1', 'web2']),
+             ('DC1', 'esx2', ['ds1'], []),
+             ('DC2', 'esx3', ['ds2'], ['db1'])])
+        # a traversal per type and per datacenter, not per host
+        self.assertEqual(sorted(server.traversals), [
+            'Datastore', 'HostSystem', 'HostSystem', 'HostSystem',
+            'ResourcePool', 'VirtualMachine'])
+        self.assertEqual([p['phase'] for p in metrics.phases],
+                         ['hardware', 'guests'])
+
+
+class LookupTest(TestCase):
+
+    def test_datastore_name(self):
+        for filename, name in [('[ds1] vm/vm.vmdk', 'ds1'),
+                               (' [shared ds.01] vm/vm_1.vmdk',
+                                'shared ds.01'),
+                               ('vm/vm.vmdk', None), ('', None),
+                               (None, None)]:
+            self.assertEqual(import_hypervisor.get_datastore_name(filename),
+                             name)
+
+    def test_nic_vswitch(self):
+        vswitchs = {'vSwitch0': 'v0', 'vSwitch1': 'v1'}
+        self.assertEqual(import_hypervisor.get_nic_vswitch(
+            [{'name': 'vSwitch0', 'nicDevice': ['vmnic0', 'vmnic1']},
+             {'name': 'vSwitch1', 'nicDevice': ['vmnic2']}], vswitchs),
+            {'vmnic0': 'v0', 'vmnic1': 'v0', 'vmnic2': 'v1'})
+
+    def test_resolve(self):
+        host = inventory('esx1', [('web1', 'Prod')])
+        web1 = host['guests'][0]
+        web1['disks'].append({'name': 'Hard disk 2', 'size': 100,
+                              'thin': False, 'raw': False,
+                              'filename': '[gone] web1/web1_1.vmdk'})
+        web1['disks'].append({'name': 'Hard disk 3', 'size': 100,
+                              'thin': False, 'raw': False,
+                              'filename': '[esx1 local] web1/web1_2.vmdk'})
+        host['hardware']['datastores'][1]['name'] = 'esx1 local'
+        web1['vnics'].append({'name': 'Network adapter 2',
+                              'mac': '00:50:56:00:00:02',
+                              'type': 'VirtualE1000', 'network': 'Backup'})
+        web1['vnics'].append({'name': 'Network adapter 3',
+                              'mac': '00:50:56:00:00:03',
+                              'type': 'VirtualE1000', 'network': 'gone'})
+        import_hypervisor.bulk_create_hypervisor(host, 'DC1', '')
+        # the disks and vNICs of unknown datastores and networks are left
+        self.assertEqual(sorted(Disk.objects.values_list('name',
+                                                         'datastore__name')),
+                         [('Hard disk 1', 'shared'),
+                          ('Hard disk 3', 'esx1 local')])
+        self.assertEqual(sorted(VirtualNic.objects.values_list(
+            'name', 'network__name')), [('Network adapter 1', 'VM Network'),
+                                        ('Network adapter 2', 'Backup')])
+        self.assertEqual(sorted(Interface.objects.values_list(
+            'name', 'vswitch__name')), [('vmnic0', 'vSwitch0'),
+                                        ('vmnic1', 'vSwitch0')])
+
+
+class SnapshotFileTest(TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_round_trip(self):
+        inventories = [('DC1', inventory('esx1', [('web1', 'Prod'),
+                                                  ('db1', 'Dev')])),
+                       ('DC2', inventory('esx2')),
+                       ('DC1', inventory('esx3', [('app1', 'Prod')]))]
+        f = gzip.open(self.filename, 'wb')
+        for datacenter, host in inventories:
+            import_hypervisor.dump_inventory(f, host, datacenter)
+        f.close()
+        # one record per hypervisor and per guest
+        self.assertEqual(len(gzip.open(self.filename).readlines()), 6)
+        loaded = list(import_hypervisor.load_inventories(self.filename))
+        self.assertEqual(loaded, inventories)
+
+    def test_empty(self):
+        gzip.open(self.filename, 'wb').close()
+        self.assertEqual(
+            list(import_hypervisor.load_inventories(self.filename)), [])
+
+
+class StubProxy(object):
+    """SOAP binding answering every call with its name"""
+
+    def __getattr__(self, name):
+        return lambda *args: name
+
+
+class StubServer(object):
+
+    def __init__(self):
+        self._proxy = import_hypervisor.SoapCounter(StubProxy())
+
+
+class ImportMetricsTest(TestCase):
+
+    def test_phases(self):
+        metrics = import_hypervisor.ImportMetrics('esx1')
+        with metrics.phase('connect'):
+            pass
+        metrics.server = StubServer()
+        with metrics.phase('write') as phase:
+            metrics.server._proxy.RetrieveProperties()
+            metrics.server._proxy.RetrieveProperties()
+            Hypervisor.objects.count()
+            phase['rows'] = 3
+        self.assertEqual([(p['phase'], p['soap_calls'], p['queries'],
+                           p['rows']) for p in metrics.phases],
+                         [('connect', 0, 0, 0), ('write', 2, 1, 3)])
+        summary = metrics.summary()
+        self.assertEqual((summary['soap_calls'], summary['rows']), (2, 3))
+
+    @unittest.skipIf(import_hypervisor.VIServer is None,
+                     'the connection requires pysphere')
+    def test_connect(self):
+        def connect(self, host, user, password, sock_timeout=None):
+            self._proxy = StubProxy()
+            self._proxy.RetrieveServiceContent()
+            self._proxy.Login()
+        counting = import_hypervisor.CountingVIServer
+        counting.connect = connect
+        try:
+            metrics = import_hypervisor.ImportMetrics('esx1')
+            with metrics.phase('connect'):
+                import_hypervisor.vmware_connect('esx1', 'user', 'password',
+                                                 metrics=metrics)
+        finally:
+            del counting.connect
+        self.assertEqual(metrics.phases[0]['soap_calls'], 2)
+
+    def test_prometheus(self):
+        metrics = import_hypervisor.ImportMetrics('esx"1\\\n')
+        metrics.phases.append({'phase': 'write', 'seconds': 1.5,
+                               'soap_calls': 0, 'queries': 4, 'rows': 2})
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            import_hypervisor.write_prometheus(filename, [metrics])
+            lines = open(filename).read().splitlines()
+        finally:
+            os.unlink(filename)
+        host = r'esx\"1\\\n'
+        self.assertTrue('vsphere_import_phase_seconds{host="%s",'
+                        'phase="write"} 1.5' % host in lines)
+        self.assertEqual(lines[-1], 'vsphere_import_success{host="%s"} 1'
+                         % host)
+
+
+class ImportHypervisorsTest(TestCase):
+
+    def setUp(self):
+        self.collect_inventory = import_hypervisor.collect_inventory
+        self.release = threading.Event()
+        self.finished = threading.Event()
+        import_hypervisor.collect_inventory = self.collect
+
+    def tearDown(self):
+        import_hypervisor.collect_inventory = self.collect_inventory
+        self.release.set()
+
+    def collect(self, host, user, password, timeout=None, metrics=None):
+        """Fake collect_inventory, bad fails to connect and slow answers
+        once released"""
+        metrics.phases.append({'phase': 'connect'})
+        if host == 'bad':
+            raise IOError('connection refused')
+        if host == 'slow':
+            self.release.wait(10)
+            metrics.phases.append({'phase': 'inventory'})
+            self.finished.set()
+        return inventory(host, [('%s-vm' % host, 'Prod')])
+
+    def write(self, inventory, datacenter, metrics):
+        with metrics.phase('write'):
+            import_hypervisor.bulk_create_hypervisor(inventory, datacenter,
+                                                     '')
+
+    def test_import(self):
+        hosts = [(host, 'DC1', 'user', 'password')
+                 for host in ('esx1', 'bad', 'slow', 'esx2')]
+        metrics = import_hypervisor.import_hypervisors(hosts, self.write,
+                                                       workers=2, timeout=1)
+        self.assertEqual([(m.host, m.success, m.error) for m in metrics], [
+            ('esx1', True, ''), ('bad', False, 'connection refused'),
+            ('slow', False, 'timeout after 1 seconds'), ('esx2', True, '')])
+        self.assertEqual(sorted(Hypervisor.objects.values_list('name',
+                                                               flat=True)),
+                         ['esx1', 'esx2'])
+        self.assertEqual([p['phase'] for p in metrics[0].phases],
+                         ['connect', 'write'])
+        self.assertEqual([p['phase'] for p in metrics[1].phases],
+                         ['connect'])
+        # the worker given up does not report once it is done
+        self.release.set()
+        self.assertTrue(self.finished.wait(10))
+        self.assertEqual(metrics[2].phases, [])
+
+    def test_hosts_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            f = open(filename, 'w')
+            f.write('# hostname datacenter [user]\n'
+                    'esx1 DC1\n\n'
+                    'esx2 DC2 admin  # rack 4\n')
+            f.close()
+            self.assertEqual(import_hypervisor.read_hosts_file(filename),
+                             [('esx1', 'DC1', None),
+                              ('esx2', 'DC2', 'admin')])
+            f = open(filename, 'w')
+            f.write('esx1\n')
+            f.close()
+            self.assertRaises(ValueError, import_hypervisor.read_hosts_file,
+                              filename)
+        finally:
+            os.unlink(filename)
@@ -0,0 +1,268 @@
+from django.contrib import admin
+from django.db import IntegrityError
+from django.test import TestCase
+from django.test.client import RequestFactory
+from vsphere.models import Hypervisor, Guest, Datacenter, CapacitySample
+from vsphere.models import Datastore, Disk, ResourcePool, Vswitch, Interface
+from vsphere.models import update_capacity, record_samples, get_samples
+from vsphere.models import update_resource_pools, update_datacenters
+from vsphere.models import update_datacenter_links
+from vsphere.admin import DatacenterAdmin, CapacitySampleAdmin
+
+
+def hypervisor(name, datacenter='DC1', **kwargs):
+    values = {'numCpuPkgs': 2, 'numCpuThreads': 32, 'memorySize': 65536,
+              'numCpuCores': 16, 'cpuMhz': 2600, 'numHBAs': 2,
+              'numNics': 4}
+    values.update(kwargs)
+    return Hypervisor.objects.create(name=name, datacenter=datacenter,
+                                     **values)
+
+
+def guest(name, hypervisor, memory=1024, vcpu=1, pool='Prod',
+          poweredOn=True):
+    return Guest.objects.create(name=name, hypervisor=hypervisor,
+                                memory=memory, vcpu=vcpu, resourcePool=pool,
+                                poweredOn=poweredOn)
+
+
+class CapacityTest(TestCase):
+
+    def setUp(self):
+        self.esx1 = hypervisor('esx1')
+        self.esx2 = hypervisor('esx2')
+        self.shared = Datastore.objects.create(name='shared', url='ds:///1/',
+                                               capacity=1000)
+        self.shared.hypervisors.add(self.esx1, self.esx2)
+        local = Datastore.objects.create(name='local', url='ds:///2/',
+                                         capacity=500)
+        local.hypervisors.add(self.esx1)
+        web1 = guest('web1', self.esx1, memory=2048, vcpu=2)
+        db1 = guest('db1', self.esx1, memory=4096, vcpu=4)
+        guest('app1', self.esx2)
+        for name, size, ds, raw, g in [
+                ('Hard disk 1', 100, self.shared, False, web1),
+                ('Hard disk 2', 50, local, False, web1),
+                ('Hard disk 1', 200, self.shared, False, db1),
+                ('Hard disk 2', 300, None, True, db1),
+                ('Hard disk 3', 70, None, False, db1)]:
+            Disk.objects.create(name=name, size=size, datastore=ds, raw=raw,
+                                guest=g)
+
+    def rollups(self, name):
+        return Hypervisor.objects.filter(name=name).values_list(
+            'numGuests', 'datastoresSize', 'memoryReserved', 'vcpuReserved',
+            'diskReserved', 'rawDiskReserved')[0]
+
+    def test_rollups(self):
+        self.assertTrue(update_capacity() > 0)
+        # the disks without datastore are neither reserved nor raw
+        self.assertEqual(self.rollups('esx1'), (2, 1500, 6144, 6, 350, 300))
+        self.assertEqual(self.rollups('esx2'), (1, 1000, 1024, 1, 0, 0))
+        self.assertEqual(
+            sorted(Datastore.objects.values_list('name', 'reserved',
+                                                 'numGuests')),
+            [('local', 50, 1), ('shared', 300, 2)])
+        self.assertEqual(update_capacity(), 0)
+
+    def test_some(self):
+        update_capacity()
+        Guest.objects.filter(name='app1').update(memory=8192)
+        Disk.objects.filter(size=100).update(size=400)
+        # only the hypervisors given and their datastores are recomputed
+        self.assertEqual(update_capacity([self.esx1.id]), 2)
+        self.assertEqual(self.rollups('esx1')[4], 650)
+        self.assertEqual(self.rollups('esx2')[2], 1024)
+        self.assertEqual(Datastore.objects.get(name='shared').reserved, 600)
+        self.assertEqual(update_capacity([self.esx2.id]), 1)
+        self.assertEqual(self.rollups('esx2')[2], 8192)
+
+    def test_unmounted(self):
+        update_capacity()
+        self.shared.hypervisors.clear()
+        Disk.objects.filter(datastore=self.shared).delete()
+        self.assertEqual(update_capacity([], [self.shared.id]), 1)
+        self.assertEqual(Datastore.objects.get(name='shared').reserved, 0)
+
+    def test_with_capacity(self):
+        getters = ['get_number_guest', 'get_datastores_size',
+                   'get_mem_reserved', 'get_disk_reserved',
+                   'get_vcpu_reserved', 'get_raw_disk_reserved']
+        expected = [[getattr(hv, g)() for g in getters]
+                    for hv in Hypervisor.objects.order_by('name')]
+        self.assertEqual(expected, [[2, 1500, 6144, 350, 6, 300],
+                                    [1, 1000, 1024, 0, 1, 0]])
+        hypervisors = list(Hypervisor.objects.with_capacity().order_by('name'))
+        with self.assertNumQueries(0):
+            self.assertEqual([[getattr(hv, g)() for g in getters]
+                              for hv in hypervisors], expected)
+
+    def test_with_disk_totals(self):
+        expected = [(g.name, g.get_disk_reserved(), g.get_disk_reserved(False))
+                    for g in Guest.objects.order_by('name')]
+        self.assertEqual(expected, [('app1', 0, 0), ('db1', 570, 270),
+                                    ('web1', 150, 150)])
+        guests = list(Guest.objects.with_disk_totals().order_by('name'))
+        with self.assertNumQueries(0):
+            self.assertEqual([(g.name, g.get_disk_reserved(),
+                               g.get_disk_reserved(False)) for g in guests],
+                             expected)
+
+    def test_with_usage(self):
+        datastores = list(Datastore.objects.with_usage().order_by('name'))
+        with self.assertNumQueries(0):
+            self.assertEqual([(ds.name, ds.get_reserved(), ds.guests_count)
+                              for ds in datastores],
+                             [('local', 50, 1), ('shared', 300, 2)])
+        self.assertEqual([ds.get_reserved() for ds in
+                          Datastore.objects.order_by('name')], [50, 300])
+
+    def test_by_free_capacity(self):
+        update_capacity()
+        hypervisors = list(Hypervisor.objects.by_free_capacity())
+        # esx2 has the most free memory
+        self.assertEqual([(hv.name, hv.memory_free, hv.storage_free)
+                          for hv in hypervisors],
+                         [('esx2', 64512, 1000), ('esx1', 59392, 1150)])
+
+
+class ResourcePoolTest(TestCase):
+
+    def test_update_resource_pools(self):
+        # guests imported before the ResourcePool model have no pool
+        esx1 = hypervisor('esx1')
+        esx2 = hypervisor('esx2', datacenter='DC2')
+        prod = ResourcePool.objects.create(name='Prod', datacenter='DC1')
+        guest('web1', esx1)
+        guest('web2', esx1)
+        guest('db1', esx1, pool='Dev')
+        guest('web3', esx2)
+        self.assertEqual(update_resource_pools(), 4)
+        self.assertEqual(
+            sorted(Guest.objects.values_list('name', 'pool__datacenter',
+                                             'pool__name')),
+            [('db1', 'DC1', 'Dev'), ('web1', 'DC1', 'Prod'),
+             ('web2', 'DC1', 'Prod'), ('web3', 'DC2', 'Prod')])
+        self.assertEqual(Guest.objects.get(name='web1').pool_id, prod.id)
+        self.assertEqual(update_resource_pools(), 0)
+
+    def test_unique(self):
+        ResourcePool.objects.create(name='Prod', datacenter='DC1')
+        ResourcePool.objects.create(name='Prod', datacenter='DC2')
+        self.assertRaises(IntegrityError, ResourcePool.objects.create,
+                          name='Prod', datacenter='DC1')
+
+
+class DatacenterTest(TestCase):
+
+    def setUp(self):
+        esx1 = hypervisor('esx1', productVersion='5.5.0')
+        esx2 = hypervisor('esx2', productVersion='6.0.0')
+        esx3 = hypervisor('esx3', datacenter='DC2', productVersion='5.5.0')
+        shared = Datastore.objects.create(name='shared', url='ds:///1/',
+                                          capacity=1000)
+        shared.hypervisors.add(esx1, esx2)
+        local = Datastore.objects.create(name='local', url='ds:///2/',
+                                         capacity=500)
+        local.hypervisors.add(esx3)
+        guest('web1', esx1, memory=2048)
+        guest('web2', esx3)
+        for hv, speeds in [(esx1, (10000, 10000)), (esx2, (1000, 0)),
+                           (esx3, (10000,))]:
+            vswitch = Vswitch.objects.create(name='vSwitch0', hypervisor=hv)
+            for i, speed in enumerate(speeds):
+                Interface.objects.create(name='vmnic%d' % i, linkSpeed=speed,
+                                         vswitch=vswitch, hypervisor=hv)
+        # a nic without vSwitch is left out of the histogram
+        Interface.objects.create(name='vmnic9', linkSpeed=100,
+                                 hypervisor=esx1)
+        self.assertEqual(update_datacenter_links(), 3)
+        update_capacity()
+
+    def test_links(self):
+        self.assertEqual(dict(Hypervisor.objects.values_list('name',
+                                                             'dc__name')),
+                         {'esx1': 'DC1', 'esx2': 'DC1', 'esx3': 'DC2'})
+        self.assertEqual(update_datacenter_links(), 0)
+
+    def test_totals(self):
+        self.assertEqual(update_datacenters(), 2)
+        dc1 = Datacenter.objects.get(name='DC1')
+        # the shared datastore is counted once
+        self.assertEqual((dc1.numHypervisors, dc1.numCpuThreads,
+                          dc1.memorySize, dc1.datastoresSize, dc1.numGuests,
+                          dc1.memoryReserved, dc1.vcpuReserved),
+                         (2, 64, 131072, 1000, 1, 2048, 1))
+        self.assertEqual(dc1.get_esxi_versions(), {'5.5.0': 1, '6.0.0': 1})
+        self.assertEqual(dc1.get_link_speeds(), {10000: 2, 1000: 1, 0: 1})
+        dc2 = Datacenter.objects.get(name='DC2')
+        self.assertEqual((dc2.numHypervisors, dc2.datastoresSize,
+                          dc2.numGuests), (1, 500, 1))
+        self.assertEqual(dc2.get_link_speeds(), {10000: 1})
+        self.assertEqual(update_datacenters(), 0)
+
+    def test_empty(self):
+        update_datacenters()
+        Hypervisor.objects.filter(name='esx3').delete()
+        self.assertEqual(update_datacenters(), 1)
+        self.assertEqual(list(Datacenter.objects.values_list('name',
+                                                             flat=True)),
+                         ['DC1'])
+
+
+class CapacitySampleTest(TestCase):
+
+    def setUp(self):
+        self.esx1 = hypervisor('esx1')
+        self.web1 = guest('web1', self.esx1)
+        update_capacity()
+
+    def samples(self, tier):
+        return list(CapacitySample.objects.filter(
+            kind=CapacitySample.HYPERVISOR, entity=self.esx1.id,
+            tier=tier).order_by('timestamp').values_list('timestamp',
+                                                         'memory'))
+
+    def test_tiers(self):
+        day = 86400 * 100
+        self.assertEqual(record_samples(timestamp=day + 60), 3)
+        self.web1.memory = 3072
+        self.web1.save()
+        update_capacity()
+        record_samples(timestamp=day + 120)
+        record_samples(timestamp=day + 3600)
+        self.assertEqual(self.samples(CapacitySample.RAW),
+                         [(day + 60, 1024), (day + 120, 3072),
+                          (day + 3600, 3072)])
+        # the coarser buckets hold the mean of their raw samples
+        self.assertEqual(self.samples(CapacitySample.HOURLY),
+                         [(day, 2048), (day + 3600, 3072)])
+        self.assertEqual(self.samples(CapacitySample.DAILY),
+                         [(day, 2389)])
+
+    def test_retention(self):
+        record_samples(timestamp=1000)
+        record_samples(timestamp=1000 + 3 * 86400)
+        self.assertEqual(self.samples(CapacitySample.RAW),
+                         [(1000 + 3 * 86400, 1024)])
+        self.assertEqual(len(self.samples(CapacitySample.HOURLY)), 2)
+
+    def test_get_samples(self):
+        for timestamp in (1000, 2000, 3000):
+            record_samples([self.esx1.id], timestamp)
+        samples = get_samples(CapacitySample.HYPERVISOR, self.esx1.id,
+                              1500, 3000, tier=CapacitySample.RAW)
+        self.assertEqual(samples['timestamp'], [2000, 3000])
+        self.assertEqual(samples['memory'], [1024, 1024])
+        self.assertEqual(samples['guests'], [1, 1])
+        samples = get_samples(CapacitySample.HYPERVISOR, self.esx1.id,
+                              5000, tier=CapacitySample.RAW)
+        self.assertEqual(samples['timestamp'], [])
+
+    def test_admin(self):
+        request = RequestFactory().get('/')
+        for model, model_admin in [(Datacenter, DatacenterAdmin),
+                                   (CapacitySample, CapacitySampleAdmin)]:
+            model_admin = model_admin(model, admin.site)
+            self.assertFalse(model_admin.has_add_permission(request))
+            self.assertFalse(model_admin.save_as)
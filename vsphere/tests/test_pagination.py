@@ -0,0 +1,146 @@
+from django.test import TestCase
+from vsphere.models import Hypervisor, Guest
+from vsphere.pagination import CursorPage, encode_cursor, decode_cursor
+import base64
+import json
+import re
+import urlparse
+
+
+class CursorTest(TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor('next', [u'web1', 12])
+        self.assertEqual(decode_cursor(cursor, ('name', 'id')),
+                         ('next', [u'web1', 12]))
+
+    def test_bad_cursor(self):
+        keys = ('name', 'id')
+        for cursor in ['garbage', '!!!', u'\xe9',
+                       base64.urlsafe_b64encode('not json'),
+                       base64.urlsafe_b64encode(json.dumps({'a': 1})),
+                       encode_cursor('next', ['web1']),
+                       encode_cursor('up', ['web1', 12]),
+                       encode_cursor('next', [['web1'], 12]),
+                       encode_cursor('next', ['web1', {'id': 12}]),
+                       encode_cursor('next', ['web1', None])]:
+            self.assertRaises(ValueError, decode_cursor, cursor, keys)
+
+
+class CursorPageTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        hypervisor = Hypervisor.objects.create(
+            name='esx1', numCpuPkgs=2, numCpuThreads=32, memorySize=65536,
+            numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+            datacenter='DC1')
+        for i in range(7):
+            Guest.objects.create(name='vm%d' % i, poweredOn=True, vcpu=1,
+                                 memory=1024, resourcePool='Prod',
+                                 hypervisor=hypervisor)
+
+    def names(self, page):
+        return [g.name for g in page]
+
+    def test_forward_and_back(self):
+        queryset = Guest.objects.all()
+        page = CursorPage(queryset, size=3)
+        self.assertEqual(self.names(page), ['vm0', 'vm1', 'vm2'])
+        self.assertFalse(page.has_previous)
+        self.assertEqual(page.previous_cursor(), None)
+
+        pages = [page]
+        while page.has_next:
+            page = CursorPage(queryset, page.next_cursor(), size=3)
+            pages.append(page)
+        self.assertEqual([self.names(p) for p in pages],
+                         [['vm0', 'vm1', 'vm2'], ['vm3', 'vm4', 'vm5'],
+                          ['vm6']])
+        self.assertTrue(page.has_previous)
+        self.assertEqual(page.next_cursor(), None)
+
+        back = [page]
+        while page.has_previous:
+            page = CursorPage(queryset, page.previous_cursor(), size=3)
+            back.append(page)
+        self.assertEqual([self.names(p) for p in reversed(back)],
+                         [self.names(p) for p in pages])
+
+    def test_ties(self):
+        # the id breaks the ties of the first key
+        queryset = Guest.objects.all()
+        page = CursorPage(queryset, size=3, keys=('poweredOn', 'id'))
+        seen = []
+        while True:
+            seen.extend(g.id for g in page)
+            if not page.has_next:
+                break
+            page = CursorPage(queryset, page.next_cursor(), size=3,
+                              keys=('poweredOn', 'id'))
+        self.assertEqual(seen, sorted(Guest.objects.values_list('id',
+                                                                flat=True)))
+
+    def test_values_list(self):
+        queryset = Guest.objects.values_list('name', flat=True)
+        page = CursorPage(queryset, size=4, keys=('name',))
+        self.assertEqual(list(page), ['vm0', 'vm1', 'vm2', 'vm3'])
+        page = CursorPage(queryset, page.next_cursor(), size=4,
+                          keys=('name',))
+        self.assertEqual(list(page), ['vm4', 'vm5', 'vm6'])
+        self.assertFalse(page.has_next)
+
+    def test_total(self):
+        page = CursorPage(Guest.objects.all(), size=3, total=True)
+        self.assertEqual(page.total, 7)
+        self.assertEqual(CursorPage(Guest.objects.all(), size=3).total, None)
+
+    def test_bad_cursor(self):
+        self.assertRaises(ValueError, CursorPage, Guest.objects.all(),
+                          'garbage')
+        # the pages fall back to the first page, the API answers 400
+        response = self.client.get('/guests', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(response.context['guest_list']),
+                         ['vm%d' % i for i in range(7)])
+        response = self.client.get('/api/v1/guest/', {'cursor': 'garbage',
+                                                      'format': 'json'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_key(self):
+        cursor = encode_cursor('next', [['vm1'], 1])
+        response = self.client.get('/guests', {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['guest_list']), 7)
+        response = self.client.get('/api/v1/guest/', {'cursor': cursor,
+                                                      'format': 'json'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_links(self):
+        for i in range(7, 30):
+            Guest.objects.create(name='vm%d' % i, poweredOn=True, vcpu=1,
+                                 memory=1024, resourcePool='Prod',
+                                 hypervisor=Hypervisor.objects.get())
+        response = self.client.get('/guests', {'cursor': '', 'total': '',
+                                               'q': 'a b'})
+        page = response.context['guest_list']
+        link = re.search(r'href="\?([^"]*)" class="next"',
+                         response.content).group(1)
+        self.assertEqual(urlparse.parse_qs(link.replace('&amp;', '&'),
+                                           keep_blank_values=True),
+                         {'q': ['a b'], 'total': [''],
+                          'cursor': [page.next_cursor()]})
+
+    def test_api(self):
+        response = self.client.get('/api/v1/guest/', {'cursor': '',
+                                                      'limit': 5,
+                                                      'format': 'json'})
+        data = json.loads(response.content)
+        self.assertEqual([g['name'] for g in data['objects']],
+                         ['vm0', 'vm1', 'vm2', 'vm3', 'vm4'])
+        self.assertEqual(data['meta']['previous'], None)
+        response = self.client.get(data['meta']['next'])
+        data = json.loads(response.content)
+        self.assertEqual([g['name'] for g in data['objects']],
+                         ['vm5', 'vm6'])
+        self.assertEqual(data['meta']['next'], None)
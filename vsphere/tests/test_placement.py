@@ -0,0 +1,121 @@
+from django.test import TestCase
+from django.utils import unittest
+from vsphere.models import Hypervisor, Datastore, Guest, Disk
+from vsphere.placement import Simulation, new_guests
+from vsphere import placement
+
+
+class NewGuestsTest(TestCase):
+
+    def test_spec(self):
+        self.assertEqual(new_guests('2:4096:2:10240', 'web'), [
+            {'name': 'web-1', 'memory': 4096, 'vcpu': 2, 'disk': 10240,
+             'datastores': ()},
+            {'name': 'web-2', 'memory': 4096, 'vcpu': 2, 'disk': 10240,
+             'datastores': ()}])
+
+    def test_bad_spec(self):
+        self.assertRaises(ValueError, new_guests, '2:4096:2')
+        self.assertRaises(ValueError, new_guests, '2:4G:2:10')
+
+
+@unittest.skipIf(placement.numpy is None, 'the simulator requires numpy')
+class SimulationTest(TestCase):
+
+    def setUp(self):
+        # free memory: esx1 8192, esx2 4096, esx3 16384 in DC2
+        hypervisors = {}
+        for name, dc, memory, reserved in [('esx1', 'DC1', 65536, 57344),
+                                           ('esx2', 'DC1', 65536, 61440),
+                                           ('esx3', 'DC2', 65536, 49152)]:
+            hypervisors[name] = Hypervisor.objects.create(
+                name=name, datacenter=dc, memorySize=memory,
+                memoryReserved=reserved, numCpuPkgs=1, numCpuThreads=4,
+                vcpuReserved=8, numCpuCores=4, cpuMhz=2600, numHBAs=1,
+                numNics=2)
+        # free space: shared 30000, big 50000, local 20000
+        for name, capacity, reserved, hosts in [
+                ('shared', 100000, 70000, ['esx1', 'esx2']),
+                ('big', 60000, 10000, ['esx1']),
+                ('local', 20000, 0, ['esx2'])]:
+            ds = Datastore.objects.create(name=name, url='ds:///%s/' % name,
+                                          capacity=capacity,
+                                          reserved=reserved)
+            for h in hosts:
+                ds.hypervisors.add(hypervisors[h])
+        for name, memory, datastore in [('web1', 2048, 'local'),
+                                        ('db1', 4096, 'shared')]:
+            g = Guest.objects.create(
+                name=name, poweredOn=True, vcpu=2, memory=memory,
+                resourcePool='Prod', hypervisor=hypervisors['esx2'])
+            Disk.objects.create(name='Hard disk 1', size=1000, guest=g,
+                                datastore=Datastore.objects.get(
+                                    name=datastore))
+
+    def plan(self, plan):
+        return [(p['guest'], p['hypervisor'], p['datastore'])
+                for p in plan['placed']]
+
+    def test_datacenter(self):
+        simulation = Simulation('DC1')
+        self.assertEqual(simulation.hv_names, ['esx1', 'esx2'])
+        self.assertEqual(list(simulation.ds_best), [50000, 30000])
+        self.assertEqual(simulation.free(), [
+            {'hypervisor': 'esx1', 'memory': 8192, 'vcpu': 8.0},
+            {'hypervisor': 'esx2', 'memory': 4096, 'vcpu': 8.0}])
+
+    def test_first_fit(self):
+        simulation = Simulation('DC1')
+        plan = simulation.place(new_guests('3:2048:1:10000'))
+        self.assertEqual(self.plan(plan), [
+            ('new-1', 'esx1', 'shared'), ('new-2', 'esx1', 'shared'),
+            ('new-3', 'esx1', 'shared')])
+        self.assertEqual(dict(zip(simulation.ds_names, simulation.ds_free)),
+                         {'shared': 0, 'big': 50000, 'local': 20000})
+        self.assertEqual(list(simulation.ds_best), [50000, 20000])
+
+    def test_best_fit(self):
+        simulation = Simulation('DC1')
+        plan = simulation.place(new_guests('3:2048:1:10000'), best_fit=True)
+        # esx2 has the least free memory, then local the least free space
+        self.assertEqual(self.plan(plan), [
+            ('new-1', 'esx2', 'local'), ('new-2', 'esx2', 'local'),
+            ('new-3', 'esx1', 'shared')])
+        self.assertEqual(simulation.free()[1]['memory'], 0)
+
+    def test_largest_first(self):
+        simulation = Simulation('DC1')
+        plan = simulation.place(new_guests('1:1024:1:0', 'small') +
+                                new_guests('1:8192:1:0', 'large'))
+        self.assertEqual(self.plan(plan), [('large-1', 'esx1', None),
+                                           ('small-1', 'esx2', None)])
+
+    def test_unplaced(self):
+        simulation = Simulation('DC1')
+        guests = (new_guests('1:16384:1:0', 'memory') +
+                  new_guests('2:1024:9:0', 'vcpu') +
+                  new_guests('1:1024:1:60000', 'disk') +
+                  new_guests('1:1024:1:0', 'fits'))
+        plan = simulation.place(guests)
+        self.assertEqual(sorted(plan['unplaced']),
+                         ['disk-1', 'memory-1', 'vcpu-1', 'vcpu-2'])
+        self.assertEqual(self.plan(plan), [('fits-1', 'esx1', None)])
+
+    def test_consolidation(self):
+        simulation = Simulation('DC1', consolidation=8)
+        plan = simulation.place(new_guests('2:1024:20:0'))
+        self.assertEqual(self.plan(plan), [('new-1', 'esx1', None),
+                                           ('new-2', 'esx2', None)])
+
+    def test_evacuate(self):
+        simulation = Simulation()
+        guests = simulation.evacuate(['esx2'])
+        self.assertEqual([(g['name'], g['memory'], len(g['datastores']))
+                          for g in guests], [('db1', 4096, 1),
+                                             ('web1', 2048, 1)])
+        plan = simulation.place(guests)
+        # local is only mounted on esx2, db1 needs a host mounting shared
+        self.assertEqual(self.plan(plan), [('db1', 'esx1', None)])
+        self.assertEqual(plan['unplaced'], ['web1'])
+        self.assertEqual([h['hypervisor'] for h in simulation.free()],
+                         ['esx1', 'esx3'])
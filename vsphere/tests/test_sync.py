@@ -0,0 +1,280 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from vsphere.models import Hypervisor, Datastore, Guest, Disk, VirtualNic
+from vsphere.models import Network, ResourcePool, CapacitySample
+from import_hypervisor import sync_objects, sync_hypervisor
+from import_hypervisor import bulk_create_hypervisor, ImportMetrics
+from import_hypervisor import sync_datastores, create_datastore
+import copy
+
+
+def inventory(name, guests=()):
+    """Return an inventory like get_inventory of a host with two
+    datastores, one shared, one vSwitch and two port groups"""
+    return {
+        'hardware': {
+            'name': name, 'memorySize': 65536, 'cpuModel': 'Xeon',
+            'vendor': 'Dell', 'numCpuPkgs': 2, 'numCpuCores': 16,
+            'numCpuThreads': 32, 'productName': 'VMware ESXi',
+            'productVersion': '5.5.0', 'numNics': 2, 'numHBAs': 2,
+            'model': 'R720', 'cpuMhz': 2600,
+            'interfaces': [
+                {'name': 'vmnic0', 'mac': '00:00:00:00:00:01',
+                 'driver': 'ixgbe', 'linkSpeed': 10000},
+                {'name': 'vmnic1', 'mac': '00:00:00:00:00:02',
+                 'driver': 'ixgbe', 'linkSpeed': 10000}],
+            'datastores': [
+                {'name': 'shared', 'url': 'ds:///shared/',
+                 'capacity': 100000},
+                {'name': 'local', 'url': 'ds:///%s/' % name,
+                 'capacity': 50000}]},
+        'vswitchs': [{'name': 'vSwitch0', 'nicDevice': ['vmnic0',
+                                                        'vmnic1']}],
+        'networks': [
+            {'name': 'VM Network', 'vlanId': 0, 'vswitchName': 'vSwitch0'},
+            {'name': 'Backup', 'vlanId': 20, 'vswitchName': 'vSwitch0'}],
+        'guests': [guest(g, pool) for g, pool in guests],
+    }
+
+
+def guest(name, pool='Prod'):
+    return {'name': name, 'vcpu': 2, 'memory': 2048, 'poweredOn': True,
+            'resourcePool': pool, 'annotation': '', 'osVersion': 'Linux',
+            'disks': [{'name': 'Hard disk 1', 'size': 10240, 'thin': False,
+                       'raw': False,
+                       'filename': '[shared] %s/%s.vmdk' % (name, name)}],
+            'vnics': [{'name': 'Network adapter 1',
+                       'mac': '00:50:56:00:00:01',
+                       'type': 'VirtualVmxnet3', 'network': 'VM Network'}]}
+
+
+class BulkCreateHypervisorTest(TestCase):
+
+    def test_create(self):
+        hypervisor = bulk_create_hypervisor(
+            inventory('esx1', [('web1', 'Prod'), ('db1', 'Dev')]), 'DC1',
+            'rack 4')
+        hypervisor = Hypervisor.objects.get(id=hypervisor.id)
+        self.assertEqual((hypervisor.annotation, hypervisor.dc.name),
+                         ('rack 4', 'DC1'))
+        self.assertEqual((hypervisor.numGuests, hypervisor.memoryReserved,
+                          hypervisor.datastoresSize), (2, 4096, 150000))
+        self.assertEqual(
+            sorted(Disk.objects.values_list('guest__name',
+                                            'datastore__name')),
+            [('db1', 'shared'), ('web1', 'shared')])
+        self.assertEqual(
+            sorted(VirtualNic.objects.values_list('guest__name',
+                                                  'network__name')),
+            [('db1', 'VM Network'), ('web1', 'VM Network')])
+        self.assertEqual(sorted(ResourcePool.objects.values_list(
+            'name', flat=True)), ['Dev', 'Prod'])
+        self.assertTrue(CapacitySample.objects.filter(
+            kind=CapacitySample.HYPERVISOR, entity=hypervisor.id).exists())
+
+    def test_duplicates(self):
+        bulk_create_hypervisor(inventory('esx1', [('web1', 'Prod')]), 'DC1',
+                               '')
+        self.assertRaises(ValidationError, bulk_create_hypervisor,
+                          inventory('esx1'), 'DC1', '')
+        self.assertRaises(ValidationError, bulk_create_hypervisor,
+                          inventory('esx2', [('web1', 'Prod')]), 'DC1', '')
+        # nothing of the rejected hypervisors is written
+        self.assertEqual(list(Hypervisor.objects.values_list('name',
+                                                             flat=True)),
+                         ['esx1'])
+        self.assertEqual(Guest.objects.count(), 1)
+
+    def test_queries(self):
+        # one batch per model whatever the number of guests, once the
+        # datacenter, pool and shared datastore exist
+        queries = []
+        for name, count in (('esx0', 1), ('esx1', 2), ('esx2', 20)):
+            guests = [('%s-vm%d' % (name, i), 'Prod') for i in range(count)]
+            metrics = ImportMetrics(name)
+            bulk_create_hypervisor(inventory(name, guests), 'DC1', '',
+                                   metrics)
+            queries.append(metrics.summary()['queries'])
+        self.assertEqual(queries[1], queries[2])
+        self.assertEqual(Disk.objects.count(), 23)
+
+
+class SharedDatastoreTest(TestCase):
+
+    def mounts(self):
+        return sorted(Datastore.objects.values_list('url',
+                                                    'hypervisors__name'))
+
+    def test_bulk(self):
+        bulk_create_hypervisor(inventory('esx1', [('web1', 'Prod')]), 'DC1',
+                               '')
+        bulk_create_hypervisor(inventory('esx2', [('web2', 'Prod')]), 'DC1',
+                               '')
+        # one row per url, the guests of both hosts share it
+        self.assertEqual(self.mounts(), [
+            ('ds:///esx1/', 'esx1'), ('ds:///esx2/', 'esx2'),
+            ('ds:///shared/', 'esx1'), ('ds:///shared/', 'esx2')])
+        shared = Datastore.objects.get(url='ds:///shared/')
+        self.assertEqual((shared.numGuests, shared.reserved), (2, 20480))
+        self.assertEqual(Datastore.objects.get(url='ds:///esx1/').numGuests,
+                         0)
+
+    def test_sync(self):
+        esx1 = bulk_create_hypervisor(inventory('esx1'), 'DC1', '')
+        esx2 = bulk_create_hypervisor(inventory('esx2'), 'DC1', '')
+        datastores = [{'name': 'shared', 'url': 'ds:///shared/',
+                       'capacity': 200000},
+                      {'name': 'new', 'url': 'ds:///new/', 'capacity': 10}]
+        rows, mounted = sync_datastores(esx1, datastores)
+        # the local datastore of esx1 is deleted, shared is resized
+        self.assertEqual(rows, (1, 1, 1))
+        self.assertEqual(sorted(mounted), ['new', 'shared'])
+        self.assertEqual(self.mounts(), [
+            ('ds:///esx2/', 'esx2'), ('ds:///new/', 'esx1'),
+            ('ds:///shared/', 'esx1'), ('ds:///shared/', 'esx2')])
+        self.assertEqual(Datastore.objects.get(url='ds:///shared/').capacity,
+                         200000)
+        rows, mounted = sync_datastores(esx2, [])
+        self.assertEqual(rows, (0, 0, 1))
+        self.assertEqual(self.mounts(), [
+            ('ds:///new/', 'esx1'), ('ds:///shared/', 'esx1')])
+
+    def test_without_url(self):
+        # inventories recorded without url are not shared by name
+        esx1 = bulk_create_hypervisor(inventory('esx1'), 'DC1', '')
+        esx2 = bulk_create_hypervisor(inventory('esx2'), 'DC1', '')
+        for hv in (esx1, esx2):
+            sync_datastores(hv, [{'name': 'nfs', 'capacity': 10}])
+        create_datastore({'name': 'iso', 'capacity': 20}, esx1)
+        self.assertEqual(self.mounts(), [
+            ('esx1:iso', 'esx1'), ('esx1:nfs', 'esx1'),
+            ('esx2:nfs', 'esx2')])
+
+
+class SyncObjectsTest(TestCase):
+
+    def test_diff(self):
+        for name in ('same', 'changed', 'gone'):
+            ResourcePool.objects.create(name=name, datacenter='DC1')
+        existing = dict((p.name, p) for p in ResourcePool.objects.all())
+        wanted = dict((name, ResourcePool(name=name, datacenter=dc))
+                      for name, dc in [('same', 'DC1'), ('changed', 'DC2'),
+                                       ('new', 'DC1')])
+        self.assertEqual(sync_objects(ResourcePool, existing, wanted),
+                         (1, 1, 1))
+        self.assertEqual(sorted(ResourcePool.objects.values_list(
+            'name', 'datacenter')), [('changed', 'DC2'), ('new', 'DC1'),
+                                     ('same', 'DC1')])
+        self.assertEqual(ResourcePool.objects.get(name='same').id,
+                         existing['same'].id)
+
+    def test_unchanged(self):
+        ResourcePool.objects.create(name='same', datacenter='DC1')
+        existing = dict((p.name, p) for p in ResourcePool.objects.all())
+        wanted = {'same': ResourcePool(name='same', datacenter='DC1')}
+        with self.assertNumQueries(0):
+            self.assertEqual(sync_objects(ResourcePool, existing, wanted),
+                             (0, 0, 0))
+
+
+class SyncHypervisorTest(TestCase):
+
+    def setUp(self):
+        self.inventory = inventory('esx1', [('web1', 'Prod'),
+                                            ('db1', 'Dev')])
+        self.stats = sync_hypervisor(self.inventory, 'DC1', '')
+
+    def sync(self, inventory):
+        """Sync and return the stats of the models which changed"""
+        stats = sync_hypervisor(inventory, 'DC1', '')
+        return dict((k, v) for k, v in stats.items() if any(v))
+
+    def test_create(self):
+        self.assertEqual(self.stats['Hypervisor'], (1, 0, 0))
+        self.assertEqual(self.stats['Datastore'], (2, 0, 0))
+        self.assertEqual(self.stats['Guest'], (2, 0, 0))
+        self.assertEqual(self.stats['Disk'], (2, 0, 0))
+        self.assertEqual(self.stats['VirtualNic'], (2, 0, 0))
+        self.assertEqual(self.stats['ResourcePool'], (2, 0, 0))
+        hypervisor = Hypervisor.objects.get(name='esx1')
+        self.assertEqual(hypervisor.numGuests, 2)
+        self.assertEqual(hypervisor.memoryReserved, 4096)
+        self.assertEqual(hypervisor.dc.name, 'DC1')
+        self.assertEqual(Guest.objects.get(name='db1').pool.name, 'Dev')
+
+    def test_unchanged(self):
+        self.assertEqual(self.sync(self.inventory), {})
+
+    def test_update(self):
+        new = copy.deepcopy(self.inventory)
+        new['hardware']['memorySize'] = 131072
+        new['guests'][0]['memory'] = 4096
+        new['guests'][0]['disks'][0]['size'] = 20480
+        new['networks'][1]['vlanId'] = 30
+        self.assertEqual(self.sync(new), {
+            'Hypervisor': (0, 1, 0), 'Guest': (0, 1, 0), 'Disk': (0, 1, 0),
+            'Network': (0, 1, 0)})
+        hypervisor = Hypervisor.objects.get(name='esx1')
+        self.assertEqual(hypervisor.memorySize, 131072)
+        self.assertEqual(hypervisor.memoryReserved, 6144)
+        self.assertEqual(Disk.objects.get(guest__name='web1').size, 20480)
+
+    def test_delete(self):
+        new = copy.deepcopy(self.inventory)
+        del new['guests'][1]
+        del new['guests'][0]['vnics'][0]
+        del new['networks'][1]
+        del new['hardware']['interfaces'][1]
+        self.assertEqual(self.sync(new), {
+            'Guest': (0, 0, 1), 'VirtualNic': (0, 0, 1),
+            'Network': (0, 0, 1), 'Interface': (0, 0, 1),
+            'ResourcePool': (0, 0, 1)})
+        self.assertEqual(list(Guest.objects.values_list('name', flat=True)),
+                         ['web1'])
+        # the disks of the deleted guest go with it
+        self.assertEqual(Disk.objects.count(), 1)
+        self.assertEqual(VirtualNic.objects.count(), 0)
+        self.assertEqual(list(Network.objects.values_list('name', flat=True)),
+                         ['VM Network'])
+        self.assertEqual(Hypervisor.objects.get(name='esx1').numGuests, 1)
+
+    def test_orphans(self):
+        sync_hypervisor(inventory('esx2'), 'DC1', '')
+        new = copy.deepcopy(self.inventory)
+        new['hardware']['datastores'] = []
+        for g in new['guests']:
+            g['disks'] = []
+        self.assertEqual(self.sync(new)['Datastore'], (0, 0, 1))
+        # the shared datastore is still mounted by esx2, the local one
+        # is left without hypervisor and deleted
+        self.assertEqual(
+            sorted(Datastore.objects.values_list('url', flat=True)),
+            ['ds:///esx2/', 'ds:///shared/'])
+        shared = Datastore.objects.get(url='ds:///shared/')
+        self.assertEqual(list(shared.hypervisors.values_list('name',
+                                                             flat=True)),
+                         ['esx2'])
+        self.assertEqual(shared.numGuests, 0)
+
+    def test_move(self):
+        stats = self.sync(inventory('esx2', [('db1', 'Dev')]))
+        self.assertEqual(stats['Guest'], (0, 1, 0))
+        self.assertEqual(Guest.objects.get(name='db1').hypervisor.name,
+                         'esx2')
+        self.assertEqual(dict(Hypervisor.objects.values_list(
+            'name', 'numGuests')), {'esx1': 1, 'esx2': 1})
+
+    def test_pools(self):
+        # the pools are per datacenter, the empty ones are deleted
+        stats = sync_hypervisor(inventory('esx2', [('app1', 'Prod')]), 'DC2',
+                                '')
+        self.assertEqual(stats['ResourcePool'], (1, 0, 0))
+        self.assertEqual(
+            sorted(Guest.objects.values_list('name', 'pool__datacenter')),
+            [('app1', 'DC2'), ('db1', 'DC1'), ('web1', 'DC1')])
+        new = copy.deepcopy(self.inventory)
+        new['guests'][1]['resourcePool'] = 'Prod'
+        self.assertEqual(self.sync(new)['ResourcePool'], (0, 0, 1))
+        self.assertEqual(sorted(ResourcePool.objects.values_list(
+            'datacenter', 'name')), [('DC1', 'Prod'), ('DC2', 'Prod')])
+        self.assertEqual(Guest.objects.get(name='db1').pool.name, 'Prod')
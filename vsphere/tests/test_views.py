@@ -0,0 +1,264 @@
+from django.test import TestCase
+from vsphere.models import Hypervisor, Guest, Disk, ResourcePool, Datacenter
+from vsphere.models import Datastore, Vswitch, Interface, Network, VirtualNic
+from vsphere.templatetags.percent import percent
+from vsphere.views import resourcepool_list_info
+
+
+class HomeTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def test_summary(self):
+        Datacenter.objects.create(
+            name='DC1', numHypervisors=2, numCpuThreads=64,
+            memorySize=131072, datastoresSize=3000, numGuests=3,
+            memoryReserved=32768, vcpuReserved=96, diskReserved=1000,
+            rawDiskReserved=500)
+        # a datacenter without storage, memory or threads
+        Datacenter.objects.create(name='DC0', numHypervisors=1)
+        with self.assertNumQueries(1):
+            response = self.client.get('/')
+        self.assertEqual(response.context['datacenter'], [
+            {'name': 'DC0', 'nb_hv': 1, 'nb_guest': 0, 'used_storage': 0,
+             'used_mem': 0, 'cpu_consolidation': 0.0,
+             'raw_storage_reserved': 0},
+            {'name': 'DC1', 'nb_hv': 2, 'nb_guest': 3, 'used_storage': 33,
+             'used_mem': 25, 'cpu_consolidation': 1.5,
+             'raw_storage_reserved': 500}])
+
+
+class ResourcePoolsTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        hypervisor = Hypervisor.objects.create(
+            name='esx1', numCpuPkgs=2, numCpuThreads=32, memorySize=65536,
+            numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+            datacenter='DC1')
+        for i in range(30):
+            pool = ResourcePool.objects.create(name='pool%02d' % i,
+                                               datacenter='DC1')
+            for j in range(2):
+                g = Guest.objects.create(
+                    name='vm%02d-%d' % (i, j), poweredOn=True, vcpu=j + 1,
+                    memory=1024 * (j + 1), resourcePool=pool.name,
+                    pool=pool, hypervisor=hypervisor)
+                if j:
+                    Disk.objects.create(name='Hard disk 1', size=1000,
+                                        guest=g)
+
+    def test_list(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/resourcepools', {'page': 2})
+        rows = list(response.context['resourcepool_list'])
+        self.assertEqual([rp['name'] for rp in rows],
+                         ['pool%02d' % i for i in range(25, 30)])
+        self.assertEqual(rows[0], {'name': 'pool25', 'num_vm': 2,
+                                   'memory_avg': 1536, 'storage_avg': 500,
+                                   'vcpu_avg': 1.5})
+
+    def test_cursor(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/resourcepools', {'cursor': ''})
+        rows = list(response.context['resourcepool_list'])
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['num_vm'], 2)
+
+
+class ResourcePoolStatsTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        for dc in ('DC1', 'DC2'):
+            hypervisor = Hypervisor.objects.create(
+                name='esx-%s' % dc, numCpuPkgs=2, numCpuThreads=32,
+                memorySize=65536, numCpuCores=16, cpuMhz=2600, numHBAs=2,
+                numNics=4, datacenter=dc)
+            pools = dict((name, ResourcePool.objects.create(
+                name=name, datacenter=dc)) for name in ('Prod', 'Dev'))
+            for name, pool, memory, vcpu, disks in [
+                    ('web', 'Prod', 4096, 4, [(1000, False)]),
+                    ('db', 'Prod', 8192, 2, [(2000, False), (500, True)]),
+                    ('test', 'Dev', 1024, 8, [])]:
+                g = Guest.objects.create(
+                    name='%s-%s' % (name, dc), poweredOn=True, vcpu=vcpu,
+                    memory=memory, resourcePool=pool, pool=pools[pool],
+                    hypervisor=hypervisor)
+                for size, raw in disks:
+                    Disk.objects.create(name='Hard disk', size=size, raw=raw,
+                                        guest=g)
+        ResourcePool.objects.create(name='Empty', datacenter='DC1')
+
+    def test_stats(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/resourcepoolstats')
+        # the pools of the same name are counted together, without raw disks
+        self.assertEqual(response.context['resource_pool'], [
+            {'name': 'Dev', 'num_vm': 2, 'mem_reserved': 2048,
+             'vcpu_reserved': 16, 'disk_reserved': 0},
+            {'name': 'Empty', 'num_vm': 0, 'mem_reserved': 0,
+             'vcpu_reserved': 0, 'disk_reserved': 0},
+            {'name': 'Prod', 'num_vm': 4, 'mem_reserved': 24576,
+             'vcpu_reserved': 12, 'disk_reserved': 6000}])
+
+    def test_top10(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/top10resourcepools')
+        self.assertEqual(response.context['top10_mem'],
+                         ['Prod', 'Dev', 'Empty'])
+        self.assertEqual(response.context['top10_cpu'],
+                         ['Dev', 'Prod', 'Empty'])
+        self.assertEqual(response.context['top10_disk'][0], 'Prod')
+
+    def test_list_info(self):
+        with self.assertNumQueries(2):
+            rows = resourcepool_list_info(['Prod', 'Empty'])
+        # the storage average includes the raw disks
+        self.assertEqual(rows, [
+            {'name': 'Prod', 'num_vm': 4, 'memory_avg': 6144,
+             'storage_avg': 1750.0, 'vcpu_avg': 3},
+            {'name': 'Empty', 'num_vm': 0, 'memory_avg': 0,
+             'storage_avg': 0, 'vcpu_avg': 0}])
+
+
+class GuestListTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        for i in range(3):
+            hypervisor = Hypervisor.objects.create(
+                name='esx%d' % i, numCpuPkgs=2, numCpuThreads=32,
+                memorySize=65536, numCpuCores=16, cpuMhz=2600, numHBAs=2,
+                numNics=4, datacenter='DC1')
+            for j in range(10):
+                g = Guest.objects.create(
+                    name='vm%d-%d' % (i, j), poweredOn=True, vcpu=1,
+                    memory=1024, resourcePool='Prod', hypervisor=hypervisor)
+                for size, raw in [(1024, False), (2048, True)]:
+                    Disk.objects.create(name='Hard disk', size=size, raw=raw,
+                                        guest=g)
+
+    def test_rows(self):
+        # the disks and hypervisor of every row come with the page
+        with self.assertNumQueries(2):
+            response = self.client.get('/guests')
+        rows = list(response.context['guest_list'])
+        self.assertEqual(len(rows), 25)
+        self.assertEqual((rows[0].name, rows[0].disks_size,
+                          rows[0].hypervisor.name), ('vm0-0', 3072, 'esx0'))
+        self.assertContains(response, u'3.0\xa0GB', 25)
+        self.assertContains(response, "/hypervisor/?name=esx2", 5)
+
+    def test_cursor(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/guests', {'cursor': ''})
+        self.assertEqual(len(response.context['guest_list']), 25)
+        self.assertContains(response, u'3.0\xa0GB', 25)
+
+
+class HypervisorListTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        # free memory of 8192, 4096 or 0, then free storage of 0 to 900
+        for i in range(30):
+            Hypervisor.objects.create(
+                name='esx%02d' % i, numCpuPkgs=2, numCpuThreads=32,
+                memorySize=65536, memoryReserved=65536 - 4096 * (i % 3),
+                datastoresSize=1000, diskReserved=1000 - 100 * (i % 10),
+                numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+                datacenter='DC1')
+
+    def names(self, response):
+        return [hv.name for hv in response.context['hypervisor_list']]
+
+    def test_order(self):
+        expected = sorted(Hypervisor.objects.all(), key=lambda hv: (
+            hv.memoryReserved - hv.memorySize,
+            hv.diskReserved - hv.datastoresSize, hv.id))
+        expected = [hv.name for hv in expected]
+        with self.assertNumQueries(2):
+            response = self.client.get('/hypervisors')
+        self.assertEqual(self.names(response), expected[:25])
+        response = self.client.get('/hypervisors', {'page': 2})
+        self.assertEqual(self.names(response), expected[25:])
+        hv = list(response.context['hypervisor_list'])[-1]
+        self.assertEqual((hv.memory_percent, hv.storage_percent),
+                         (100, 100))
+
+    def test_no_datastores(self):
+        Hypervisor.objects.filter(name='esx00').update(datastoresSize=0)
+        response = self.client.get('/hypervisor', {'name': 'esx00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(percent(1000, 0), 0)
+        self.assertEqual(percent(512, 1024), 50)
+
+
+class HypervisorPageTest(TestCase):
+    urls = 'vsphere.urls'
+
+    def setUp(self):
+        self.esx1, esx2 = [Hypervisor.objects.create(
+            name=name, numCpuPkgs=2, numCpuThreads=32, memorySize=65536,
+            numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+            datacenter='DC1') for name in ('esx1', 'esx2')]
+        self.shared = Datastore.objects.create(name='shared', url='ds:///1/',
+                                               capacity=4000, reserved=1000)
+        self.shared.hypervisors.add(self.esx1, esx2)
+        local = Datastore.objects.create(name='local', url='ds:///2/',
+                                         capacity=1000)
+        local.hypervisors.add(self.esx1)
+        vswitch = Vswitch.objects.create(name='vSwitch0',
+                                         hypervisor=self.esx1)
+        for name in ('vmnic0', 'vmnic1'):
+            Interface.objects.create(name=name, linkSpeed=10000,
+                                     vswitch=vswitch, hypervisor=self.esx1)
+        self.network = Network.objects.create(name='VM Network', vlanId=0,
+                                              vswitch=vswitch)
+        Network.objects.create(name='Backup', vlanId=20, vswitch=vswitch)
+        self.add_guests(['web1', 'db1'])
+        # a guest of esx2 on the shared datastore
+        self.add_guest('app1', esx2)
+
+    def add_guest(self, name, hypervisor):
+        g = Guest.objects.create(name=name, poweredOn=True, vcpu=1,
+                                 memory=1024, resourcePool='Prod',
+                                 hypervisor=hypervisor)
+        for i in range(2):
+            Disk.objects.create(name='Hard disk %d' % i, size=500, guest=g,
+                                datastore=self.shared)
+        if hypervisor == self.esx1:
+            VirtualNic.objects.create(name='Network adapter 1', guest=g,
+                                      network=self.network)
+
+    def add_guests(self, names):
+        for name in names:
+            self.add_guest(name, self.esx1)
+
+    def get(self):
+        response = self.client.get('/hypervisor', {'name': 'esx1'})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_datastores(self):
+        datastores = self.get().context['datastores']
+        self.assertEqual([(ds.name, ds.guest_names, ds.reserved_percent)
+                          for ds in datastores],
+                         [('local', [], 0),
+                          ('shared', ['web1', 'db1', 'app1'], 25)])
+
+    def test_networks(self):
+        vswitch, = self.get().context['vswitchs']
+        self.assertEqual([i.name for i in vswitch.interface_list],
+                         ['vmnic0', 'vmnic1'])
+        self.assertEqual([(net.name, net.vnic_guests)
+                          for net in vswitch.network_list],
+                         [('VM Network', ['web1', 'db1']), ('Backup', [])])
+
+    def test_queries(self):
+        # the panels don't query per guest, datastore or network
+        with self.assertNumQueries(10):
+            self.get()
+        self.add_guests(['vm%d' % i for i in range(10)])
+        with self.assertNumQueries(10):
+            self.get()
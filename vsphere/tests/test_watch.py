@@ -0,0 +1,200 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from vsphere.models import Hypervisor, Guest, ResourcePool, CapacitySample
+from watch_hypervisors import InventoryWatcher
+from StringIO import StringIO
+import json
+import sys
+
+
+class StubCollector(object):
+    """Property collector returning the batches of updates it was given"""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.properties = None
+
+    def create_filter(self, properties):
+        self.properties = properties
+
+    def wait_for_updates(self, version, max_wait):
+        if not self.batches:
+            return version, False, []
+        return str(int(version or 0) + 1), False, self.batches.pop(0)
+
+
+def enter(obj_type, mor, name):
+    return ('enter', obj_type, mor, [('assign', 'name', name)])
+
+
+def modify(obj_type, mor, name, val):
+    return ('modify', obj_type, mor, [('assign', name, val)])
+
+
+def guest(mor, name, host, pool, memory=1024):
+    return ('enter', 'VirtualMachine', mor, [
+        ('assign', 'name', name),
+        ('assign', 'config.hardware.memoryMB', memory),
+        ('assign', 'config.hardware.numCPU', 2),
+        ('assign', 'runtime.powerState', 'poweredOn'),
+        ('assign', 'runtime.host', host),
+        ('assign', 'resourcePool', pool)])
+
+
+class InventoryWatcherTest(TestCase):
+
+    def setUp(self):
+        for name in ('esx1', 'esx2'):
+            Hypervisor.objects.create(
+                name=name, numCpuPkgs=2, numCpuThreads=32, memorySize=65536,
+                numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+                datacenter='DC1')
+        self.watcher = InventoryWatcher(StubCollector([]))
+        self.watcher.process([
+            enter('HostSystem', 'host-1', 'esx1'),
+            enter('HostSystem', 'host-2', 'esx2'),
+            enter('ResourcePool', 'resgroup-1', 'Prod'),
+            enter('ResourcePool', 'resgroup-2', 'Dev'),
+            guest('vm-1', 'web1', 'host-1', 'resgroup-1'),
+            guest('vm-2', 'db1', 'host-1', 'resgroup-2', 4096),
+            guest('vm-3', 'app1', 'host-2', 'resgroup-1'),
+        ], now=1000)
+
+    def hypervisors(self):
+        return dict(Hypervisor.objects.values_list('name', 'numGuests'))
+
+    def test_initial(self):
+        self.assertEqual(
+            sorted(Guest.objects.values_list('name', 'hypervisor__name',
+                                             'resourcePool', 'memory')),
+            [('app1', 'esx2', 'Prod', 1024), ('db1', 'esx1', 'Dev', 4096),
+             ('web1', 'esx1', 'Prod', 1024)])
+        self.assertEqual(self.hypervisors(), {'esx1': 2, 'esx2': 1})
+        self.assertEqual(Hypervisor.objects.get(name='esx1').memoryReserved,
+                         5120)
+
+    def test_guest_rename(self):
+        guest_id = Guest.objects.get(name='web1').id
+        stats = self.watcher.process(
+            [modify('VirtualMachine', 'vm-1', 'name', 'web2')], now=1010)
+        self.assertEqual(stats['guests'], 1)
+        self.assertFalse(Guest.objects.filter(name='web1').exists())
+        self.assertEqual(Guest.objects.get(name='web2').id, guest_id)
+        self.assertEqual(Guest.objects.count(), 3)
+
+    def test_vmotion(self):
+        self.watcher.process(
+            [modify('VirtualMachine', 'vm-2', 'runtime.host', 'host-2')],
+            now=1010)
+        self.assertEqual(Guest.objects.get(name='db1').hypervisor.name,
+                         'esx2')
+        self.assertEqual(self.hypervisors(), {'esx1': 1, 'esx2': 2})
+        self.assertEqual(Hypervisor.objects.get(name='esx1').memoryReserved,
+                         1024)
+        self.assertEqual(Hypervisor.objects.get(name='esx2').memoryReserved,
+                         5120)
+
+    def test_pool_rename(self):
+        stats = self.watcher.process(
+            [modify('ResourcePool', 'resgroup-2', 'name', 'Devel')],
+            now=1010)
+        self.assertEqual(stats['guests'], 1)
+        self.assertEqual(Guest.objects.get(name='db1').resourcePool, 'Devel')
+        self.assertEqual(Guest.objects.get(name='db1').pool.name, 'Devel')
+        self.assertEqual(sorted(ResourcePool.objects.values_list('name',
+                                                                 flat=True)),
+                         ['Devel', 'Prod'])
+
+    def test_host_leave(self):
+        stats = self.watcher.process([
+            ('leave', 'HostSystem', 'host-2', []),
+            ('leave', 'VirtualMachine', 'vm-3', []),
+        ], now=1010)
+        self.assertEqual(stats['left'], 1)
+        self.assertFalse(Guest.objects.filter(name='app1').exists())
+        # the hypervisor rows are only created and deleted by the imports
+        self.assertEqual(self.hypervisors(), {'esx1': 2, 'esx2': 0})
+        # a guest moved to a host which left is not followed
+        stats = self.watcher.process(
+            [modify('VirtualMachine', 'vm-1', 'runtime.host', 'host-2')],
+            now=1020)
+        self.assertEqual(stats['rows'], 0)
+        self.assertEqual(Guest.objects.get(name='web1').hypervisor.name,
+                         'esx1')
+
+    def test_host_after_guest(self):
+        Hypervisor.objects.create(
+            name='esx3', numCpuPkgs=2, numCpuThreads=32, memorySize=65536,
+            numCpuCores=16, cpuMhz=2600, numHBAs=2, numNics=4,
+            datacenter='DC1')
+        stats = self.watcher.process([
+            guest('vm-4', 'web3', 'host-3', 'resgroup-1'),
+            guest('vm-5', 'web4', 'host-1', 'resgroup-3')], now=1010)
+        self.assertEqual((stats['rows'], stats['pending']), (0, 2))
+        self.assertFalse(Guest.objects.filter(name__in=['web3',
+                                                        'web4']).exists())
+        # the guests are retried once their host and pool enter
+        stats = self.watcher.process(
+            [enter('HostSystem', 'host-3', 'esx3')], now=1020)
+        self.assertEqual(stats['pending'], 1)
+        self.assertEqual(Guest.objects.get(name='web3').hypervisor.name,
+                         'esx3')
+        stats = self.watcher.process(
+            [enter('ResourcePool', 'resgroup-3', 'Test')], now=1030)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(Guest.objects.get(name='web4').pool.name, 'Test')
+        self.assertEqual(self.hypervisors(), {'esx1': 3, 'esx2': 1,
+                                              'esx3': 1})
+
+    def test_batch_queries(self):
+        # the queries of a batch do not grow with its guests
+        queries = []
+        for n, first in ((2, 10), (8, 20)):
+            with CaptureQueriesContext(connection) as context:
+                self.watcher.process(
+                    [guest('vm-%d' % i, 'new%d' % i, 'host-1', 'resgroup-1')
+                     for i in range(first, first + n)] +
+                    [modify('VirtualMachine', 'vm-1',
+                            'config.hardware.memoryMB', 2048 + n)], now=1010)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(self.hypervisors(), {'esx1': 12, 'esx2': 1})
+
+    def test_samples(self):
+        esx1 = Hypervisor.objects.get(name='esx1').id
+        samples = CapacitySample.objects.filter(
+            kind=CapacitySample.HYPERVISOR, entity=esx1,
+            tier=CapacitySample.RAW)
+        self.assertEqual(list(samples.values_list('timestamp', flat=True)),
+                         [1000])
+        stats = self.watcher.process(
+            [modify('VirtualMachine', 'vm-1', 'config.hardware.memoryMB',
+                    2048)], now=1100)
+        self.assertEqual(stats['samples'], 0)
+        self.assertEqual(self.watcher.sample(now=1200), 0)
+        self.assertTrue(self.watcher.sample(now=1300) > 0)
+        self.assertEqual(
+            list(samples.order_by('timestamp').values_list('timestamp',
+                                                           'memory')),
+            [(1000, 5120), (1300, 6144)])
+        self.assertEqual(self.watcher.sample(now=2000), 0)
+
+    def test_run(self):
+        collector = StubCollector([
+            [modify('VirtualMachine', 'vm-1', 'name', 'web2')],
+            [modify('VirtualMachine', 'vm-2', 'runtime.host', 'host-2')]])
+        self.watcher.collector = collector
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.watcher.run(max_wait=1, iterations=3)
+        finally:
+            stdout, sys.stdout = sys.stdout, stdout
+        stats = [json.loads(l) for l in stdout.getvalue().splitlines()]
+        self.assertEqual([s['version'] for s in stats], ['1', '2'])
+        self.assertEqual(self.watcher.version, '2')
+        self.assertEqual(sorted(collector.properties),
+                         ['HostSystem', 'ResourcePool', 'VirtualMachine'])
+        self.assertEqual(
+            sorted(Guest.objects.values_list('name', 'hypervisor__name')),
+            [('app1', 'esx2'), ('db1', 'esx2'), ('web2', 'esx1')])
@@ -16,6 +16,8 @@ urlpatterns = patterns(
     url(r'^top10resourcepools$', 'vsphere.views.top10'),
     url(r'^physical$', 'vsphere.views.physical_statistics'),
     url(r'^datacenter$', 'vsphere.views.datacenter_statistics'),
+    url(r'^history$', 'vsphere.views.capacity_history'),
+    url(r'^simulate$', 'vsphere.views.simulate_placement'),
     url(r'^hypervisor', 'vsphere.views.hypervisor_info'),
     url(r'^guest', 'vsphere.views.guest_info'),
     url(r'^resourcepool', 'vsphere.views.resourcepool'),
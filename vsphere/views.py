@@ -1,9 +1,25 @@
 from vsphere.models import Hypervisor, Guest, Datastore, Disk, Interface, VirtualNic, Network, Vswitch
+from vsphere.models import ResourcePool, Datacenter
+from vsphere.models import CapacitySample, get_samples
+from vsphere.forecast import days_until_full, days_until_full_by_field
+from vsphere.forecast import MAX_CONSOLIDATION
+from vsphere.placement import Simulation, new_guests
+from vsphere.pagination import CursorPage
+from vsphere.templatetags.percent import percent
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import render_to_response
-from django.db.models import Min, Max, Avg, Sum
+from django.db.models import Min, Max, Avg, Sum, Count, StdDev
 from django.template import RequestContext
+from django.db import connection
 from django.http import HttpResponse
+import heapq
+import json
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def list_deviation(l):
@@ -18,43 +34,55 @@ def list_deviation(l):
     return standard_deviation
 
 
-def home(request):
-    hypervisor_list = Hypervisor.objects.all()
-    datacenter = [x.datacenter for x in hypervisor_list]
-    datacenter = list(set(datacenter))
+def set_percents(hypervisor_list):
+    """Set the memory and storage percentages shown by
+    hypervisor_list.html on the hypervisors, return them as a list"""
+    hypervisor_list = list(hypervisor_list)
+    for hv in hypervisor_list:
+        hv.memory_percent = percent(hv.memoryReserved, hv.memorySize)
+        hv.storage_percent = percent(hv.diskReserved, hv.datastoresSize)
+    return hypervisor_list
+
+
+def cursor_page(request, queryset, **kwargs):
+    """Return the CursorPage of the cursor GET parameter, the first one if
+    it is not a cursor, with the estimated total if total is given. The
+    other GET parameters are kept in its params for the page links"""
+    total = 'total' in request.GET
+    try:
+        page = CursorPage(queryset, request.GET['cursor'], total=total,
+                          **kwargs)
+    except ValueError:
+        page = CursorPage(queryset, total=total, **kwargs)
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    page.params = params.urlencode()
+    return page
+
 
+def home(request):
     ret_val = []
-    for dc in datacenter:
-        hypervisors = Hypervisor.objects.filter(datacenter=dc)
-        num_vm = 0
-        storage = 0
-        storage_reserved = 0
-        mem_reserved = 0
-        mem = 0
-        threads = 0
-        vcpu_reserved = 0
-        raw_storage_reserved = 0
-        for hv in hypervisors:
-            num_vm += hv.get_number_guest()
-            storage += hv.get_datastores_size()
-            storage_reserved += hv.diskReserved
-            mem_reserved += hv.memoryReserved
-            mem += hv.memorySize
-            threads += hv.numCpuThreads
-            vcpu_reserved += hv.vcpuReserved
-            raw_storage_reserved += hv.get_raw_disk_reserved()
-
-        used_storage = int(100 * storage_reserved / storage)
-        used_mem = int(100 * mem_reserved / mem)
-        cpu_consolidation = float(vcpu_reserved) / threads
-
-        info = {'name': dc,
-                'nb_hv': len(hypervisors),
-                'nb_guest': num_vm,
+    # the totals are grouped aggregates of the hypervisors, maintained by
+    # update_datacenters; a datacenter without storage, memory or threads
+    # shows 0
+    for dc in Datacenter.objects.order_by('name'):
+        used_storage = 0
+        if dc.datastoresSize:
+            used_storage = int(100 * dc.diskReserved / dc.datastoresSize)
+        used_mem = 0
+        if dc.memorySize:
+            used_mem = int(100 * dc.memoryReserved / dc.memorySize)
+        cpu_consolidation = 0.0
+        if dc.numCpuThreads:
+            cpu_consolidation = float(dc.vcpuReserved) / dc.numCpuThreads
+
+        info = {'name': dc.name,
+                'nb_hv': dc.numHypervisors,
+                'nb_guest': dc.numGuests,
                 'used_storage': used_storage,
                 'used_mem': used_mem,
                 'cpu_consolidation': cpu_consolidation,
-                'raw_storage_reserved': raw_storage_reserved,
+                'raw_storage_reserved': dc.rawDiskReserved,
                 }
         ret_val.append(info)
 
@@ -66,27 +94,31 @@ def home(request):
                               context_instance=RequestContext(request))
 
 
+def resourcepool_names():
+    return ResourcePool.objects.order_by('name').values_list(
+        'name', flat=True).distinct()
+
+
 def resourcepools_info(request):
-    guest_list = Guest.objects.all()
-    resource_pool = [x.resourcePool for x in guest_list]
-    resource_pool = list(set(resource_pool))
+    resource_pool = resourcepool_names()
+
+    # pools of the same name in several datacenters are counted together
+    totals = dict((r['pool__name'], r) for r in Guest.objects.exclude(
+        pool=None).values('pool__name').annotate(
+        num_vm=Count('id'), mem_reserved=Sum('memory'),
+        vcpu_reserved=Sum('vcpu')))
+    disks = dict(Disk.objects.filter(raw=False).exclude(
+        guest__pool=None).values_list('guest__pool__name').annotate(
+        Sum('size')))
 
     ret_val = []
     for rp in resource_pool:
-        guests = Guest.objects.filter(resourcePool=rp)
-        num_vm = len(guests)
-        mem_reserved = 0
-        vcpu_reserved = 0
-        disk_reserved = 0
-        for guest in guests:
-            mem_reserved += guest.memory
-            vcpu_reserved += guest.vcpu
-            disk_reserved += guest.get_disk_reserved(raw=False)
+        total = totals.get(rp, {})
         info = {'name': rp,
-                'num_vm': num_vm,
-                'mem_reserved': mem_reserved,
-                'vcpu_reserved': vcpu_reserved,
-                'disk_reserved': disk_reserved,
+                'num_vm': total.get('num_vm', 0),
+                'mem_reserved': total.get('mem_reserved') or 0,
+                'vcpu_reserved': total.get('vcpu_reserved') or 0,
+                'disk_reserved': disks.get(rp) or 0,
                 }
         ret_val.append(info)
 
@@ -106,67 +138,63 @@ def stats_by_resourcepool(request):
 def top10(request):
     data = resourcepools_info(request)
     d = data['resource_pool']
-    data['top10_mem'] = [x['name'] for x in sorted(d, key=lambda a: -a['mem_reserved'])][:10]
-    data['top10_cpu'] = [x['name'] for x in sorted(d, key=lambda a: -a['vcpu_reserved'])][:10]
-    data['top10_disk'] = [x['name'] for x in sorted(d, key=lambda a: -a['disk_reserved'])][:10]
+    data['top10_mem'] = [x['name'] for x in heapq.nlargest(10, d, key=lambda a: a['mem_reserved'])]
+    data['top10_cpu'] = [x['name'] for x in heapq.nlargest(10, d, key=lambda a: a['vcpu_reserved'])]
+    data['top10_disk'] = [x['name'] for x in heapq.nlargest(10, d, key=lambda a: a['disk_reserved'])]
 
     return render_to_response('top10.html',
                               data,
                               context_instance=RequestContext(request))
 
 
+def list_stats(l):
+    """Return the min, max, avg, sum and standard deviation of a list of
+    numbers, in one numpy pass when numpy is installed"""
+    if not l:
+        return dict.fromkeys(('min', 'max', 'avg', 'sum', 'dev'), 0)
+    if numpy is not None:
+        a = numpy.array(l, dtype=float)
+        return {'min': min(l), 'max': max(l), 'avg': float(a.mean()),
+                'sum': sum(l), 'dev': float(a.std())}
+    return {'min': min(l), 'max': max(l), 'avg': sum(l) / float(len(l)),
+            'sum': sum(l), 'dev': list_deviation(l)}
+
+
 def resourcepool_info(rp):
 
-    guest_list = Guest.objects.filter(resourcePool=rp)
-
-    memory_max = guest_list.filter(resourcePool=rp).aggregate(Max('memory'))
-    memory_min = guest_list.filter(resourcePool=rp).aggregate(Min('memory'))
-    memory_avg = guest_list.filter(resourcePool=rp).aggregate(Avg('memory'))
-    memory_sum = guest_list.filter(resourcePool=rp).aggregate(Sum('memory'))
-    memory_dev = list_deviation([x.memory for x in guest_list])
-    vcpu_max = guest_list.filter(resourcePool=rp).aggregate(Max('vcpu'))
-    vcpu_min = guest_list.filter(resourcePool=rp).aggregate(Min('vcpu'))
-    vcpu_avg = guest_list.filter(resourcePool=rp).aggregate(Avg('vcpu'))
-    vcpu_sum = guest_list.filter(resourcePool=rp).aggregate(Sum('vcpu'))
-    vcpu_dev = list_deviation([x.vcpu for x in guest_list])
-    storage_list = [x.get_disk_reserved() for x in guest_list]
-    storage_max = max(storage_list)
-    storage_min = min(storage_list)
-    storage_avg = sum(storage_list) / float(len(storage_list))
-    storage_sum = sum(storage_list)
-    storage_dev = list_deviation(storage_list)
-
-    dc_dict = {}
-    for g in guest_list:
-        dc = g.hypervisor.datacenter
-        if dc not in dc_dict:
-            dc_dict[dc] = 1
-        else:
-            dc_dict[dc] += 1
-    dc_count_guest = []
-    for dc in dc_dict:
-        dc_count_guest.append({'name': dc, 'count': dc_dict.get(dc)})
-
-    info = {
-        'name': rp,
-        'dc_count_guest': dc_count_guest,
-        'guests': guest_list,
-        'memory_max': memory_max.get('memory__max'),
-        'memory_min': memory_min.get('memory__min'),
-        'memory_avg': memory_avg.get('memory__avg'),
-        'memory_sum': memory_sum.get('memory__sum'),
-        'memory_dev': memory_dev,
-        'vcpu_max': vcpu_max.get('vcpu__max'),
-        'vcpu_min': vcpu_min.get('vcpu__min'),
-        'vcpu_avg': vcpu_avg.get('vcpu__avg'),
-        'vcpu_sum': vcpu_sum.get('vcpu__sum'),
-        'vcpu_dev': vcpu_dev,
-        'storage_max': storage_max,
-        'storage_min': storage_min,
-        'storage_avg': storage_avg,
-        'storage_sum': storage_sum,
-        'storage_dev': storage_dev,
-    }
+    guests = Guest.objects.filter(pool__name=rp)
+    guest_list = guests.with_disk_totals().select_related('hypervisor')
+
+    info = {'name': rp, 'guests': guest_list}
+    if connection.features.supports_stddev:
+        stats = guests.aggregate(
+            memory_max=Max('memory'), memory_min=Min('memory'),
+            memory_avg=Avg('memory'), memory_sum=Sum('memory'),
+            memory_dev=StdDev('memory'),
+            vcpu_max=Max('vcpu'), vcpu_min=Min('vcpu'),
+            vcpu_avg=Avg('vcpu'), vcpu_sum=Sum('vcpu'),
+            vcpu_dev=StdDev('vcpu'))
+        # an empty pool has no aggregate
+        info.update((k, v or 0) for k, v in stats.items())
+    else:
+        # the backend has no standard deviation (sqlite)
+        rows = list(guests.values_list('memory', 'vcpu'))
+        for i, name in enumerate(('memory', 'vcpu')):
+            for k, v in list_stats([r[i] for r in rows]).items():
+                info['%s_%s' % (name, k)] = v
+
+    # guests without disk reserve no storage
+    storage_list = [size for guest, size in Disk.objects.filter(
+        guest__pool__name=rp).values_list('guest').annotate(Sum('size'))]
+    info['num_vm'] = guests.count()
+    storage_list += [0] * (info['num_vm'] - len(storage_list))
+    for k, v in list_stats(storage_list).items():
+        info['storage_%s' % k] = v
+
+    info['dc_count_guest'] = [
+        {'name': r['hypervisor__datacenter'], 'count': r['count']}
+        for r in guests.values('hypervisor__datacenter').annotate(
+            count=Count('id')).order_by('hypervisor__datacenter')]
 
     return info
 
@@ -182,27 +210,44 @@ def resourcepool(request):
                               context_instance=RequestContext(request))
 
 
-def resourcepool_info_list(rp):
-    info = resourcepool_info(rp)
-    return {
-        'name': rp,
-        'guests': info.get('guests'),
-        'memory_avg': info.get('memory_avg'),
-        'storage_avg': info.get('storage_avg'),
-        'vcpu_avg': info.get('vcpu_avg'),
-    }
+def resourcepool_list_info(names):
+    """Return the guest count and average memory, storage and vCPU of the
+    resource pools of a list or queryset of names, with two grouped
+    queries whatever the number of pools"""
+    totals = dict((r['pool__name'], r) for r in Guest.objects.filter(
+        pool__name__in=names).values('pool__name').annotate(
+        num_vm=Count('id'), memory_avg=Avg('memory'), vcpu_avg=Avg('vcpu')))
+    # guests without disk count in the storage average
+    disks = dict(Disk.objects.filter(
+        guest__pool__name__in=names).values_list(
+        'guest__pool__name').annotate(Sum('size')))
 
+    ret_val = []
+    for rp in names:
+        total = totals.get(rp, {})
+        num_vm = total.get('num_vm', 0)
+        ret_val.append({
+            'name': rp,
+            'num_vm': num_vm,
+            'memory_avg': total.get('memory_avg') or 0,
+            'storage_avg': num_vm and float(disks.get(rp) or 0) / num_vm,
+            'vcpu_avg': total.get('vcpu_avg') or 0,
+        })
+    return ret_val
 
-def resourcepools(request):
-    rp_list = [g.resourcePool for g in Guest.objects.all()]
-    rp_list = list(set(rp_list))
 
-    data = []
-    for rp in rp_list:
-        info = resourcepool_info_list(rp)
-        data.append(info)
+def resourcepools(request):
+    rp_list = resourcepool_names()
+
+    if 'cursor' in request.GET:
+        data_pag = cursor_page(request, rp_list, keys=('name',))
+        data_pag.object_list = resourcepool_list_info(data_pag.object_list)
+        return render_to_response('resourcepools.html',
+                                  {'resourcepool_list': data_pag,
+                                   'cursor': True},
+                                  context_instance=RequestContext(request))
 
-    paginator = Paginator(data, 25)
+    paginator = Paginator(rp_list, 25)
 
     page = request.GET.get('page')
     try:
@@ -211,6 +256,8 @@ def resourcepools(request):
         data_pag = paginator.page(1)
     except EmptyPage:
         data_pag = paginator.page(paginator.num_pages)
+    # only the pools of the page are computed
+    data_pag.object_list = resourcepool_list_info(list(data_pag.object_list))
 
     data = {
         'resourcepool_list': data_pag,
@@ -222,22 +269,25 @@ def resourcepools(request):
 
 
 def hypervisors(request):
-    hypervisor_list = Hypervisor.objects.all()
-    hypervisor_list_sorted = sorted(hypervisor_list,
-                                    key=lambda a: (a.memoryReserved - a.memorySize,
-                                                   a.diskReserved - a.get_datastores_size()))
-    paginator = Paginator(hypervisor_list_sorted, 25)
+    if 'cursor' in request.GET:
+        hypervisors_pag = cursor_page(request, Hypervisor.objects.all())
+    else:
+        hypervisor_list = Hypervisor.objects.by_free_capacity()
+        paginator = Paginator(hypervisor_list, 25)
 
-    page = request.GET.get('page')
-    try:
-        hypervisors_pag = paginator.page(page)
-    except PageNotAnInteger:
-        hypervisors_pag = paginator.page(1)
-    except EmptyPage:
-        hypervisors_pag = paginator.page(paginator.num_pages)
+        page = request.GET.get('page')
+        try:
+            hypervisors_pag = paginator.page(page)
+        except PageNotAnInteger:
+            hypervisors_pag = paginator.page(1)
+        except EmptyPage:
+            hypervisors_pag = paginator.page(paginator.num_pages)
+
+    hypervisors_pag.object_list = set_percents(hypervisors_pag.object_list)
 
     data = {
         'hypervisor_list': hypervisors_pag,
+        'cursor': 'cursor' in request.GET,
     }
     return render_to_response('hypervisors.html',
                               data,
@@ -245,20 +295,24 @@ def hypervisors(request):
 
 
 def guests(request):
-    guest_list = Guest.objects.all()
-    guest_list = guest_list.order_by('name')
-    paginator = Paginator(guest_list, 25)
+    guest_list = Guest.objects.with_disk_totals().select_related('hypervisor')
+    if 'cursor' in request.GET:
+        guests = cursor_page(request, guest_list)
+    else:
+        guest_list = guest_list.order_by('name')
+        paginator = Paginator(guest_list, 25)
 
-    page = request.GET.get('page')
-    try:
-        guests = paginator.page(page)
-    except PageNotAnInteger:
-        guests = paginator.page(1)
-    except EmptyPage:
-        guests = paginator.page(paginator.num_pages)
+        page = request.GET.get('page')
+        try:
+            guests = paginator.page(page)
+        except PageNotAnInteger:
+            guests = paginator.page(1)
+        except EmptyPage:
+            guests = paginator.page(paginator.num_pages)
 
     data = {
         'guest_list': guests,
+        'cursor': 'cursor' in request.GET,
     }
     return render_to_response('guests.html',
                               data,
@@ -286,17 +340,58 @@ def guest_info(request):
 def hypervisor_info(request):
     if 'name' in request.GET and request.GET['name']:
         hypervisor_name = request.GET['name']
-        hypervisor = Hypervisor.objects.filter(name=hypervisor_name)
-        guests = Guest.objects.filter(hypervisor=hypervisor[0])
-        datastores = Datastore.objects.filter(hypervisor=hypervisor[0])
-        interfaces = Interface.objects.filter(hypervisor=hypervisor[0])
-        vswitchs = Vswitch.objects.filter(hypervisor=hypervisor[0])
-        networks = Network.objects.filter(vswitch__hypervisor=hypervisor[0])
+        hv = Hypervisor.objects.filter(name=hypervisor_name)[0]
+        guests = Guest.objects.with_disk_totals().filter(hypervisor=hv)
+        datastores = Datastore.objects.filter(hypervisors=hv)
+        interfaces = list(Interface.objects.filter(hypervisor=hv))
+        vswitchs = list(Vswitch.objects.filter(hypervisor=hv))
+        networks = list(Network.objects.filter(vswitch__hypervisor=hv))
+
+        datastores = list(datastores.order_by('name'))
+        full = days_until_full(CapacitySample.DATASTORE, 'disk',
+                               dict((ds.id, ds.capacity) for ds in datastores))
+        # guest names of the disks of each datastore, in disk order
+        ds_guests = {}
+        seen = set()
+        for ds, name in Disk.objects.filter(datastore__in=datastores).order_by(
+                'id').values_list('datastore', 'guest__name'):
+            if (ds, name) not in seen:
+                seen.add((ds, name))
+                ds_guests.setdefault(ds, []).append(name)
+        for ds in datastores:
+            ds.fullIn = full.get(ds.id)
+            ds.guest_names = ds_guests.get(ds.id, [])
+            ds.reserved_percent = percent(ds.reserved, ds.capacity)
+        full = days_until_full_by_field(CapacitySample.HYPERVISOR, {
+            'memory': {hv.id: hv.memorySize},
+            'vcpu': {hv.id: hv.numCpuThreads * MAX_CONSOLIDATION}})
+        forecast = {
+            'memory': full.get('memory', {}).get(hv.id),
+            'vcpu': full.get('vcpu', {}).get(hv.id),
+        }
+
+        # interfaces, networks and the guests of their vNICs by vswitch
+        vnic_guests = {}
+        for net, name in VirtualNic.objects.filter(
+                network__in=networks).order_by('id').values_list(
+                'network', 'guest__name'):
+            vnic_guests.setdefault(net, []).append(name)
+        vs_interfaces = {}
+        for i in interfaces:
+            vs_interfaces.setdefault(i.vswitch_id, []).append(i)
+        vs_networks = {}
+        for net in networks:
+            net.vnic_guests = vnic_guests.get(net.id, [])
+            vs_networks.setdefault(net.vswitch_id, []).append(net)
+        for vs in vswitchs:
+            vs.interface_list = vs_interfaces.get(vs.id, [])
+            vs.network_list = vs_networks.get(vs.id, [])
 
         data = {
-            'hypervisor':   hypervisor[0],
+            'hypervisor':   hv,
+            'forecast':     forecast,
             'guests':       guests,
-            'datastores':   datastores.order_by('name'),
+            'datastores':   datastores,
             'interfaces':   interfaces,
             'vswitchs':     vswitchs,
             'networks':     networks,
@@ -308,23 +403,48 @@ def hypervisor_info(request):
         return HttpResponse('Please submit something !')
 
 
+def capacity_history(request):
+    kind = CapacitySample.KINDS.get(request.GET.get('kind'))
+    if kind is None or not request.GET.get('id', '').isdigit():
+        return HttpResponse('Please submit something !')
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    start = int(time.time()) - days * 86400
+    data = get_samples(kind, int(request.GET['id']), start)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def simulate_placement(request):
+    try:
+        simulation = Simulation(request.GET.get('datacenter'))
+        guests = simulation.evacuate(request.GET.getlist('lose'))
+        for spec in request.GET.getlist('new'):
+            guests += new_guests(spec)
+    except ImportError as e:
+        return HttpResponse(str(e))
+    except ValueError:
+        return HttpResponse('Please submit something !')
+    data = simulation.place(guests, request.GET.get('fit') == 'best')
+    data['hypervisors'] = simulation.free()
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
 def search(request):
     if 'filter' in request.GET and request.GET['filter']:
         field = request.GET['filter']
-        hypervisor_list = Hypervisor.objects.filter(name__icontains=field)
-        guest_list = Guest.objects.filter(name__icontains=field)
-        resourcepool_list = [g.resourcePool for g in Guest.objects.all()]
-        resourcepool_list = list(set(resourcepool_list))
-
-        data = []
-        for rp in [rp for rp in resourcepool_list if field.lower() in rp.lower()]:
-            info = resourcepool_info_list(rp)
-            data.append(info)
+        hypervisor_list = set_percents(Hypervisor.objects.filter(
+            name__icontains=field))
+        guest_list = Guest.objects.with_disk_totals().select_related(
+            'hypervisor').filter(name__icontains=field)
+        resourcepool_list = resourcepool_names().filter(
+            name__icontains=field)
 
         data = {
             'hypervisor_list':  hypervisor_list,
             'guest_list':       guest_list,
-            'resourcepool_list': data,
+            'resourcepool_list': resourcepool_list_info(resourcepool_list),
         }
         return render_to_response('search.html',
                                   data,
@@ -333,19 +453,6 @@ def search(request):
         return HttpResponse('Please submit something !')
 
 
-def interface_statistics(hv):
-    inter_list = Interface.objects.filter(
-        hypervisor=hv).exclude(vswitch=None)
-    ret_val = {}
-    for i in inter_list:
-        if i.linkSpeed in ret_val:
-            ret_val[i.linkSpeed] += 1
-        else:
-            ret_val[i.linkSpeed] = 1
-
-    return ret_val
-
-
 def sum_list_dict(l):
     ret_val = {}
     for d in l:
@@ -358,45 +465,21 @@ def sum_list_dict(l):
 
 
 def datacenter_info(request):
-    hypervisor_list = Hypervisor.objects.all()
-    ret_val = {}
-    for hv in hypervisor_list:
-        datacenter = hv.datacenter
-        if datacenter not in ret_val:
-            ret_val[datacenter] = {'threads': 0, 'vcpu_reserved': 0,
-                                   'memory': 0, 'mem_reserved': 0, 'guest': 0,
-                                   'hypervisor': 0, 'storage': 0,
-                                   'esxiversion': [], 'disk_reserved': 0,
-                                   'linkspeed': [], 'raw': 0}
-        ret_val[datacenter]['hypervisor'] += 1
-        ret_val[datacenter]['threads'] += hv.numCpuThreads
-        ret_val[datacenter]['vcpu_reserved'] += hv.vcpuReserved
-        ret_val[datacenter]['memory'] += hv.memorySize
-        ret_val[datacenter]['mem_reserved'] += hv.memoryReserved
-        ret_val[datacenter]['storage'] += hv.get_datastores_size()
-        ret_val[datacenter]['disk_reserved'] += hv.diskReserved
-        ret_val[datacenter]['raw'] += hv.get_raw_disk_reserved()
-        ret_val[datacenter]['guest'] += hv.get_number_guest()
-        ret_val[datacenter]['linkspeed'].append(interface_statistics(hv))
-        ret_val[datacenter]['esxiversion'].append({str(hv.productVersion): 1})
-
     datacenter = []
-    for dc in ret_val:
+    for dc in Datacenter.objects.all():
         datacenter.append({
-            'datacenter': dc,
-            'hypervisor': ret_val[dc]['hypervisor'],
-            'storage': ret_val[dc]['storage'],
-            'threads': ret_val[dc]['threads'],
-            'guest': ret_val[dc]['guest'],
-            'vcpu_reserved': ret_val[dc]['vcpu_reserved'],
-            'mem_reserved': ret_val[dc]['mem_reserved'],
-            'disk_reserved': ret_val[dc]['disk_reserved'],
-            'raw': ret_val[dc]['raw'],
-            'memory': ret_val[dc]['memory'],
-            'linkspeed': reduce(lambda x, y: dict((k, v + y[k])
-                                                  for k, v in x.iteritems()),
-                                ret_val[dc]['linkspeed']),
-            'esxiversion': sum_list_dict(ret_val[dc]['esxiversion']),
+            'datacenter': dc.name,
+            'hypervisor': dc.numHypervisors,
+            'storage': dc.datastoresSize,
+            'threads': dc.numCpuThreads,
+            'guest': dc.numGuests,
+            'vcpu_reserved': dc.vcpuReserved,
+            'mem_reserved': dc.memoryReserved,
+            'disk_reserved': dc.diskReserved,
+            'raw': dc.rawDiskReserved,
+            'memory': dc.memorySize,
+            'linkspeed': dc.get_link_speeds(),
+            'esxiversion': dc.get_esxi_versions(),
         })
     data = {
         'data': datacenter,
@@ -419,23 +502,40 @@ def physical_statistics(request):
 
 def datacenter_statistics(request):
     data = datacenter_info(request)
-    guest_list = Guest.objects.all()
+    guest_count = Guest.objects.values('hypervisor__datacenter',
+                                       'resourcePool').annotate(
+        count=Count('id'))
 
     guest_rp_dc = {}
-    for guest in guest_list:
-        rp = guest.resourcePool
-        dc = guest.hypervisor.datacenter
-        if dc not in guest_rp_dc.keys():
+    for r in guest_count:
+        dc = r['hypervisor__datacenter']
+        if dc not in guest_rp_dc:
             guest_rp_dc[dc] = {}
-        if rp not in guest_rp_dc[dc]:
-            guest_rp_dc[dc][rp] = 0
-
-        guest_rp_dc[dc][rp] += 1
+        guest_rp_dc[dc][r['resourcePool']] = r['count']
     u = []
     for dc in guest_rp_dc:
         temp = guest_rp_dc[dc]
         temp['name'] = dc
         u.append(temp)
     data['guest_rp_dc'] = u
+
+    keys = dict(Hypervisor.objects.values_list('id', 'datacenter'))
+    forecasts = [
+        ('memory_full', 'memory', 'memory'),
+        ('storage_full', 'disk', 'storage'),
+        ('vcpu_full', 'vcpu', 'threads'),
+    ]
+    capacities = {}
+    for name, field, capacity in forecasts:
+        capacities[field] = dict((x['datacenter'], x[capacity])
+                                 for x in data['data'])
+    for dc in capacities['vcpu']:
+        capacities['vcpu'][dc] *= MAX_CONSOLIDATION
+    # keys holds every hypervisor, the samples are not filtered by id
+    full = days_until_full_by_field(CapacitySample.HYPERVISOR, capacities,
+                                    keys, all_entities=True)
+    for name, field, capacity in forecasts:
+        for x in data['data']:
+            x[name] = full.get(field, {}).get(x['datacenter'])
     return render_to_response('datacenter.html', data,
                               context_instance=RequestContext(request))